@@ -1,26 +1,78 @@
 # app_pg.py — Mostefaoui DZShop Affiliates (complete)
 # تشغيل محلي:  py app_pg.py
 # تشغيل إنتاج (Render): gunicorn app_pg:app --workers 3 --timeout 120 --bind 0.0.0.0:$PORT
+# مهمة أسبوعية (cron، الإثنين):  flask --app app_pg weekly-bonus
 # .env يجب أن يحتوي: DATABASE_URL, SECRET_KEY, ADMIN_PASSWORD, (اختياري) CLOUDINARY_URL
 
+import atexit
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import mimetypes
+import multiprocessing
 import os
-from datetime import datetime, timezone, timedelta
-from functools import wraps
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+from decimal import Decimal
 from typing import Optional, Tuple
 
+import click
 from flask import (
-    Flask, render_template, request, redirect, url_for, flash, session, abort, jsonify
+    Flask, render_template, request, redirect, url_for, flash, session, abort, jsonify,
+    g, has_request_context, make_response, before_render_template, template_rendered
 )
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.middleware.proxy_fix import ProxyFix
+from markupsafe import Markup, escape
 from dotenv import load_dotenv
 
+from migrate_db import migrate
+from queries import (
+    USER_BY_EMAIL_SQL, REGISTER_SQL, RATE_SQL, RATE_PRUNE_SQL,
+    SLOW_INSERT_SQL, SLOW_PRUNE_SQL, SLOW_PLAN_SQL, SLOW_REPORT_SQL, BLOB_URL_SQL,
+    CATEGORIES_Q, products_page_query, product_detail_query, product_images_query,
+    affiliate_orders_query, BALANCE_SQL, WITHDRAW_SQL, WEEKLY_BONUS_SQL,
+    DASHBOARD_STATS_Q, DASHBOARD_LATEST_Q, DASHBOARD_WITHDRAWALS_Q, affiliates_page_query, admin_affiliates_query, ADMIN_USER_Q,
+    ORDER_STATUS_SQL, ORDER_STATUS_IMPORT_SQL, ORDER_STATUS_BULK_SQL, WITHDRAW_STATUS_SQL,
+    IMPORT_CATEGORIES_SQL, IMPORT_CATEGORY_IDS_SQL, IMPORT_IDS_SQL, analytics_queries,
+    export_where, orders_export_query, withdrawals_export_query, statement_export_query,
+)
+import queries
+import images
+import exports
+import metrics
+
 import psycopg
 import psycopg.rows
+from psycopg.pq import TransactionStatus
+from psycopg_pool import ConnectionPool, PoolTimeout
 
 import cloudinary
 import cloudinary.uploader
 
+try:
+    import brotli                      # اختياري: بدونه نضغط بـ gzip فقط
+except ImportError:
+    brotli = None
+
 # ===================== إعداد البيئة =====================
 load_dotenv()
 APP_NAME = "Mostefaoui DZShop Affiliates"
@@ -31,12 +83,69 @@ ADMIN_PASSWORD     = os.getenv("ADMIN_PASSWORD", "admin123")
 CLOUDINARY_URL     = os.getenv("CLOUDINARY_URL", "").strip()
 WITHDRAW_MIN       = float(os.getenv("WITHDRAW_MIN", "5000"))
 WEEKLY_BONUS       = float(os.getenv("WEEKLY_BONUS_AMOUNT", "1000"))
+PAGE_SIZE          = int(os.getenv("PAGE_SIZE", "50"))                 # عناصر القوائم في كل صفحة
+PAGE_MAX           = int(os.getenv("PAGE_MAX", "200"))                 # أقصى ?n= مسموح
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", "512"))       # عدد نتائج الاستعلامات المحفوظة لكل عامل
+CATALOG_CACHE_TTL  = float(os.getenv("CATALOG_CACHE_TTL", "300"))      # ثواني؛ حد أعلى للتقادم إن ضاع إشعار
+
+# رفع الصور: sync = بالتوازي داخل الطلب، async = طابور في القاعدة يعالجه عامل في الخلفية
+UPLOAD_WORKERS     = int(os.getenv("UPLOAD_WORKERS", "4"))             # رفعات متوازية لكل عامل
+IMAGE_UPLOAD_MODE  = os.getenv("IMAGE_UPLOAD_MODE", "sync").strip().lower()
+IMAGE_WORKER_THREADS = int(os.getenv("IMAGE_WORKER_THREADS", "1"))     # خيوط معالجة داخل كل عامل (0 = عامل CLI فقط)
+IMAGE_JOB_ATTEMPTS = int(os.getenv("IMAGE_JOB_ATTEMPTS", "5"))
+IMAGE_JOB_BACKOFF  = float(os.getenv("IMAGE_JOB_BACKOFF", "30"))      # ثواني قبل المحاولة الثانية، تتضاعف بعدها
+IMAGE_JOB_LEASE    = float(os.getenv("IMAGE_JOB_LEASE", "600"))       # مهمة محجوزة أطول من هذا تعود للطابور (عامل مات)
+IMAGE_GC_GRACE_HOURS    = float(os.getenv("IMAGE_GC_GRACE_HOURS", "24"))  # ملف يتيم أحدث من هذا لا يُحذف (رفع جارٍ)
+IMAGE_GC_INTERVAL_HOURS = float(os.getenv("IMAGE_GC_INTERVAL_HOURS", "0")) # تنظيف دوري داخل التطبيق (0 = عبر CLI/cron فقط)
+IMAGE_GC_BATCH          = int(os.getenv("IMAGE_GC_BATCH", "1000"))
+
+# كلمات السر: التجزئة في مجمّع عمليات لكل عامل (0 = داخل الطلب)، وحد لمحاولات الدخول/التسجيل
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")  # الهاشات الأقدم تُحدَّث عند الدخول
+HASH_WORKERS       = int(os.getenv("HASH_WORKERS", "1"))               # عمليات تجزئة لكل عامل gunicorn
+HASH_QUEUE_MAX     = int(os.getenv("HASH_QUEUE_MAX", "4"))             # تجزئات منتظرة قبل 503
+HASH_TIMEOUT       = float(os.getenv("HASH_TIMEOUT", "10"))
+AUTH_RATE_WINDOW   = int(os.getenv("AUTH_RATE_WINDOW", "900"))         # ثواني
+AUTH_RATE_IP       = int(os.getenv("AUTH_RATE_IP", "30"))              # محاولات لكل IP في النافذة
+AUTH_RATE_ACCOUNT  = int(os.getenv("AUTH_RATE_ACCOUNT", "10"))         # محاولات فاشلة لكل حساب في النافذة
+TRUSTED_PROXIES    = int(os.getenv("TRUSTED_PROXIES", "1"))            # عدد البروكسيات أمام التطبيق (Render: 1) لقراءة IP الحقيقي
+
+# القياس: /metrics (Prometheus) مجمّع من كل العمال عبر ملفات في METRICS_DIR (امسحه عند كل نشر)
+METRICS_DIR        = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "dzshop-metrics"))
+METRICS_TOKEN      = os.getenv("METRICS_TOKEN", "").strip()            # Authorization: Bearer <token> للـ scraper (بدل جلسة أدمن)
+QUERY_WARN         = int(os.getenv("QUERY_WARN", "30"))                # استعلامات لكل طلب قبل تحذير في السجل
+QUERY_REPEAT_WARN  = int(os.getenv("QUERY_REPEAT_WARN", "5"))          # نفس الاستعلام يتكرر في طلب واحد (N+1)
+
+# سجل الاستعلامات البطيئة (جدول slow_queries؛ الملخص: flask --app app_pg slow-queries)
+SLOW_QUERY_MS      = float(os.getenv("SLOW_QUERY_MS", "250"))          # 0 = معطّل
+SLOW_QUERY_EXPLAIN = float(os.getenv("SLOW_QUERY_EXPLAIN", "0.2"))     # نسبة القراءات البطيئة التي يُلتقط خطتها
+SLOW_QUERY_KEEP_DAYS = int(os.getenv("SLOW_QUERY_KEEP_DAYS", "7"))
+
+# مسبح الاتصالات (لكل عامل gunicorn على حدة)
+DB_POOL_MIN        = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX        = int(os.getenv("DB_POOL_MAX", "4"))
+DB_POOL_TIMEOUT    = float(os.getenv("DB_POOL_TIMEOUT", "10"))         # ثواني انتظار اتصال حر قبل 503
+DB_POOL_MAX_WAIT   = int(os.getenv("DB_POOL_MAX_WAITING", "20"))       # أقصى عدد طلبات منتظرة
+DB_POOL_LIFETIME   = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))  # إعادة تدوير الاتصال بعد هذه المدة
+DB_POOL_IDLE       = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE", "30"))      # فحص الصحة فقط لاتصال خامل أكثر من هذا
+# الاستعلام المتكرر يُحضَّر على الخادم (PREPARE) بعد هذا العدد من التنفيذات على نفس الاتصال => بلا تحليل وتخطيط كل مرة
+# none = معطّل (ضروري خلف pgbouncer بوضع transaction)
+DB_PREPARE_THRESHOLD = os.getenv("DB_PREPARE_THRESHOLD", "5").strip().lower()
+DB_PREPARED_MAX    = int(os.getenv("DB_PREPARED_MAX", "100"))          # استعلامات محضّرة لكل اتصال (الأقدم استعمالًا يُحذف)
+
+# نسخ القراءة (اختياري): روابط مفصولة بمسافة؛ قراءات طلبات GET تُوزَّع عليها بالتناوب، والكتابة وما بعدها للرئيسية
+DATABASE_REPLICA_URLS = os.getenv("DATABASE_REPLICA_URLS", "").split()
+REPLICA_MAX_LAG    = float(os.getenv("REPLICA_MAX_LAG", "10"))         # ثواني تأخر قبل استبعاد النسخة
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))  # فحص التأخر لكل نسخة كل هذه المدة
+REPLICA_RETRY      = float(os.getenv("REPLICA_RETRY", "30"))           # نسخة معطلة تُستبعد هذه المدة ثم تُجرَّب من جديد
+REPLICA_TIMEOUT    = float(os.getenv("REPLICA_TIMEOUT", "2"))          # انتظار اتصال من مسبح النسخة قبل الرجوع للرئيسية
 
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL مفقود")
 
 app = Flask(__name__, static_folder="static")
 app.config["SECRET_KEY"] = SECRET_KEY
+if TRUSTED_PROXIES: app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
 
 UPLOAD_FOLDER = os.path.join("static", "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -48,53 +157,699 @@ if CLOUDINARY_URL:
     USE_CLOUDINARY = True
 
 # ===================== أدوات قاعدة البيانات =====================
+# المسبح يُنشأ بكسل داخل كل عملية: بعد fork لا نستعمل مسبح الأب (مقابسه مشتركة معه)
+_pool: Optional[ConnectionPool] = None
+_pool_pid: Optional[int] = None
+_pool_lock = threading.Lock()
+
+def _reset_pool_after_fork():
+    global _pool, _pool_pid, _pool_lock
+    _pool, _pool_pid, _pool_lock = None, None, threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+def _pool_check(conn):
+    # فحص الصحة يكلف رحلة شبكة: نجريه فقط إن كان الاتصال معطوبًا أو خاملًا منذ مدة
+    if conn.broken or time.monotonic()-getattr(conn, "_dz_used", 0)>DB_POOL_CHECK_IDLE:
+        ConnectionPool.check_connection(conn)
+
+def _pool_reset(conn):
+    conn._dz_used=time.monotonic()
+
+def _pool_configure(conn):
+    conn.prepare_threshold=None if DB_PREPARE_THRESHOLD in ("none","") else int(DB_PREPARE_THRESHOLD)
+    conn.prepared_max=DB_PREPARED_MAX
+    _pool_reset(conn)
+
+def get_pool()->ConnectionPool:
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid!=os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid!=os.getpid():
+                _pool=ConnectionPool(
+                    DATABASE_URL,
+                    kwargs={"autocommit": False},
+                    min_size=DB_POOL_MIN, max_size=max(DB_POOL_MIN, DB_POOL_MAX),
+                    timeout=DB_POOL_TIMEOUT, max_waiting=DB_POOL_MAX_WAIT,
+                    max_lifetime=DB_POOL_LIFETIME, max_idle=DB_POOL_IDLE,
+                    configure=_pool_configure, check=_pool_check, reset=_pool_reset,
+                    name=f"dzshop-{os.getpid()}", open=True,
+                )
+                _pool_pid=os.getpid()
+    return _pool
+
+def close_pool():
+    if _pool is not None and _pool_pid==os.getpid():
+        _pool.close()
+
+atexit.register(close_pool)
+
+# ---- نسخ القراءة: مسبح لكل نسخة (autocommit، بلا معاملة) داخل كل عملية، مثل المسبح الرئيسي ----
+# نسخة لا تتصل أو تتأخر أكثر من REPLICA_MAX_LAG تُستبعد REPLICA_RETRY ثانية وتذهب قراءاتها للرئيسية
+_replicas: list = []
+_replicas_pid: Optional[int] = None
+_replica_rr = itertools.count()
+
+# التأخر بالثواني؛ 0 إن وصل كل ما استلمته النسخة (رئيسية بلا كتابة لا تعني نسخة متأخرة)، أو إن لم تكن نسخة أصلًا
+REPLICA_LAG_SQL="""SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn()=pg_last_wal_replay_lsn() THEN 0
+                          ELSE COALESCE(EXTRACT(epoch FROM now()-pg_last_xact_replay_timestamp()), 0) END"""
+
+def _replica_configure(conn):
+    _pool_configure(conn); conn._dz_replica=True
+
+def replicas()->list:
+    global _replicas, _replicas_pid
+    if DATABASE_REPLICA_URLS and _replicas_pid!=os.getpid():
+        with _pool_lock:
+            if _replicas_pid!=os.getpid():
+                _replicas=[dict(pool=ConnectionPool(
+                                    url, kwargs={"autocommit": True},
+                                    min_size=DB_POOL_MIN, max_size=max(DB_POOL_MIN, DB_POOL_MAX),
+                                    timeout=REPLICA_TIMEOUT, max_lifetime=DB_POOL_LIFETIME, max_idle=DB_POOL_IDLE,
+                                    configure=_replica_configure, check=_pool_check, reset=_pool_reset,
+                                    name=f"dzshop-replica{i}-{os.getpid()}", open=True),
+                                down_until=0.0, checked=0.0)
+                           for i, url in enumerate(DATABASE_REPLICA_URLS)]
+                _replicas_pid=os.getpid()
+    return _replicas
+
+def close_replicas():
+    if _replicas_pid==os.getpid():
+        for r in _replicas: r["pool"].close()
+
+atexit.register(close_replicas)
+
+def replica_down(i:int, reason):
+    replicas()[i]["down_until"]=time.monotonic()+REPLICA_RETRY
+    METRICS.inc("db_replica_failovers_total", replica=i)
+    app.logger.warning("replica %d excluded for %.0fs: %s", i, REPLICA_RETRY, reason)
+
+def _replica_get(i:int):
+    # اتصال سليم وغير متأخر من النسخة i أو None
+    r=replicas()[i]
+    try:
+        conn=r["pool"].getconn()
+    except (PoolTimeout, psycopg.OperationalError) as e:
+        replica_down(i, e); return None
+    now=time.monotonic()
+    if now-r["checked"]>=REPLICA_CHECK_INTERVAL:
+        try:
+            lag=float(conn.execute(REPLICA_LAG_SQL).fetchone()[0])
+        except psycopg.Error as e:
+            r["pool"].putconn(conn); replica_down(i, e); return None
+        r["checked"]=now
+        if lag>REPLICA_MAX_LAG:
+            r["pool"].putconn(conn); replica_down(i, f"lag {lag:.1f}s"); return None
+    return conn
+
 def get_db():
-    return psycopg.connect(DATABASE_URL, autocommit=False)
+    # يُستعمل كـ with get_db() as conn: ... ؛ commit عند النجاح و rollback عند الخطأ ثم يعود الاتصال للمسبح
+    return get_pool().connection()
+
+def pool_stats()->dict:
+    st=dict(get_pool().get_stats())
+    st.update(pid=os.getpid(), min_size=DB_POOL_MIN, max_size=max(DB_POOL_MIN, DB_POOL_MAX),
+              timeout=DB_POOL_TIMEOUT, max_waiting=DB_POOL_MAX_WAIT, max_lifetime=DB_POOL_LIFETIME)
+    now=time.monotonic()
+    if DATABASE_REPLICA_URLS:
+        st["replicas"]=[dict(r["pool"].get_stats(), excluded_for=max(0, round(r["down_until"]-now, 1))) for r in replicas()]
+    return st
+
+# ---- وحدة عمل لكل طلب: اتصال واحد من المسبح ومعاملة واحدة، commit في after_request ----
+# اتصال الطلب في وضع autocommit لدى psycopg ونرسل BEGIN بأنفسنا ضمن أول دفعة:
+# هكذا BEGIN + الاستعلامات = رحلة شبكة واحدة ثم COMMIT = رحلة ثانية
+def db_conn():
+    conn=g.get("_db")
+    if conn is None:
+        conn=get_pool().getconn()
+        conn.autocommit=True
+        g._db=conn
+    return conn
+
+def _needs_begin(conn)->bool:
+    # اتصال الطلب خارج معاملة؛ اتصال نسخة القراءة لا يفتح معاملة أبدًا
+    return conn.autocommit and not getattr(conn, "_dz_replica", False) and conn.info.transaction_status==TransactionStatus.IDLE
+
+def _begin(conn):
+    # يُستدعى داخل pipeline فقط
+    if _needs_begin(conn): conn.execute("BEGIN")
+
+def on_commit(fn):
+    # تُستدعى بعد نجاح COMMIT معاملة الطلب (مثل إبطال الكاش: قبل الـ commit قد يُعاد ملؤه بالقديم)
+    g.setdefault("_on_commit", []).append(fn)
+
+@app.after_request
+def _db_commit(resp):
+    conn=g.get("_db")
+    if conn is not None:
+        st=conn.info.transaction_status
+        if st==TransactionStatus.INERROR: conn.execute("ROLLBACK"); g.pop("_on_commit", None)
+        elif st!=TransactionStatus.IDLE: conn.execute("COMMIT"); _committed()   # فشل الـ commit يظهر كـ 500 بدل redirect "ناجح"
+    for fn in g.pop("_on_commit", ()): fn()
+    if g.pop("_wrote", False): _read_your_writes()
+    return resp
+
+def _committed():
+    # معاملة طلب POST ثُبّتت (هنا أو في db_release قبل عمل بطيء) => كتابة يجب أن يراها المستخدم
+    if request.method not in ("GET","HEAD"): g._wrote=True
+
+def _put_back(conn):
+    try:
+        if not conn.closed and conn.info.transaction_status!=TransactionStatus.IDLE: conn.execute("ROLLBACK")
+        if not conn.closed: conn.autocommit=False
+    finally:
+        get_pool().putconn(conn)
+
+def _replica_release():
+    ro=g.pop("_ro", None)
+    if ro is not None: replicas()[ro[0]]["pool"].putconn(ro[1])
+
+@app.teardown_request
+def _db_release(exc):
+    _replica_release()
+    conn=g.pop("_db", None)
+    if conn is not None: _put_back(conn)
+
+def db_release():
+    # قبل عمل بطيء داخل الطلب (رفع صور...): commit ما سبق وإرجاع الاتصال للمسبح
+    # فلا نحجز اتصالًا ولا أقفال صفوف أثناء الانتظار؛ الاستعلام التالي يأخذ اتصالًا جديدًا
+    _replica_release()
+    conn=g.pop("_db", None)
+    if conn is None: return
+    try:
+        if conn.info.transaction_status==TransactionStatus.INTRANS: conn.execute("COMMIT"); _committed()
+    finally:
+        _put_back(conn)
+
+def _use_conn():
+    # داخل طلب HTTP: اتصال الطلب (بدون commit هنا)؛ خارجه (CLI/تهيئة): اتصال مؤقت مع commit
+    if has_request_context(): return nullcontext(db_conn())
+    return get_db()
+
+def _execute(cur, sql, params):
+    # أول استعلام في معاملة الطلب: BEGIN والاستعلام في رحلة شبكة واحدة
+    conn=cur.connection; t0=time.perf_counter()
+    if _needs_begin(conn):
+        with conn.pipeline():
+            _begin(conn); cur.execute(sql, params)
+    else:
+        cur.execute(sql, params)
+    db_record(((sql, params),), time.perf_counter()-t0)
+
+# ---- توجيه القراءة: طلب GET/HEAD بلا جملة كتابة، ولم يبدأ معاملة على الرئيسية، ولم يكتب صاحبه مؤخرًا ----
+# النسخة المختارة تبقى لكل قراءات الطلب؛ بعد أول معاملة على الرئيسية يبقى الطلب عليها
+_WRITE_SQL=re.compile(r"\b(insert|update|delete|merge|truncate|copy|nextval|setval|pg_notify|pg_advisory_\w+)\b|\bfor\s+(update|share)\b", re.I)
+
+def _replica_ok(stmts)->bool:
+    if not DATABASE_REPLICA_URLS or not has_request_context() or request.method not in ("GET","HEAD"): return False
+    conn=g.get("_db")
+    if conn is not None and conn.info.transaction_status!=TransactionStatus.IDLE: return False
+    if any(_WRITE_SQL.search(q[0]) for q in stmts): return False
+    # بلا كوكي جلسة لا نلمس session: قراءتها تضيف Vary: Cookie فتُبطل كاش الصفحات العامة و API الصور
+    if app.config["SESSION_COOKIE_NAME"] not in request.cookies: return True
+    return session.get("_rw", 0)<time.time()
+
+def _replica_conn():
+    ro=g.get("_ro")
+    if ro is not None: return ro[1]
+    reps=replicas(); start=next(_replica_rr); now=time.monotonic()
+    for k in range(len(reps)):
+        i=(start+k)%len(reps)
+        if reps[i]["down_until"]>now: continue
+        conn=_replica_get(i)
+        if conn is not None:
+            g._ro=(i, conn); return conn
+    return None
+
+def _read(run, stmts, primary:bool=False):
+    # run(conn) على نسخة قراءة إن أمكن؛ انقطاع النسخة أو تعارض مع الاستعادة => نفس القراءة على الرئيسية
+    conn=None if primary or not _replica_ok(stmts) else _replica_conn()
+    if conn is not None:
+        try:
+            out=run(conn)
+            METRICS.inc("db_replica_reads_total", len(stmts), replica=g._ro[0])
+            return out
+        except (psycopg.OperationalError, psycopg.errors.SerializationFailure) as e:
+            i,_=g._ro
+            _replica_release()
+            if isinstance(e, psycopg.OperationalError): replica_down(i, e)
+    with _use_conn() as conn: return run(conn)
+
+def _read_your_writes():
+    # من _db_commit بعد تثبيت كتابة: يقرأ المستخدم من الرئيسية حتى تلحق النسخ (أقصى تأخر مقبول + مدة الفحص)
+    if DATABASE_REPLICA_URLS: session["_rw"]=time.time()+REPLICA_MAX_LAG+REPLICA_CHECK_INTERVAL
 
 def q_all(sql, params=()):
-    with get_db() as conn:
+    def run(conn):
         with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
-            cur.execute(sql, params); return cur.fetchall()
+            _execute(cur, sql, params); return cur.fetchall()
+    return _read(run, ((sql, params),))
 
 def q_one(sql, params=()):
-    with get_db() as conn:
+    def run(conn):
         with conn.cursor(row_factory=psycopg.rows.dict_row) as cur:
-            cur.execute(sql, params); return cur.fetchone()
+            _execute(cur, sql, params); return cur.fetchone()
+    return _read(run, ((sql, params),))
 
 def exec_sql(sql, params=()):
-    with get_db() as conn:
+    with _use_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(sql, params)
-        conn.commit()
+            _execute(cur, sql, params)
 
-# ===================== مساعدين =====================
-def now_iso(): return datetime.now(timezone.utc).isoformat()
+def q_batch(*stmts, primary:bool=False):
+    # استعلامات مستقلة تُرسل دفعة واحدة (pipeline) => رحلة شبكة واحدة
+    # كل عنصر: (sql, params, "one"|"all") ؛ تُنفّذ بالترتيب فالقراءة بعد كتابة في نفس الدفعة ترى أثرها
+    # primary: من الرئيسية دائمًا (ملء كاش الكتالوج: نسخة متأخرة بعد NOTIFY تخزّن القديم حتى TTL)
+    def run(conn):
+        curs=[]; t0=time.perf_counter()
+        with conn.pipeline():
+            _begin(conn)
+            for sql, params, kind in stmts:
+                cur=conn.cursor(row_factory=psycopg.rows.dict_row)
+                cur.execute(sql, params); curs.append((cur, kind))
+        db_record([q[:2] for q in stmts], time.perf_counter()-t0)
+        out=[]
+        for cur, kind in curs:
+            out.append(cur.fetchone() if kind=="one" else cur.fetchall()); cur.close()
+        return out
+    return _read(run, stmts, primary)
+
+# ===================== القياس (metrics) =====================
+# لكل طلب: الزمن، عدد الاستعلامات وزمنها، الرفع، القوالب => هيستوغرامات لكل مسار في /metrics،
+# وفي وضع debug ترويسة Server-Timing (تظهر في أدوات المطوّر بالمتصفح)
+METRICS=metrics.Registry(METRICS_DIR)
+METRICS.counter("http_requests_total", "Requests by endpoint, method and status")
+METRICS.histogram("http_request_duration_seconds", "Request latency")
+METRICS.histogram("db_queries_per_request", "SQL statements per request", metrics.COUNT_BUCKETS)
+METRICS.histogram("db_time_per_request_seconds", "Cumulative SQL time per request")
+METRICS.counter("db_query_warnings_total", "Requests over QUERY_WARN statements or repeating one QUERY_REPEAT_WARN times")
+METRICS.histogram("template_render_seconds", "Template render time")
+METRICS.counter("db_replica_reads_total", "Read statements served by a replica")
+METRICS.counter("db_replica_failovers_total", "Replica excluded (connection error or lag); its reads go to the primary")
+METRICS.histogram("image_upload_seconds", "Time to store one uploaded image")
+atexit.register(METRICS.flush, True)   # آخر ثانية قبل الخروج (gunicorn: worker_exit أيضًا، انظر README)
+
+def db_record(stmts, dt:float):
+    # stmts: [(sql, params)]؛ q_batch: عدة استعلامات في رحلة واحدة => زمن الدفعة مرة واحدة
+    if SLOW_QUERY_MS and dt*1000>=SLOW_QUERY_MS: slow_query(stmts, dt)
+    if not has_request_context(): return
+    g._db_n=g.get("_db_n", 0)+len(stmts); g._db_time=g.get("_db_time", 0.0)+dt
+    g.setdefault("_db_sql", Counter()).update(q[0] for q in stmts)
+
+def _request_add(name:str, dt:float):
+    if has_request_context(): setattr(g, name, g.get(name, 0.0)+dt)
+
+@app.before_request
+def _request_timer():
+    g._t0=time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _template_timer(sender, template, context, **extra):
+    t0=g.pop("_tpl_t0", None) if has_request_context() else None
+    if t0 is None: return
+    dt=time.perf_counter()-t0
+    METRICS.observe("template_render_seconds", dt, template=template.name or "?")
+    _request_add("_tpl_time", dt)
+
+@before_render_template.connect_via(app)
+def _template_start(sender, template, context, **extra):
+    if has_request_context(): g._tpl_t0=time.perf_counter()
+
+@app.after_request
+def _server_timing(resp):
+    if app.debug and "_t0" in g:
+        parts=[f'db;dur={g.get("_db_time", 0.0)*1000:.1f};desc="{g.get("_db_n", 0)} queries"']
+        if "_tpl_time" in g: parts.append(f"tpl;dur={g._tpl_time*1000:.1f}")
+        if "_upload_time" in g: parts.append(f"upload;dur={g._upload_time*1000:.1f}")
+        parts.append(f"app;dur={(time.perf_counter()-g._t0)*1000:.1f}")
+        resp.headers["Server-Timing"]=", ".join(parts)
+    g._status=resp.status_code
+    return resp
 
+@app.teardown_request
+def _request_metrics(exc):
+    t0=g.pop("_t0", None)
+    if t0 is None: return
+    endpoint=request.url_rule.endpoint if request.url_rule else "none"
+    n,dt=g.get("_db_n", 0), g.get("_db_time", 0.0)
+    METRICS.inc("http_requests_total", endpoint=endpoint, method=request.method, status=500 if exc else g.get("_status", 500))
+    METRICS.observe("http_request_duration_seconds", time.perf_counter()-t0, endpoint=endpoint, method=request.method)
+    METRICS.observe("db_queries_per_request", n, endpoint=endpoint)
+    METRICS.observe("db_time_per_request_seconds", dt, endpoint=endpoint)
+    sql,times=(g._db_sql.most_common(1)[0] if n else ("", 0))
+    if n>QUERY_WARN or times>=QUERY_REPEAT_WARN:
+        METRICS.inc("db_query_warnings_total", endpoint=endpoint)
+        app.logger.warning("%s %s: %d queries in %.0fms; most repeated x%d: %s", request.method, request.path,
+                           n, dt*1000, times, " ".join(sql.split())[:200])
+    try: METRICS.flush()
+    except OSError as e: app.logger.warning("metrics flush: %s", e)
+
+# ===================== سجل الاستعلامات البطيئة =====================
+# كل استعلام عبر q_*/exec_sql أبطأ من SLOW_QUERY_MS يُسجَّل في slow_queries من خيط خلفي (طابور محدود:
+# السجل لا يبطئ الطلب أبدًا). لعينة من القراءات: EXPLAIN (ANALYZE, BUFFERS) في معاملة READ ONLY تُلغى بعدها،
+# مرة على الأكثر لكل استعلام كل SLOW_EXPLAIN_EVERY ثانية. الكتابة لا تُعاد
+SLOW_EXPLAIN_EVERY=600
+_SQL_LITERALS=re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_slow_q: Optional[queue.Queue] = None
+_slow_pid: Optional[int] = None
+
+def normalize_sql(sql:str)->str:
+    # مسافات موحدة والثوابت المكتوبة في النص => ? (LIMIT 20 و LIMIT 50 نفس الاستعلام)
+    return " ".join(_SQL_LITERALS.sub("?", sql).split())
+
+def slow_query(stmts, dt:float):
+    global _slow_q, _slow_pid
+    if _slow_pid!=os.getpid():
+        with _pool_lock:
+            if _slow_pid!=os.getpid():
+                _slow_q=queue.Queue(maxsize=200)
+                threading.Thread(target=_slow_query_writer, args=(_slow_q,), name="slow-queries", daemon=True).start()
+                _slow_pid=os.getpid()
+    endpoint=(request.endpoint or "none") if has_request_context() else "cli"
+    try: _slow_q.put_nowait((datetime.now(timezone.utc), endpoint, dt, stmts))
+    except queue.Full: pass
+
+def _explain(conn, sql, params, timeout_ms:int)->Optional[str]:
+    # معاملة READ ONLY + rollback: حتى لو أخطأ التصنيف لا يُكتب شيء
+    try:
+        conn.execute("SET TRANSACTION READ ONLY")
+        conn.execute("SELECT set_config('statement_timeout', %s, true)", (str(timeout_ms),))
+        return "\n".join(r[0] for r in conn.execute("EXPLAIN (ANALYZE, BUFFERS) "+sql, params))
+    except psycopg.Error as e:
+        return f"-- EXPLAIN failed: {e}"
+    finally:
+        conn.rollback()
+
+def _slow_query_writer(q:queue.Queue):
+    explained={}; pruned=0.0
+    while True:
+        at,endpoint,dt,stmts=q.get()
+        try:
+            with get_db() as conn:
+                rows=[]
+                for sql,params in stmts:
+                    norm=normalize_sql(sql); qid=hashlib.sha1(norm.encode()).hexdigest()[:16]
+                    plan=None
+                    if (random.random()<SLOW_QUERY_EXPLAIN and not _WRITE_SQL.search(sql)
+                            and time.monotonic()-explained.get(qid, -SLOW_EXPLAIN_EVERY)>=SLOW_EXPLAIN_EVERY):
+                        explained[qid]=time.monotonic()
+                        plan=_explain(conn, sql, params, min(int(dt*1000*10)+1000, 30000))
+                    rows.append((at, qid, endpoint, dt*1000, len(stmts), norm,
+                                 hashlib.sha1(repr(params).encode()).hexdigest()[:12], plan))
+                with conn.cursor() as cur:
+                    cur.executemany(SLOW_INSERT_SQL, rows)
+                if time.monotonic()-pruned>3600:
+                    conn.execute(SLOW_PRUNE_SQL, (SLOW_QUERY_KEEP_DAYS,))
+                    pruned=time.monotonic()
+        except Exception as e:
+            app.logger.warning("slow query log: %s", e)
+
+@app.cli.command("slow-queries")
+@click.option("--hours", type=float, default=24, help="الفترة (ساعات)")
+@click.option("--limit", type=int, default=15)
+@click.option("--plan", "plan_id", default=None, help="طباعة آخر خطة ملتقطة لهذا query_id")
+def slow_queries_command(hours, limit, plan_id):
+    with get_db() as conn:
+        if plan_id:
+            row=conn.execute(SLOW_PLAN_SQL, (plan_id,)).fetchone()
+            if not row: raise click.ClickException("لا توجد خطة ملتقطة لهذا الاستعلام")
+            click.echo(f"{row[0]:%Y-%m-%d %H:%M} {row[1]} {row[2]:.0f}ms\n{row[3]}\n\n{row[4]}"); return
+        rows=conn.execute(SLOW_REPORT_SQL, (hours*3600, limit)).fetchall()
+    if not rows: click.echo("لا استعلامات بطيئة في هذه الفترة"); return
+    click.echo(f"{'query_id':16}  {'calls':>6}  {'total ms':>10}  {'mean':>8}  {'max':>8}  plan  endpoints / sql")
+    for qid,n,total,mean,mx,eps,sql,has_plan in rows:
+        click.echo(f"{qid:16}  {n:>6}  {total:>10.0f}  {mean:>8.1f}  {mx:>8.0f}  {'yes' if has_plan else '-':4}  {eps}")
+        click.echo(f"{'':18}{sql[:160]}")
+
+# ===================== كاش الكتالوج =====================
+# المنتجات/التصنيفات/الصور/الصفحات تتغير نادرًا وتُقرأ في كل صفحة => كاش داخل العامل (LRU + TTL)
+# المفتاح = (sql, params, kind) نفسه. الإبطال: triggers في القاعدة ترسل NOTIFY catalog_changed
+# وخيط في كل عامل يستمع ويفرغ الكاش؛ إن انقطع الاستماع لا نستعمل الكاش حتى يعود
+class CatalogCache:
+    def __init__(self, maxsize:int, ttl:float):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0          # يزيد مع كل إفراغ: نتيجة قُرئت قبل الإفراغ لا تُخزَّن بعده
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            item=self._data.get(key)
+            if item is not None and item[0]>time.monotonic():
+                self._data.move_to_end(key); self.hits+=1
+                return True, item[1]
+            if item is not None: del self._data[key]
+            self.misses+=1
+            return False, None
+
+    def put(self, key, value, generation:int):
+        with self._lock:
+            if generation!=self.generation: return
+            self._data[key]=(time.monotonic()+self.ttl, value); self._data.move_to_end(key)
+            while len(self._data)>self.maxsize:
+                self._data.popitem(last=False); self.evictions+=1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear(); self.generation+=1; self.invalidations+=1
+
+    def stats(self)->dict:
+        with self._lock:
+            return dict(size=len(self._data), maxsize=self.maxsize, ttl=self.ttl, hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, invalidations=self.invalidations)
+
+catalog_cache=CatalogCache(CATALOG_CACHE_SIZE, CATALOG_CACHE_TTL)
+_listener_pid: Optional[int] = None
+_listener_live = threading.Event()
+
+def _catalog_listener():
+    while True:
+        try:
+            with psycopg.connect(DATABASE_URL, autocommit=True) as conn:
+                conn.execute("LISTEN catalog_changed")
+                catalog_cache.clear()            # قد تكون فاتتنا إشعارات قبل الاتصال
+                _listener_live.set()
+                for _ in conn.notifies(): catalog_cache.clear()
+        except Exception as e:
+            app.logger.warning("catalog listener: %s", e)
+        _listener_live.clear(); time.sleep(5)
+
+def _ensure_listener():
+    # خيط لكل عملية (بعد fork لا يُورث الخيط)
+    global _listener_pid, _listener_live
+    if _listener_pid!=os.getpid():
+        with _pool_lock:
+            if _listener_pid!=os.getpid():
+                _listener_live=threading.Event(); catalog_cache.clear()
+                threading.Thread(target=_catalog_listener, name="catalog-listener", daemon=True).start()
+                _listener_pid=os.getpid()
+    return _listener_live.is_set()
+
+def cached_batch(*stmts):
+    # مثل q_batch لكن من الكاش؛ الناقص فقط يُجلب، في دفعة واحدة
+    if not _ensure_listener(): return q_batch(*stmts)
+    out=[]; missing=[]
+    for i,q in enumerate(stmts):
+        hit,val=catalog_cache.get(q); out.append(val)
+        if not hit: missing.append(i)
+    if missing:
+        gen=catalog_cache.generation
+        for i,val in zip(missing, q_batch(*(stmts[i] for i in missing), primary=True)):
+            out[i]=val; catalog_cache.put(stmts[i], val, gen)
+    return out
+
+def cached_all(sql, params=()): return cached_batch((sql, tuple(params), "all"))[0]
+def cached_one(sql, params=()): return cached_batch((sql, tuple(params), "one"))[0]
+
+def catalog_changed():
+    # العامل الذي كتب يرى التغيير فورًا؛ الباقون عبر NOTIFY (trigger)
+    on_commit(catalog_cache.clear)
+
+# ===================== الملفات الثابتة والضغط =====================
+# css/js/img: بصمة المحتوى في الاسم (css/app.<hash>.css) عبر url_for("static") نفسه => تخزين دائم في المتصفح
+# ونسخ gzip/brotli جاهزة في الذاكرة. الصفحات (HTML/JSON) تُضغط عند الإرسال حسب Accept-Encoding
+# الصور المرفوعة بأسماء البصمة (sha256) لا تتغير أبدًا => immutable أيضًا
+IMMUTABLE="public, max-age=31536000, immutable"
+COMPRESSIBLE={"text/css", "text/javascript", "application/javascript", "image/svg+xml", "application/json",
+              "text/plain", "text/html"}
+COMPRESS_MIN_SIZE=1024          # أصغر من هذا لا يستحق (الترويسات + زمن المعالج)
+CONTENT_ADDRESSED=re.compile(r"^uploads/(_v/)?[0-9a-f]{64}\.")
+
+def _compress(data:bytes, enc:str, level:Optional[int]=None)->bytes:
+    if enc=="br": return brotli.compress(data, quality=11 if level is None else level)
+    return gzip.compress(data, compresslevel=9 if level is None else level, mtime=0)
+
+def _build_assets(root:str)->dict:
+    # يُبنى مرة عند الإقلاع (قبل fork مع --preload)؛ uploads خارجها (تتغير أثناء التشغيل)
+    assets={}
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir=os.path.relpath(dirpath, root).replace(os.sep, "/")
+        if rel_dir=="uploads": dirnames[:]=[]; continue
+        for fn in filenames:
+            if fn.startswith("."): continue
+            rel=fn if rel_dir=="." else f"{rel_dir}/{fn}"
+            with open(os.path.join(dirpath, fn), "rb") as f: data=f.read()
+            digest=hashlib.sha256(data).hexdigest()[:12]
+            stem, ext = os.path.splitext(rel)
+            mt=mimetypes.guess_type(fn)[0] or "application/octet-stream"
+            enc={}
+            if mt in COMPRESSIBLE and len(data)>=256:
+                enc["gzip"]=_compress(data, "gzip")
+                if brotli: enc["br"]=_compress(data, "br")
+            assets[rel]=dict(hashed=f"{stem}.{digest}{ext}", etag=digest, data=data, mimetype=mt, enc=enc)
+    return assets
+
+STATIC_ASSETS=_build_assets(app.static_folder)
+STATIC_BY_HASH={a["hashed"]: rel for rel, a in STATIC_ASSETS.items()}
+
+def _accepted_encoding(available)->Optional[str]:
+    for enc in ("br", "gzip"):
+        if enc in available and request.accept_encodings.quality(enc)>0: return enc
+    return None
+
+@app.url_defaults
+def _static_fingerprint(endpoint, values):
+    # في وضع debug نترك الأسماء كما هي (الملفات تتعدل والقائمة مبنية عند الإقلاع)
+    if endpoint=="static" and not app.debug:
+        a=STATIC_ASSETS.get(values.get("filename", ""))
+        if a: values["filename"]=a["hashed"]
+
+def _static(filename):
+    rel=STATIC_BY_HASH.get(filename)
+    if rel is None:
+        resp=app.send_static_file(filename)
+        if CONTENT_ADDRESSED.match(filename): resp.headers["Cache-Control"]=IMMUTABLE
+        return resp
+    a=STATIC_ASSETS[rel]
+    enc=_accepted_encoding(a["enc"])
+    etag=a["etag"]+("-"+enc if enc else "")
+    if request.if_none_match.contains(etag):
+        resp=app.response_class(status=304)
+    else:
+        resp=app.response_class(a["enc"][enc] if enc else a["data"], mimetype=a["mimetype"])
+        if enc: resp.headers["Content-Encoding"]=enc
+    resp.set_etag(etag); resp.headers["Cache-Control"]=IMMUTABLE; resp.vary.add("Accept-Encoding")
+    return resp
+
+app.view_functions["static"]=_static
+
+@app.after_request
+def _compress_response(resp):
+    # قوائم المنتجات والطلبيات: HTML كبير ومتكرر => يُضغط بـ 70-85%
+    if (resp.direct_passthrough or resp.is_streamed or resp.status_code in (204, 304) or resp.status_code<200
+            or "Content-Encoding" in resp.headers or resp.mimetype not in ("text/html", "application/json")):
+        return resp
+    enc=_accepted_encoding(("br", "gzip") if brotli else ("gzip",))
+    resp.vary.add("Accept-Encoding")
+    data=resp.get_data()
+    if not enc or len(data)<COMPRESS_MIN_SIZE: return resp
+    resp.set_data(_compress(data, enc, level=5 if enc=="br" else 6))   # مستوى سريع: يُضغط مع كل طلب
+    resp.headers["Content-Encoding"]=enc
+    return resp
+
+# ===================== مساعدين =====================
 def allowed_file(filename:str)->bool:
     return "." in filename and filename.rsplit(".",1)[1].lower() in ALLOWED_EXT
 
+# تخزين حسب المحتوى: اسم الملف = sha256 لما رفعه المستخدم => نفس الصورة لعدة منتجات تُخزَّن وتُرفع مرة واحدة
+# المراجع (products.image_path, product_images) تُعدّ في جدول blobs بواسطة triggers في القاعدة
+def _spool(file_storage, dst)->str:
+    # نسخ الملف إلى dst وحساب البصمة أثناء القراءة (دون تحميله كاملًا في الذاكرة)
+    h=hashlib.sha256()
+    for chunk in iter(lambda: file_storage.stream.read(64*1024), b""):
+        h.update(chunk); dst.write(chunk)
+    dst.flush()
+    return h.hexdigest()
+
+def _image_ext(filename:str)->str:
+    # من الاسم الأصلي لا من secure_filename (يحذف الاسم العربي كله مع النقطة)
+    ext=filename.rsplit(".",1)[1].lower()
+    return "jpg" if ext=="jpeg" else ext
+
+def blob_url(digest:str)->Optional[str]:
+    # اتصال قصير خاص: لا نفتح معاملة الطلب أثناء الرفع
+    with get_db() as conn:
+        row=conn.execute(BLOB_URL_SQL, (digest,)).fetchone()
+    return row[0] if row else None
+
 def save_image(file_storage):
     if not file_storage or file_storage.filename=="" or not allowed_file(file_storage.filename):
         return None
+    t0=time.perf_counter()
+    try: return _store_image(file_storage, _image_ext(file_storage.filename))
+    finally:
+        dt=time.perf_counter()-t0
+        METRICS.observe("image_upload_seconds", dt, backend="cloudinary" if USE_CLOUDINARY else "local")
+        _request_add("_upload_time", dt)      # خيوط upload_pool بلا سياق طلب: save_images يحسب المجموع
+
+def _store_image(file_storage, ext:str)->str:
     if USE_CLOUDINARY:
-        res = cloudinary.uploader.upload(
-            file_storage,
-            folder="dzshop/products",
-            resource_type="image",
-            use_filename=True,
-            unique_filename=True,
-            overwrite=False
-        )
+        with tempfile.SpooledTemporaryFile(max_size=8*1024*1024) as tmp:
+            digest=_spool(file_storage, tmp)
+            known=blob_url(digest)
+            if known: return known
+            tmp.seek(0)
+            res = cloudinary.uploader.upload(
+                tmp,
+                folder="dzshop/products",
+                public_id=digest,
+                resource_type="image",
+                unique_filename=False,
+                overwrite=False               # موجودة مسبقًا (رفع متزامن) => يعيد نفس الرابط
+            )
         return res.get("secure_url")
-    # محلي
-    filename = secure_filename(file_storage.filename)
-    base, ext = os.path.splitext(filename)
-    uniq = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-    filename = f"{base}_{uniq}{ext}"
-    path = os.path.join(UPLOAD_FOLDER, filename)
-    file_storage.save(path)
+    # محلي: ملف مؤقت في نفس المجلد ثم os.replace (ذري)؛ EXIF يُحذف قبل النشر
+    fd, tmp_path = tempfile.mkstemp(prefix=".upload-", suffix="."+ext, dir=UPLOAD_FOLDER)
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            digest=_spool(file_storage, tmp)
+        path = os.path.join(UPLOAD_FOLDER, f"{digest}.{ext}")
+        if not os.path.exists(path):
+            try:
+                images.strip_exif(tmp_path)
+            except Exception as e:
+                app.logger.warning("strip exif %s: %s", file_storage.filename, e)
+        # قفل مشترك على البصمة: تنظيف اليتيمة يأخذه حصريًا ويعيد فحص التاريخ قبل الحذف
+        with get_db() as conn:
+            conn.execute("SELECT pg_advisory_xact_lock_shared(hashtextextended(%s,0))", (digest,))
+            if os.path.exists(path):
+                # موجودة: تجديد التاريخ (مع النسخ المصغّرة) يحميها من تنظيف جارٍ (مهلة السماح)
+                for v in [path]+[images.variant_path(path, size, fmt) for size in images.SIZES for fmt in images.FORMATS]:
+                    try: os.utime(v)
+                    except FileNotFoundError: pass
+            else:
+                os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+    # النسخ المصغّرة تُولَّد الآن إن لم تكن موجودة (Cloudinary يحوّل عند الطلب)
+    try:
+        images.make_variants(path)
+    except Exception as e:
+        app.logger.warning("image variants %s: %s", path, e)   # الأصل محفوظ؛ backfill يكمل لاحقًا
     return "/" + path.replace("\\","/")
 
+# مجمّع خيوط الرفع (بعد fork لا تُورث الخيوط => واحد لكل عملية)
+_upload_pool: Optional[ThreadPoolExecutor] = None
+_upload_pid: Optional[int] = None
+
+def upload_pool()->ThreadPoolExecutor:
+    global _upload_pool, _upload_pid
+    if _upload_pid!=os.getpid():
+        with _pool_lock:
+            if _upload_pid!=os.getpid():
+                _upload_pool=ThreadPoolExecutor(max_workers=max(1,UPLOAD_WORKERS), thread_name_prefix="upload")
+                _upload_pid=os.getpid()
+    return _upload_pool
+
+def save_images(files)->list:
+    # رفع بالتوازي (حد أقصى UPLOAD_WORKERS) بنفس ترتيب الملفات؛ None لملف فارغ/غير مسموح
+    if has_request_context(): db_release()
+    if sum(1 for f in files if f and f.filename)<=1: return [save_image(f) for f in files]
+    t0=time.perf_counter()
+    try: return list(upload_pool().map(save_image, files))
+    finally: _request_add("_upload_time", time.perf_counter()-t0)
+
 def dl_url(url_or_path:str)->str:
     if not url_or_path:
         return url_for("static", filename="img/placeholder.svg")
@@ -107,91 +862,297 @@ def dl_url(url_or_path:str)->str:
     if s.startswith("static/"): return "/"+s
     return s
 
+# ---- ترقيم keyset: WHERE id < :before ORDER BY id DESC LIMIT n+1 ----
+# كلفة الصفحة ثابتة مهما كبر الجدول (بعكس OFFSET)؛ الصف الزائد يعني وجود صفحة تالية
+KEYSET_TOP=2**31-1   # أكبر من أي id (SERIAL) => الصفحة الأولى
+
+def page_args(param:str="before")->Tuple[int,int]:
+    before=request.args.get(param, type=int) or KEYSET_TOP
+    n=min(max(request.args.get("n", PAGE_SIZE, type=int),1),PAGE_MAX)
+    return before, n
+
+def keyset_page(rows, n:int, param:str="before", key=lambda r: r["id"]):
+    # رابط الصفحة التالية يحافظ على باقي المعاملات (cat/status/q/...)
+    if len(rows)<=n: return rows, None
+    rows=rows[:n]
+    args=request.args.to_dict(); args[param]=key(rows[-1])
+    return rows, url_for(request.endpoint, **(request.view_args or {}), **args)
+
+def static_url(url_or_path:str)->str:
+    # رابط عرض الأصل (dl_url للتنزيل)
+    if not url_or_path:
+        return url_for("static", filename="img/placeholder.svg")
+    s=url_or_path.strip()
+    return "/"+s if s.startswith("static/") else s
+
+# عرض الشاشة التقريبي لكل حجم (سمة sizes) ليختار المتصفح أصغر نسخة كافية من srcset
+IMG_SIZES_ATTR={"thumb":"96px", "card":"(min-width: 992px) 25vw, 50vw", "detail":"(min-width: 992px) 50vw, 100vw"}
+
+def picture(url_or_path:str, size:str="card", alt:str="", sizes:Optional[str]=None, **attrs)->Markup:
+    # <picture> بـ WebP + JPEG احتياطي و srcset و loading=lazy؛ بدون نسخ (svg/صورة قديمة) => <img> للأصل
+    # srcset للأحجام المربعة فقط (عرضها معروف)؛ "detail" يحافظ على النسبة => src واحد
+    attrs={k.rstrip("_"):v for k,v in attrs.items()}
+    attrs.setdefault("loading","lazy"); attrs.setdefault("decoding","async")
+    extra="".join(f' {k}="{escape(v)}"' for k,v in attrs.items())
+    def set_attr(fmt):
+        if images.SIZES[size][2]!="cover": return ""
+        return f' srcset="{escape(images.srcset(url_or_path,size,fmt))}" sizes="{sizes or IMG_SIZES_ATTR[size]}"'
+    if images.is_remote(url_or_path) and "/upload/" in url_or_path:
+        return Markup(f'<img src="{escape(images.cloudinary_url(url_or_path,size))}"{set_attr("webp")} alt="{escape(alt)}"{extra}>')
+    jpg=images.variant_url(url_or_path, size, "jpg")
+    if not jpg:
+        return Markup(f'<img src="{escape(static_url(url_or_path))}" alt="{escape(alt)}"{extra}>')
+    webp=set_attr("webp") or f' srcset="{escape(images.variant_url(url_or_path,size,"webp"))}"'
+    return Markup(f'<picture><source type="image/webp"{webp}><img src="{escape(jpg)}"{set_attr("jpg")} alt="{escape(alt)}"{extra}></picture>')
+
 @app.context_processor
 def inject_globals():
-    return dict(app_name=APP_NAME, dl_url=dl_url)
+    return dict(app_name=APP_NAME, dl_url=dl_url, static_url=static_url, picture=picture)
+
+@app.cli.command("images-backfill")
+@click.option("--force", is_flag=True, help="إعادة توليد النسخ الموجودة")
+def images_backfill_command(force):
+    # نسخ مشتقة للصور المرفوعة قبل خط المعالجة (محليًا فقط؛ Cloudinary يحوّل عند الطلب)
+    rows=q_all("""SELECT image_path FROM products WHERE image_path IS NOT NULL
+                  UNION SELECT image_path FROM product_images""")
+    done=skipped=failed=0
+    for r in rows:
+        if images.is_remote(r["image_path"]): skipped+=1; continue
+        try:
+            if images.make_variants(r["image_path"], force=force): done+=1
+            else: skipped+=1
+        except Exception as e:
+            failed+=1; click.echo(f"{r['image_path']}: {e}", err=True)
+    click.echo(f"{done} صورة عولجت، {skipped} متجاوزة، {failed} فشلت")
+
+# ===================== تنظيف الصور اليتيمة (mark & sweep) =====================
+# mark: كل المراجع من القاعدة عبر مؤشر على الخادم (لا تُحمَّل دفعة واحدة) => مجموعة مفاتيح
+# sweep: نمرّ على المخزن (المجلد أو Cloudinary) ونحذف غير المرجَع الأقدم من مهلة السماح، على دفعات.
+# كل دفعة في معاملة: قفل البصمات + blobs FOR UPDATE + إعادة stat ثم الحذف قبل COMMIT
+# => صورة أُعيد استعمالها بعد الـ mark (مرجع مسجّل أو رفع محلي لنفس المحتوى) لا تُحذف
+IMAGE_GC_LOCK = 0x647A73686F71
+IMAGE_BLOB_LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtextextended(s,0)) FROM (SELECT unnest(%s::text[]) s ORDER BY 1) x"
+
+def image_refs()->set:
+    refs=set()
+    with get_db() as conn:
+        with conn.cursor(name="image_gc_refs") as cur:
+            cur.itersize=10000
+            cur.execute("""SELECT image_path FROM products WHERE image_path IS NOT NULL
+                           UNION ALL SELECT image_path FROM product_images""")
+            for (path,) in cur:
+                key=images.image_key(path)
+                if key: refs.add(key)
+    return refs
+
+class ImageGC:
+    def __init__(self, dry_run:bool, grace_hours:float, batch:int, log=None):
+        self.dry_run, self.batch, self.log = dry_run, max(1, batch), log
+        self.cutoff=time.time()-grace_hours*3600
+        self.stats=dict(scanned=0, referenced=0, orphans=0, reused=0, deleted=0, bytes=0)
+        self._pending=[]
+
+    def _flush(self, delete, recent=None):
+        # batch: [(key, id, size)] ؛ delete(ids) يحذف من المخزن ؛ recent(id) يعيد فحص التاريخ لحظة الحذف
+        batch, self._pending = self._pending, []
+        if not batch: return
+        sha=lambda key: key.rsplit("/",1)[-1]
+        with get_db() as conn:
+            # معاملة واحدة للدفعة: قفل حصري لكل بصمة (save_image يأخذه مشتركًا) ثم FOR UPDATE على صفوف blobs،
+            # والحذف من المخزن قبل COMMIT => رفع متزامن لنفس المحتوى ينتظر ثم يعيد كتابة الملف
+            shas=sorted({sha(k) for k,_,_ in batch})
+            conn.execute(IMAGE_BLOB_LOCK_SQL, (shas,))
+            live={r[0] for r in conn.execute("SELECT sha256 FROM blobs WHERE sha256=ANY(%s) AND refcount>0 FOR UPDATE",
+                                             (shas,)).fetchall()}
+            kept=[b for b in batch if sha(b[0]) not in live and not (recent and recent(b[1]))]
+            self.stats["reused"]+=len(batch)-len(kept)
+            self.stats["orphans"]+=len(kept)
+            if self.log:
+                for _,ident,size in kept: self.log(f"{'(dry-run) ' if self.dry_run else ''}{ident} {size}")
+            if self.dry_run or not kept: return
+            skipped={sha(k) for k,_,_ in batch}-{sha(k) for k,_,_ in kept}
+            conn.execute("DELETE FROM blobs WHERE sha256=ANY(%s) AND refcount<=0",
+                         (sorted({sha(k) for k,_,_ in kept}-skipped),))
+            delete([ident for _,ident,_ in kept])
+        self.stats["deleted"]+=len(kept); self.stats["bytes"]+=sum(size for _,_,size in kept)
+
+    def candidate(self, key, ident, size, delete, recent=None):
+        self._pending.append((key, ident, size))
+        if len(self._pending)>=self.batch: self._flush(delete, recent)
+
+    def sweep_local(self, refs):
+        def delete(paths):
+            for p in paths:
+                try: os.remove(p)
+                except FileNotFoundError: pass
+        def recent(path):
+            # تاريخ الفحص قد يكون قديمًا: رفع أثناء التشغيل يجدّده (os.utime) => نعيد stat تحت القفل
+            try: return os.stat(path).st_mtime>=self.cutoff
+            except FileNotFoundError: return True
+        for folder, keyfn in ((UPLOAD_FOLDER, lambda n: os.path.splitext(n)[0]), (images.VARIANT_DIR, images.variant_key)):
+            if not os.path.isdir(folder): continue
+            with os.scandir(folder) as it:
+                for e in it:
+                    if not e.is_file() or e.name==".gitkeep": continue
+                    self.stats["scanned"]+=1
+                    st=e.stat()
+                    tmp=e.name.startswith(".upload-") or e.name.endswith(".tmp")   # بقايا رفع/توليد انقطع
+                    key=keyfn(e.name)
+                    if not tmp and key in refs: self.stats["referenced"]+=1; continue
+                    if st.st_mtime>=self.cutoff: continue
+                    self.candidate(key, e.path, st.st_size, delete, recent)
+        self._flush(delete, recent)
+
+    def sweep_cloudinary(self, refs):
+        import cloudinary.api
+        def delete(ids):
+            for i in range(0, len(ids), 100):           # حد واجهة Cloudinary لكل طلب
+                cloudinary.api.delete_resources(ids[i:i+100], resource_type="image", type="upload")
+        cursor=None
+        while True:
+            res=cloudinary.api.resources(type="upload", resource_type="image", prefix="dzshop/products/",
+                                         max_results=500, **({"next_cursor": cursor} if cursor else {}))
+            for r in res.get("resources", []):
+                self.stats["scanned"]+=1
+                if r["public_id"] in refs: self.stats["referenced"]+=1; continue
+                created=datetime.fromisoformat(r["created_at"].replace("Z","+00:00")).timestamp()
+                if created>=self.cutoff: continue
+                self.candidate(r["public_id"], r["public_id"], r.get("bytes", 0), delete)
+            cursor=res.get("next_cursor")
+            if not cursor: break
+        self._flush(delete)
+
+def run_image_gc(dry_run=False, grace_hours=None, batch=None, log=None)->Optional[dict]:
+    # قفل استشاري: تشغيل واحد في كل الخوادم؛ None إن كان تشغيل آخر جاريًا
+    with psycopg.connect(DATABASE_URL, autocommit=True) as lock:
+        if not lock.execute("SELECT pg_try_advisory_lock(%s)", (IMAGE_GC_LOCK,)).fetchone()[0]: return None
+        gc=ImageGC(dry_run, IMAGE_GC_GRACE_HOURS if grace_hours is None else grace_hours,
+                   batch or IMAGE_GC_BATCH, log)
+        refs=image_refs()
+        if USE_CLOUDINARY: gc.sweep_cloudinary(refs)
+        gc.sweep_local(refs)                            # صور محلية قديمة تبقى حتى مع Cloudinary
+        return gc.stats
+
+_image_gc_pid: Optional[int] = None
+
+def _image_gc_loop():
+    while True:
+        time.sleep(IMAGE_GC_INTERVAL_HOURS*3600)
+        try:
+            st=run_image_gc()
+            if st: app.logger.info("image gc: %s", st)
+        except Exception as e:
+            app.logger.warning("image gc: %s", e)
+
+@app.before_request
+def _ensure_image_gc():
+    global _image_gc_pid
+    if IMAGE_GC_INTERVAL_HOURS<=0 or _image_gc_pid==os.getpid(): return
+    with _pool_lock:
+        if _image_gc_pid==os.getpid(): return
+        threading.Thread(target=_image_gc_loop, name="image-gc", daemon=True).start()
+        _image_gc_pid=os.getpid()
+
+@app.cli.command("images-gc")
+@click.option("--dry-run", is_flag=True, help="تقرير فقط دون حذف")
+@click.option("--grace-hours", type=float, default=None, help="لا يُحذف ملف أحدث من هذا (افتراضيًا IMAGE_GC_GRACE_HOURS)")
+@click.option("--batch", type=int, default=None, help="حجم دفعة الحذف")
+@click.option("-v", "--verbose", is_flag=True, help="طباعة كل ملف محذوف")
+def images_gc_command(dry_run, grace_hours, batch, verbose):
+    t0=time.monotonic()
+    st=run_image_gc(dry_run, grace_hours, batch, log=click.echo if verbose or dry_run else None)
+    if st is None: raise click.ClickException("تنظيف آخر جارٍ (قفل مأخوذ)")
+    click.echo(f"فُحص {st['scanned']}، مرجَع {st['referenced']}، يتيم {st['orphans']}، "
+               f"حُذف {st['deleted']} ({st['bytes']/1048576:.1f} MB) في {time.monotonic()-t0:.1f}s"
+               + (" — dry-run" if dry_run else ""))
+
+# ===================== طابور الصور (IMAGE_UPLOAD_MODE=async) =====================
+# الطلب يحفظ الملفات في image_jobs ويعود فورًا؛ العامل يحجز مهمة مستحقة (locked_until) في معاملة قصيرة،
+# يرفع صورها بالتوازي بلا معاملة مفتوحة، ثم يربطها بالمنتج ويحذف المهمة في معاملة قصيرة ثانية.
+# إن مات العامل تعود المهمة للطابور بانتهاء الحجز؛ الفشل يؤجلها (next_attempt_at) بمهلة تتضاعف
+def image_job_params(main_image, extra_images)->tuple:
+    files=[f for f in [main_image]+list(extra_images) if f and f.filename and allowed_file(f.filename)]
+    has_main=bool(main_image and main_image.filename and allowed_file(main_image.filename))
+    names=[f.filename for f in files]
+    return (has_main, names, [f.read() for f in files], names)
+
+def run_image_job(conn)->bool:
+    # conn: اتصال مخصص بوضع autocommit و dict_row => كل استعلام معاملة مستقلة. يعيد False إن لم تبقَ مهمة مستحقة
+    job=conn.execute("""UPDATE image_jobs SET locked_until=now()+make_interval(secs=>%s)
+                        WHERE id=(SELECT id FROM image_jobs
+                                  WHERE NOT failed AND next_attempt_at<=now() AND (locked_until IS NULL OR locked_until<now())
+                                  ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED)
+                        RETURNING *""", (IMAGE_JOB_LEASE,)).fetchone()
+    if not job: return False
+    # locked_until يعمل كرمز الحجز: إن انتهى وحجزها عامل آخر لا نكتب فوقه (الملفات المرفوعة يجمعها images-gc)
+    lease=dict(id=job["id"], lease=job["locked_until"])
+    try:
+        paths=save_images([FileStorage(io.BytesIO(d), filename=fn) for fn,d in zip(job["filenames"], job["data"])])
+    except Exception as e:
+        conn.execute("""UPDATE image_jobs SET attempts=attempts+1, last_error=%(err)s, failed=attempts+1>=%(max)s,
+                          next_attempt_at=now()+make_interval(secs=>%(backoff)s*2^attempts), locked_until=NULL
+                        WHERE id=%(id)s AND locked_until=%(lease)s""",
+                     dict(lease, err=str(e)[:500], max=IMAGE_JOB_ATTEMPTS, backoff=IMAGE_JOB_BACKOFF))
+        app.logger.warning("image job %s: %s", job["id"], e)
+        return True
+    main,extra=(paths[0], paths[1:]) if job["has_main"] else (None, paths)
+    done=conn.execute("""WITH j AS (
+                           DELETE FROM image_jobs WHERE id=%(id)s AND locked_until=%(lease)s RETURNING product_id),
+                         p AS (
+                           UPDATE products SET image_path=COALESCE(%(main)s,image_path)
+                           WHERE id=(SELECT product_id FROM j) RETURNING id),
+                         i AS (
+                           INSERT INTO product_images(product_id,image_path)
+                           SELECT p.id, x.path FROM p, unnest(%(extra)s::text[]) WITH ORDINALITY AS x(path,n)
+                           WHERE x.path IS NOT NULL ORDER BY x.n)
+                         SELECT count(*) AS n FROM j""",
+                      dict(lease, main=main, extra=extra)).fetchone()["n"]
+    if not done: app.logger.warning("image job %s: انتهى الحجز قبل الربط (IMAGE_JOB_LEASE)", job["id"])
+    return True
+
+_image_wakeup=threading.Event()
+_image_worker_pid: Optional[int] = None
+
+def wake_image_worker(): _image_wakeup.set()
+
+def image_worker_loop(poll:float=5.0, once:bool=False):
+    while True:
+        try:
+            with psycopg.connect(DATABASE_URL, autocommit=True, row_factory=psycopg.rows.dict_row) as conn:
+                while True:
+                    if run_image_job(conn): continue
+                    if once: return
+                    _image_wakeup.wait(poll); _image_wakeup.clear()
+        except Exception as e:
+            app.logger.warning("image worker: %s", e)
+            if once: raise
+            time.sleep(5)
+
+@app.before_request
+def _ensure_image_workers():
+    # خيوط المعالجة داخل كل عامل gunicorn (بعد fork)؛ أو عامل مستقل عبر أمر CLI أدناه
+    global _image_worker_pid, _image_wakeup
+    if IMAGE_UPLOAD_MODE!="async" or IMAGE_WORKER_THREADS<=0 or _image_worker_pid==os.getpid(): return
+    with _pool_lock:
+        if _image_worker_pid==os.getpid(): return
+        _image_wakeup=threading.Event()
+        for i in range(IMAGE_WORKER_THREADS):
+            threading.Thread(target=image_worker_loop, name=f"image-worker-{i}", daemon=True).start()
+        _image_worker_pid=os.getpid()
+
+@app.cli.command("image-worker")
+@click.option("--once", is_flag=True, help="معالجة الطابور حتى يفرغ ثم الخروج")
+def image_worker_command(once):
+    image_worker_loop(once=once)
+    failed=q_one("SELECT COUNT(*) AS n FROM image_jobs WHERE failed")["n"]
+    if failed: click.echo(f"{failed} مهمة فشلت نهائيًا (image_jobs.failed)", err=True)
 
 # ===================== تهيئة القاعدة =====================
 def init_db():
+    # المخطط والفهارس عبر ترحيلات مرقّمة (migrate_db.py) تحت قفل استشاري
+    migrate(DATABASE_URL)
     with get_db() as conn:
         with conn.cursor() as cur:
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS users(
-              id SERIAL PRIMARY KEY,
-              name TEXT NOT NULL,
-              email TEXT UNIQUE NOT NULL,
-              password_hash TEXT NOT NULL,
-              role TEXT NOT NULL CHECK(role IN ('affiliate','admin')),
-              approved BOOLEAN NOT NULL DEFAULT FALSE,
-              phone TEXT,
-              created_at TEXT NOT NULL
-            );""")
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS categories(
-              id SERIAL PRIMARY KEY,
-              name TEXT UNIQUE NOT NULL
-            );""")
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS products(
-              id SERIAL PRIMARY KEY,
-              name TEXT NOT NULL,
-              description TEXT,
-              price NUMERIC NOT NULL,
-              commission NUMERIC NOT NULL,
-              delivery_price NUMERIC NOT NULL,
-              image_path TEXT,
-              category_id INTEGER REFERENCES categories(id),
-              delivery_mode TEXT CHECK (delivery_mode IN ('home','office')) DEFAULT 'home',
-              notes TEXT,
-              created_at TEXT NOT NULL
-            );""")
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS product_images(
-              id SERIAL PRIMARY KEY,
-              product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
-              image_path TEXT NOT NULL,
-              created_at TEXT NOT NULL
-            );""")
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS orders(
-              id SERIAL PRIMARY KEY,
-              product_id INTEGER NOT NULL REFERENCES products(id),
-              affiliate_id INTEGER NOT NULL REFERENCES users(id),
-              customer_name TEXT NOT NULL,
-              customer_phone TEXT NOT NULL,
-              customer_address TEXT NOT NULL,
-              status TEXT NOT NULL CHECK(status IN ('pending','delivered','canceled')),
-              created_at TEXT NOT NULL
-            );""")
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS withdrawals(
-              id SERIAL PRIMARY KEY,
-              affiliate_id INTEGER NOT NULL REFERENCES users(id),
-              amount NUMERIC NOT NULL,
-              method TEXT NOT NULL,
-              details TEXT NOT NULL,
-              status TEXT NOT NULL CHECK(status IN ('requested','approved','rejected')),
-              bonus NUMERIC NOT NULL DEFAULT 0,
-              created_at TEXT NOT NULL
-            );""")
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS pages(
-              id SERIAL PRIMARY KEY,
-              slug TEXT UNIQUE NOT NULL,
-              title TEXT NOT NULL,
-              content TEXT NOT NULL
-            );""")
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS bonuses(
-              id SERIAL PRIMARY KEY,
-              affiliate_id INTEGER NOT NULL REFERENCES users(id),
-              iso_year INTEGER NOT NULL,
-              iso_week INTEGER NOT NULL,
-              amount NUMERIC NOT NULL,
-              created_at TEXT NOT NULL,
-              UNIQUE(affiliate_id, iso_year, iso_week)
-            );""")
-
             # صفحات افتراضية
             for slug,title in [("privacy","سياسة الخصوصية"),("about","من نحن"),("contact","تواصل معنا")]:
                 cur.execute("SELECT 1 FROM pages WHERE slug=%s",(slug,))
@@ -202,12 +1163,13 @@ def init_db():
             # أدمن افتراضي
             cur.execute("SELECT id FROM users WHERE role='admin' LIMIT 1")
             if not cur.fetchone():
-                cur.execute("""INSERT INTO users(name,email,password_hash,role,approved,created_at)
-                               VALUES(%s,%s,%s,%s,%s,%s)""",
-                            ("Admin","admin@local",generate_password_hash(ADMIN_PASSWORD),"admin",True,now_iso()))
+                cur.execute("""INSERT INTO users(name,email,password_hash,role,approved)
+                               VALUES(%s,%s,%s,%s,%s)""",
+                            ("Admin","admin@local",generate_password_hash(ADMIN_PASSWORD, PASSWORD_HASH_METHOD),"admin",True))
         conn.commit()
 
-init_db()
+# عمليات التجزئة (spawn) تستورد سكربت التشغيل باسم __mp_main__ (py app_pg.py): لا ترحيل ولا اتصالات فيها
+if __name__!="__mp_main__": init_db()
 
 # ===================== الحماية =====================
 def login_required(role: Optional[str]=None):
@@ -226,32 +1188,156 @@ def current_user():
     if "user_id" not in session: return None
     return q_one("SELECT * FROM users WHERE id=%s",(session["user_id"],))
 
+# ===================== الطلبات المشروطة (ETag / Last-Modified) =====================
+# صفحات الكتالوج تتغير فقط عند تعديل الكتالوج => الإصدار (catalog_version، يزيده trigger) يكفي كبصمة
+# يُقرأ من كاش الكتالوج (يُبطَل بنفس NOTIFY) => 304 بلا استعلام ولا قالب في الغالب
+# البصمة تشمل: الإصدار + نسخة القوالب/الملفات الثابتة (نشر جديد) + المستخدم (القائمة تختلف) + الرابط كاملًا
+def _render_version()->str:
+    h=hashlib.sha256()
+    for rel in sorted(STATIC_ASSETS): h.update(STATIC_ASSETS[rel]["etag"].encode())
+    for dirpath, _, filenames in sorted(os.walk(os.path.join(app.root_path, "templates"))):
+        for fn in sorted(filenames):
+            with open(os.path.join(dirpath, fn), "rb") as f: h.update(f.read())
+    return h.hexdigest()[:12]
+
+RENDER_VERSION=_render_version()
+CATALOG_VERSION_Q=("SELECT version, changed_at FROM catalog_version", (), "one")
+
+def conditional(per_user:bool=True):
+    # تحت login_required (التحقق من الجلسة أولًا). per_user=False: لا يعتمد على الجلسة => Last-Modified أيضًا
+    def deco(f):
+        @wraps(f)
+        def wrap(*a, **kw):
+            if request.method not in ("GET","HEAD") or (per_user and session.get("_flashes")):
+                return f(*a, **kw)                       # رسالة flash معلقة => الصفحة تختلف
+            v=cached_batch(CATALOG_VERSION_Q)[0]
+            who=f"{session.get('role')}:{session.get('user_id')}" if per_user else "*"
+            etag=hashlib.sha1(f"{v['version']}|{RENDER_VERSION}|{who}|{request.full_path}".encode()).hexdigest()[:20]
+            changed=v["changed_at"].replace(microsecond=0)
+            if request.if_none_match:
+                fresh=request.if_none_match.contains_weak(etag)
+            else:
+                fresh=not per_user and request.if_modified_since is not None and request.if_modified_since>=changed
+            resp=app.response_class(status=304) if fresh else make_response(f(*a, **kw))
+            if resp.status_code in (200,304):
+                resp.set_etag(etag, weak=True)           # ضعيفة: نفس البصمة للنسخة المضغوطة وغير المضغوطة
+                if per_user:
+                    resp.headers["Cache-Control"]="private, no-cache"; resp.vary.add("Cookie")
+                else:
+                    resp.headers["Cache-Control"]="public, no-cache"; resp.last_modified=changed
+            return resp
+        return wrap
+    return deco
+
 # ===================== العلاوة الأسبوعية =====================
 def iso_year_week(dt:Optional[datetime]=None)->Tuple[int,int]:
     if not dt: dt=datetime.now(timezone.utc)
     iso=dt.isocalendar(); return iso.year, iso.week
 
-def weekly_bonus_pending(affiliate_id:int)->float:
-    since=(datetime.now(timezone.utc)-timedelta(days=7)).isoformat()
-    row=q_one("""SELECT COUNT(*) AS n FROM orders
-                 WHERE affiliate_id=%s AND status='delivered' AND created_at>=%s""",(affiliate_id,since))
-    n=int(row["n"]) if row and row.get("n") is not None else 0
-    candidate=(n//10)*WEEKLY_BONUS
-    y,w=iso_year_week()
-    exists=q_one("SELECT 1 FROM bonuses WHERE affiliate_id=%s AND iso_year=%s AND iso_week=%s",
-                 (affiliate_id,y,w))
-    return 0.0 if exists else float(candidate)
-
-def mark_bonus_paid(conn, affiliate_id:int, amount:float)->float:
-    if amount<=0: return 0.0
-    y,w=iso_year_week()
+def iso_week_bounds(y:int, w:int)->Tuple[datetime,datetime]:
+    start=datetime.fromisocalendar(y,w,1).replace(tzinfo=timezone.utc)
+    return start, start+timedelta(days=7)
+
+def last_iso_week()->Tuple[int,int]:
+    return iso_year_week(datetime.now(timezone.utc)-timedelta(days=7))
+
+def compute_weekly_bonuses(y:int, w:int, chunk:int=5000)->Tuple[int,float]:
+    # دفعات حسب affiliate_id، كل دفعة commit مستقل => إن انقطعت المهمة يُكمل التشغيل التالي الباقي
+    start,end=iso_week_bounds(y,w)
+    top=q_one("SELECT COALESCE(MAX(id),0) AS m FROM users")["m"]
+    n,total=0,0.0
+    for lo in range(0, top+1, chunk):
+        row=q_one(WEEKLY_BONUS_SQL, dict(amount=WEEKLY_BONUS, start=start, end=end, lo=lo, hi=lo+chunk, y=y, w=w))
+        n+=row["n"]; total+=float(row["total"])
+    return n,total
+
+@app.cli.command("weekly-bonus")
+@click.option("--week", help="YYYY-Www (الافتراضي: الأسبوع الماضي)")
+@click.option("--chunk", default=5000, show_default=True, help="عدد المسوّقين (نطاق id) في كل معاملة")
+def weekly_bonus_command(week, chunk):
+    if week:
+        try: y,w=datetime.strptime(week+"-1","%G-W%V-%u").isocalendar()[:2]
+        except ValueError: raise click.BadParameter("الصيغة YYYY-Www", param_hint="--week")
+    else:
+        y,w=last_iso_week()
+    # أسبوع لم يكتمل بعد سيُجمَّد بعدد ناقص
+    if (y,w)>=iso_year_week(): raise click.ClickException(f"الأسبوع {y}-W{w:02d} لم ينته بعد")
+    n,total=compute_weekly_bonuses(y,w,chunk)
+    click.echo(f"{y}-W{w:02d}: {n} علاوة جديدة، المجموع {total:.0f} دج")
+
+# علاوة الأسبوع الماضي المحسوبة مسبقًا (قراءة بالفهرس الفريد)
+def last_bonus_query(affiliate_id:int):
+    return queries.last_bonus_query(affiliate_id, *last_iso_week())
+
+# ===================== كلمات السر وحد المحاولات =====================
+# scrypt ثقيلة عمدًا: تُحسب في عملية منفصلة (spawn: لا ترث خيوط التطبيق ولا اتصالاته) بطابور محدود؛
+# امتلاؤه => 503 فورًا بدل أن تتجمد كل العوامل خلف موجة محاولات دخول
+class HashBusy(Exception): pass
+
+_hash_pool: Optional[ProcessPoolExecutor] = None
+_hash_slots: Optional[threading.BoundedSemaphore] = None
+_hash_pid: Optional[int] = None
+
+def hash_pool()->Tuple[ProcessPoolExecutor, threading.BoundedSemaphore]:
+    global _hash_pool, _hash_slots, _hash_pid
+    if _hash_pid!=os.getpid():
+        with _pool_lock:
+            if _hash_pid!=os.getpid():
+                _hash_pool=ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+                _hash_slots=threading.BoundedSemaphore(HASH_WORKERS+HASH_QUEUE_MAX)
+                _hash_pid=os.getpid()
+    return _hash_pool, _hash_slots
+
+def _hash_call(fn, *args):
+    # خارج الطلبات (CLI/التهيئة) أو HASH_WORKERS=0: مباشرة
+    if not has_request_context() or HASH_WORKERS<=0: return fn(*args)
+    db_release()                                   # لا نحجز اتصالًا أثناء الانتظار
+    pool,slots=hash_pool()
+    if not slots.acquire(blocking=False): raise HashBusy()
     try:
-        with conn.cursor() as cur:
-            cur.execute("""INSERT INTO bonuses(affiliate_id,iso_year,iso_week,amount,created_at)
-                           VALUES(%s,%s,%s,%s,%s)""",(affiliate_id,y,w,amount,now_iso()))
-        return float(amount)
-    except Exception:
-        return 0.0
+        fut=pool.submit(fn, *args)
+    except BrokenProcessPool:
+        global _hash_pid
+        _hash_pid=None; slots.release(); raise HashBusy()
+    fut.add_done_callback(lambda _: slots.release())   # الخانة تبقى محجوزة حتى تنتهي العملية فعلًا
+    try: return fut.result(timeout=HASH_TIMEOUT)
+    except FutureTimeout: raise HashBusy()
+
+def hash_password(pwd:str)->str:
+    return _hash_call(generate_password_hash, pwd, PASSWORD_HASH_METHOD)
+
+@lru_cache(maxsize=1)
+def _dummy_hash()->str: return generate_password_hash(os.urandom(16).hex(), PASSWORD_HASH_METHOD)
+
+def verify_password(pw_hash:Optional[str], pwd:str)->bool:
+    # حساب غير موجود: نفس الكلفة (لا يُكشف وجود الإيميل من زمن الرد)
+    ok=_hash_call(check_password_hash, pw_hash or _dummy_hash(), pwd)
+    return ok and bool(pw_hash)
+
+@lru_cache(maxsize=1)
+def _hash_prefix()->str: return _dummy_hash().split("$",1)[0]   # "scrypt:32768:8:1"
+
+def needs_rehash(pw_hash:str)->bool: return pw_hash.split("$",1)[0]!=_hash_prefix()
+
+def rate_hits(key:str, hit:bool=True)->Tuple[float,int]:
+    # (عدد المحاولات في النافذة، ثواني حتى النافذة التالية)؛ hit=False: قراءة فقط
+    # اتصال الطلب نفسه (لا اتصال ثانٍ من المسبح). قبل أي BEGIN (أول ما يُنفَّذ في login/register) هو autocommit
+    # => المحاولة تُثبَّت فورًا حتى لو أُلغيت معاملة الطلب بعدها (إيميل مكرر عند التسجيل...)؛ وإلا تُثبَّت معها
+    conn=db_conn()
+    cur,prev,frac=conn.execute(RATE_SQL, dict(k=key, w=AUTH_RATE_WINDOW, hit=hit)).fetchone()
+    if random.random()<0.01:
+        conn.execute(RATE_PRUNE_SQL, (2*AUTH_RATE_WINDOW,))
+    return prev*(1-frac)+cur, int(AUTH_RATE_WINDOW*(1-frac))+1
+
+def auth_throttle(account:Optional[str]=None):
+    # كل محاولة تُحسب على IP؛ الحساب يُحسب بالفشل فقط (auth_failed) => صاحبه لا يُقفل بدخوله الناجح
+    n,retry=rate_hits(f"ip:{request.remote_addr}")
+    if n>AUTH_RATE_IP: raise TooManyRequests(retry_after=retry)
+    if account:
+        n,retry=rate_hits(account, hit=False)
+        if n>=AUTH_RATE_ACCOUNT: raise TooManyRequests(retry_after=retry)
+
+def auth_failed(account:str): rate_hits(account)
 
 # ===================== مصادقة =====================
 @app.route("/register", methods=["GET","POST"])
@@ -263,15 +1349,16 @@ def register():
         password=request.form.get("password","")
         if not name or not email or not phone or not password:
             flash("املأ كل الحقول","danger"); return redirect(url_for("register"))
+        auth_throttle()
+        # الإيميل المكرر يُرفض قبل حساب الهاش (scrypt ثقيلة)؛ المحاولة محسوبة في auth_throttle
+        if q_one(USER_BY_EMAIL_SQL,(email,)):
+            flash("الإيميل مستخدم أو خطأ في التسجيل","danger"); return redirect(url_for("register"))
         try:
-            exec_sql("""INSERT INTO users(name,email,password_hash,role,approved,phone,created_at)
-                        VALUES(%s,%s,%s,%s,%s,%s,%s)""",
-                     (name,email,generate_password_hash(password),"affiliate",False,phone,now_iso()))
-            flash("تم التسجيل. بانتظار موافقة الإدارة.","success")
-            return redirect(url_for("login"))
-        except Exception:
-            flash("الإيميل مستخدم أو خطأ في التسجيل","danger")
-            return redirect(url_for("register"))
+            exec_sql(REGISTER_SQL, (name,email,hash_password(password),"affiliate",False,phone))
+        except psycopg.errors.UniqueViolation:     # تسجيل متزامن بنفس الإيميل
+            flash("الإيميل مستخدم أو خطأ في التسجيل","danger"); return redirect(url_for("register"))
+        flash("تم التسجيل. بانتظار موافقة الإدارة.","success")
+        return redirect(url_for("login"))
     return render_template("register.html")
 
 @app.route("/login", methods=["GET","POST"])
@@ -279,9 +1366,15 @@ def login():
     if request.method=="POST":
         email=request.form.get("email","").strip().lower()
         pwd=request.form.get("password","")
-        u=q_one("SELECT * FROM users WHERE email=%s",(email,))
-        if not u or not check_password_hash(u["password_hash"], pwd):
+        auth_throttle(f"acct:{email}")
+        u=q_one(USER_BY_EMAIL_SQL,(email,))
+        if not verify_password(u and u["password_hash"], pwd):
+            auth_failed(f"acct:{email}")
             flash("بيانات الدخول غير صحيحة","danger"); return redirect(url_for("login"))
+        if needs_rehash(u["password_hash"]):
+            # ترقية الهاش القديم لكلفة PASSWORD_HASH_METHOD (لا نعرف كلمة السر إلا الآن)
+            exec_sql("UPDATE users SET password_hash=%s WHERE id=%s AND password_hash=%s",
+                     (hash_password(pwd), u["id"], u["password_hash"]))
         if u["role"]=="affiliate" and not u["approved"]:
             flash("حسابك بانتظار الموافقة","warning"); return redirect(url_for("login"))
         session["user_id"]=u["id"]; session["role"]=u["role"]
@@ -295,11 +1388,14 @@ def logout():
 
 # ===================== صفحات عامة =====================
 @app.route("/privacy")
-def privacy():  return render_template("page.html", page=q_one("SELECT * FROM pages WHERE slug='privacy'"))
+@conditional()
+def privacy():  return render_template("page.html", page=cached_one("SELECT * FROM pages WHERE slug='privacy'"))
 @app.route("/about")
-def about():    return render_template("page.html", page=q_one("SELECT * FROM pages WHERE slug='about'"))
+@conditional()
+def about():    return render_template("page.html", page=cached_one("SELECT * FROM pages WHERE slug='about'"))
 @app.route("/contact")
-def contact():  return render_template("page.html", page=q_one("SELECT * FROM pages WHERE slug='contact'"))
+@conditional()
+def contact():  return render_template("page.html", page=cached_one("SELECT * FROM pages WHERE slug='contact'"))
 
 # ===================== توجيه أولي =====================
 @app.route("/")
@@ -309,95 +1405,115 @@ def home():
     return redirect(url_for("login"))
 
 # ===================== واجهة المسوّق =====================
+# ---- البحث: النص في queries.py؛ التطبيع العربي في قاعدة البيانات (ar_normalize, migrate_db.py)
+# => نفس القواعد للفهرس وللسؤال. الترتيب بالدرجة ثم id؛ الدرجة مقرّبة لتكون مفتاح keyset ثابتًا: ?after=<score>:<id>
+SEARCH_MAX_LEN=100
+_search_fuzzy=None   # pg_trgm مثبّت؟ (اختياري: بدونه نص كامل فقط)
+
+def search_fuzzy()->bool:
+    global _search_fuzzy
+    if _search_fuzzy is None:
+        _search_fuzzy=bool(q_one("SELECT 1 FROM pg_extension WHERE extname='pg_trgm'"))
+    return _search_fuzzy
+
+def search_text(raw:Optional[str])->str:
+    # "  حذاء   رياضي " => "حذاء رياضي": نفس المفتاح في الكاش لنفس البحث
+    return " ".join((raw or "").split())[:SEARCH_MAX_LEN].lower()
+
+def search_after()->Tuple[Optional[Decimal], int]:
+    score,_,pid=(request.args.get("after") or "").partition(":")
+    try: return Decimal(score), int(pid)
+    except (ArithmeticError, ValueError): return None, KEYSET_TOP
+
+def products_search_query(q:str, cat_id:Optional[int], after:Tuple[Optional[Decimal], int], n:int):
+    return queries.products_search_query(q, cat_id, after, n, search_fuzzy())
+
+def products_suggest_query(q:str):
+    return queries.products_suggest_query(q, search_fuzzy())
+
 @app.route("/affiliate/products")
 @login_required(role="affiliate")
+@conditional()
 def affiliate_products():
     cat_id=request.args.get("cat", type=int)
-    if cat_id:
-        products=q_all("""SELECT p.*, c.name AS category_name
-                          FROM products p LEFT JOIN categories c ON c.id=p.category_id
-                          WHERE p.category_id=%s ORDER BY p.id DESC""",(cat_id,))
+    q=search_text(request.args.get("q"))
+    if q:
+        n=page_args()[1]
+        products,cats=cached_batch(products_search_query(q, cat_id, search_after(), n), CATEGORIES_Q)
+        products,next_url=keyset_page(products, n, "after", key=lambda r: f"{r['score']}:{r['id']}")
     else:
-        products=q_all("""SELECT p.*, c.name AS category_name
-                          FROM products p LEFT JOIN categories c ON c.id=p.category_id
-                          ORDER BY p.id DESC""")
-    cats=q_all("SELECT * FROM categories ORDER BY name ASC")
-    return render_template("affiliate/products.html", products=products, categories=cats)
+        before,n=page_args()
+        products,cats=cached_batch(products_page_query(cat_id, before, n), CATEGORIES_Q)
+        products,next_url=keyset_page(products, n)
+    return render_template("affiliate/products.html", products=products, categories=cats, next_url=next_url,
+                           active_cat=cat_id, q=q)
 
 @app.route("/affiliate/categories")
 @login_required(role="affiliate")
 def affiliate_categories():
-    return render_template("affiliate/categories.html", categories=q_all("SELECT * FROM categories ORDER BY name ASC"))
+    return render_template("affiliate/categories.html", categories=cached_batch(CATEGORIES_Q)[0])
 
 @app.route("/affiliate/product/<int:pid>")
 @login_required(role="affiliate")
+@conditional()
 def affiliate_product_detail(pid):
-    p=q_one("""SELECT p.*, c.name AS category_name
-               FROM products p LEFT JOIN categories c ON c.id=p.category_id WHERE p.id=%s""",(pid,))
+    p,imgs=cached_batch(product_detail_query(pid), product_images_query(pid))
     if not p: abort(404)
-    imgs=q_all("SELECT image_path FROM product_images WHERE product_id=%s ORDER BY id ASC",(pid,))
     return render_template("affiliate/product_detail.html", p=p, images=imgs)
 
 @app.route("/affiliate/order/<int:pid>", methods=["GET","POST"])
 @login_required(role="affiliate")
 def affiliate_order(pid):
-    p=q_one("SELECT * FROM products WHERE id=%s",(pid,))
-    if not p: abort(404)
     if request.method=="POST":
         cn=request.form.get("customer_name","").strip()
         cp=request.form.get("customer_phone","").strip()
         ca=request.form.get("customer_address","").strip()
         if not cn or not cp or not ca:
             flash("املأ بيانات الزبون","danger"); return redirect(url_for("affiliate_order", pid=pid))
-        exec_sql("""INSERT INTO orders(product_id,affiliate_id,customer_name,customer_phone,customer_address,status,created_at)
-                    VALUES(%s,%s,%s,%s,%s,%s,%s)""",
-                 (pid, session["user_id"], cn, cp, ca, "pending", now_iso()))
+        # التحقق من وجود المنتج والإدراج في استعلام واحد؛ العمولة والسعر لقطة وقت الطلب
+        row=q_one("""INSERT INTO orders(product_id,affiliate_id,customer_name,customer_phone,customer_address,status,commission,price)
+                     SELECT id,%s,%s,%s,%s,%s,commission,price FROM products WHERE id=%s RETURNING id""",
+                  (session["user_id"], cn, cp, ca, "pending", pid))
+        if not row: abort(404)
         flash("تم إنشاء الطلبية","success"); return redirect(url_for("affiliate_orders"))
+    p=cached_batch(product_detail_query(pid))[0]
+    if not p: abort(404)
     return render_template("affiliate/order_form.html", p=p)
 
 @app.route("/affiliate/orders")
 @login_required(role="affiliate")
 def affiliate_orders():
-    rows=q_all("""SELECT o.*, p.name AS product_name, p.image_path, p.commission, p.price
-                  FROM orders o JOIN products p ON p.id=o.product_id
-                  WHERE o.affiliate_id=%s ORDER BY o.id DESC""",(session["user_id"],))
-    return render_template("affiliate/orders.html", rows=rows)
+    status=request.args.get("status")
+    before,n=page_args()
+    if status not in ("pending","delivered","canceled"): status=None
+    rows=q_batch(affiliate_orders_query(session["user_id"], status, before, n))[0]
+    rows,next_url=keyset_page(rows, n)
+    return render_template("affiliate/orders.html", rows=rows, next_url=next_url)
 
 def affiliate_balance(aid:int)->float:
-    e=q_one("""SELECT COALESCE(SUM(p.commission),0) AS total
-               FROM orders o JOIN products p ON p.id=o.product_id
-               WHERE o.affiliate_id=%s AND o.status='delivered'""",(aid,))
-    earned=float(e["total"]) if e else 0.0
-    out=q_one("""SELECT COALESCE(SUM(amount+bonus),0) AS total
-                 FROM withdrawals WHERE affiliate_id=%s AND status IN ('requested','approved')""",(aid,))
-    spent=float(out["total"]) if out else 0.0
-    return earned-spent
+    row=q_one(BALANCE_SQL,dict(aid=aid))
+    return float(row["balance"]) if row else 0.0
 
 @app.route("/affiliate/commissions", methods=["GET","POST"])
 @login_required(role="affiliate")
 def affiliate_commissions():
-    bal=affiliate_balance(session["user_id"])
-    bonus_p=weekly_bonus_pending(session["user_id"])
+    b,lb=q_batch((BALANCE_SQL,dict(aid=session["user_id"]),"one"), last_bonus_query(session["user_id"]))
+    bal=float(b["balance"]); last_bonus=float(lb["amount"]) if lb else 0.0
     if request.method=="POST":
         method=request.form.get("method")
         details=request.form.get("details","").strip()
         try: amount=float(request.form.get("amount","0") or 0)
         except: amount=0
-        total=bal+bonus_p
         if method not in ("ccp","rib"): flash("اختر CCP أو RIB","danger"); return redirect(url_for("affiliate_commissions"))
-        if amount<=0 or amount>total:   flash("قيمة السحب غير صالحة","danger"); return redirect(url_for("affiliate_commissions"))
-        if amount<WITHDRAW_MIN and total>=WITHDRAW_MIN:
+        if amount<=0 or amount>bal:     flash("قيمة السحب غير صالحة","danger"); return redirect(url_for("affiliate_commissions"))
+        if amount<WITHDRAW_MIN and bal>=WITHDRAW_MIN:
             flash(f"الحد الأدنى للسحب {int(WITHDRAW_MIN)} دج","danger"); return redirect(url_for("affiliate_commissions"))
-        with get_db() as conn:
-            awarded=mark_bonus_paid(conn, session["user_id"], bonus_p)
-            with conn.cursor() as cur:
-                cur.execute("""INSERT INTO withdrawals(affiliate_id,amount,method,details,status,bonus,created_at)
-                               VALUES(%s,%s,%s,%s,%s,%s,%s)""",
-                            (session["user_id"],amount,method,details,'requested',awarded,now_iso()))
-            conn.commit()
-        flash(f"تم إرسال طلب السحب. العلاوة المضافة: {int(awarded)} دج","success")
+        # طلب السحب وقيد الدفتر في استعلام واحد
+        row=q_one(WITHDRAW_SQL, dict(aid=session["user_id"], amount=amount, method=method, details=details))
+        if not row: flash("قيمة السحب غير صالحة","danger"); return redirect(url_for("affiliate_commissions"))
+        flash("تم إرسال طلب السحب","success")
         return redirect(url_for("affiliate_commissions"))
-    return render_template("affiliate/commissions.html", balance=bal, min_withdraw=WITHDRAW_MIN, bonus_pending=bonus_p)
+    return render_template("affiliate/commissions.html", balance=bal, min_withdraw=WITHDRAW_MIN, last_bonus=last_bonus)
 
 @app.route("/affiliate/settings", methods=["GET","POST"])
 @login_required(role="affiliate")
@@ -408,10 +1524,13 @@ def affiliate_settings():
         new2=request.form.get("confirm_password","")
         if not new1 or len(new1)<6 or new1!=new2:
             flash("تحقق من كلمة السر الجديدة (≥6 ومطابقة)","danger"); return redirect(url_for("affiliate_settings"))
+        account=f"user:{session['user_id']}"
+        auth_throttle(account)
         u=q_one("SELECT * FROM users WHERE id=%s",(session["user_id"],))
-        if not u or not check_password_hash(u["password_hash"], curp):
+        if not verify_password(u and u["password_hash"], curp):
+            auth_failed(account)
             flash("كلمة السر الحالية غير صحيحة","danger"); return redirect(url_for("affiliate_settings"))
-        exec_sql("UPDATE users SET password_hash=%s WHERE id=%s",(generate_password_hash(new1), session["user_id"]))
+        exec_sql("UPDATE users SET password_hash=%s WHERE id=%s",(hash_password(new1), session["user_id"]))
         flash("تم تغيير كلمة السر","success"); return redirect(url_for("affiliate_settings"))
     return render_template("affiliate/settings.html")
 
@@ -421,27 +1540,19 @@ def admin_required(f): return login_required(role="admin")(f)
 @app.route("/admin")
 @admin_required
 def admin_dashboard():
-    stats={
-        "orders_total": q_one("SELECT COUNT(*) AS n FROM orders")["n"],
-        "delivered":    q_one("SELECT COUNT(*) AS n FROM orders WHERE status='delivered'")["n"],
-        "pending":      q_one("SELECT COUNT(*) AS n FROM orders WHERE status='pending'")["n"],
-        "canceled":     q_one("SELECT COUNT(*) AS n FROM orders WHERE status='canceled'")["n"],
-    }
-    latest=q_all("""SELECT o.*, p.name AS product_name, p.image_path, p.price, p.commission, u.name AS affiliate_name
-                    FROM orders o JOIN products p ON p.id=o.product_id
-                    JOIN users u ON u.id=o.affiliate_id
-                    ORDER BY o.id DESC LIMIT 20""")
-    withdraws=q_all("""SELECT w.*, u.name AS affiliate_name, u.email
-                       FROM withdrawals w JOIN users u ON u.id=w.affiliate_id
-                       WHERE w.status='requested' ORDER BY w.id DESC""")
+    stats,latest,withdraws=q_batch(DASHBOARD_STATS_Q, DASHBOARD_LATEST_Q, DASHBOARD_WITHDRAWALS_Q)
     return render_template("admin/dashboard.html", stats=stats, latest_orders=latest, pending_withdraws=withdraws)
 
 @app.route("/admin/affiliates")
 @admin_required
 def admin_affiliates():
-    pending=q_all("SELECT * FROM users WHERE role='affiliate' AND approved=false ORDER BY id DESC")
-    approved=q_all("SELECT * FROM users WHERE role='affiliate' AND approved=true ORDER BY id DESC")
-    return render_template("admin/affiliates.html", pending=pending, approved=approved)
+    # قائمتان بمؤشرين مستقلين
+    bp,n=page_args("before_pending"); ba,_=page_args("before_approved")
+    pending,approved=q_batch(affiliates_page_query(False, bp, n), affiliates_page_query(True, ba, n))
+    pending,next_pending=keyset_page(pending, n, "before_pending")
+    approved,next_approved=keyset_page(approved, n, "before_approved")
+    return render_template("admin/affiliates.html", pending=pending, approved=approved,
+                           next_pending=next_pending, next_approved=next_approved)
 
 @app.route("/admin/affiliates/<int:uid>/set", methods=["POST"])
 @admin_required
@@ -456,17 +1567,17 @@ def admin_affiliate_set(uid):
 def admin_affiliate_reset_password(uid):
     new_pass=request.form.get("new_password","").strip()
     if len(new_pass)<6: flash("كلمة السر قصيرة","danger"); return redirect(url_for("admin_affiliates"))
-    exec_sql("UPDATE users SET password_hash=%s WHERE id=%s",(generate_password_hash(new_pass), uid))
+    exec_sql("UPDATE users SET password_hash=%s WHERE id=%s",(hash_password(new_pass), uid))
     flash("تم إعادة تعيين كلمة السر للمسوّق","success"); return redirect(url_for("admin_affiliates"))
 
 @app.route("/admin/products")
 @admin_required
 def admin_products():
-    products=q_all("""SELECT p.*, c.name AS category_name
-                      FROM products p LEFT JOIN categories c ON c.id=p.category_id
-                      ORDER BY p.id DESC""")
-    cats=q_all("SELECT * FROM categories ORDER BY name ASC")
-    return render_template("admin/products.html", products=products, categories=cats)
+    cat_id=request.args.get("cat", type=int)
+    before,n=page_args()
+    products,cats=cached_batch(products_page_query(cat_id, before, n), CATEGORIES_Q)
+    products,next_url=keyset_page(products, n)
+    return render_template("admin/products.html", products=products, categories=cats, next_url=next_url)
 
 @app.route("/admin/categories/add", methods=["POST"])
 @admin_required
@@ -474,50 +1585,69 @@ def admin_category_add():
     name=request.form.get("name","").strip()
     if not name: flash("أدخل اسم التصنيف","danger"); return redirect(url_for("admin_products"))
     try:
-        exec_sql("INSERT INTO categories(name) VALUES(%s)", (name,))
+        exec_sql("INSERT INTO categories(name) VALUES(%s)", (name,)); catalog_changed()
         flash("تمت إضافة التصنيف","success")
     except Exception:
         flash("التصنيف موجود مسبقًا","warning")
     return redirect(url_for("admin_products"))
 
+PRODUCT_FIELDS=("name","description","price","commission","delivery_price","delivery_mode","notes")
+
+def product_fields(src)->Tuple[Optional[dict], Optional[str]]:
+    # قواعد المنتج (نموذج الإضافة والاستيراد الجماعي): (الحقول، None) أو (None، رسالة الخطأ)
+    def text(k): return str(src.get(k) or "").strip()
+    try:
+        price=float(src.get("price") or 0)
+        commission=float(src.get("commission") or 0)
+        delivery_price=float(src.get("delivery_price") or 0)
+    except (TypeError, ValueError):
+        return None, "تحقق من الأرقام"
+    f=dict(name=text("name"), description=text("description"), price=price, commission=commission,
+           delivery_price=delivery_price, delivery_mode=text("delivery_mode") or "home", notes=text("notes"))
+    if not f["name"] or price<=0 or commission<0 or delivery_price<0 or f["delivery_mode"] not in ("home","office"):
+        return None, "تحقق من الحقول"
+    return f, None
+
 @app.route("/admin/products/new", methods=["GET","POST"])
 @admin_required
 def admin_product_new():
     if request.method=="POST":
-        name=request.form.get("name","").strip()
-        description=request.form.get("description","").strip()
-        try:
-            price=float(request.form.get("price","0") or 0)
-            commission=float(request.form.get("commission","0") or 0)
-            delivery_price=float(request.form.get("delivery_price","0") or 0)
-        except: flash("تحقق من الأرقام","danger"); return redirect(url_for("admin_product_new"))
+        f,err=product_fields(request.form)
+        if err: flash(err,"danger"); return redirect(url_for("admin_product_new"))
+        name,description,price,commission,delivery_price,delivery_mode,notes=(f[k] for k in PRODUCT_FIELDS)
         category_id=request.form.get("category_id", type=int)
-        delivery_mode=request.form.get("delivery_mode","home")
-        notes=request.form.get("notes","").strip()
         main_image=request.files.get("image")
         extra_images=request.files.getlist("images[]")
-        if not name or price<=0 or commission<0 or delivery_price<0 or delivery_mode not in ("home","office"):
-            flash("تحقق من الحقول","danger"); return redirect(url_for("admin_product_new"))
-        main_path=save_image(main_image) or "static/img/placeholder.svg"
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""INSERT INTO products(name,description,price,commission,delivery_price,image_path,category_id,delivery_mode,notes,created_at)
-                               VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id""",
-                           (name,description,price,commission,delivery_price,main_path,category_id,delivery_mode,notes,now_iso()))
-                pid=cur.fetchone()[0]
-                for f in extra_images:
-                    p=save_image(f)
-                    if p: cur.execute("INSERT INTO product_images(product_id,image_path,created_at) VALUES(%s,%s,%s)", (pid,p,now_iso()))
-            conn.commit()
+        if IMAGE_UPLOAD_MODE=="async":
+            # المنتج يُنشأ فورًا بالصورة البديلة؛ الصور تُرفع في الخلفية وتُربط به عند الانتهاء
+            job=image_job_params(main_image, extra_images)
+            exec_sql("""WITH p AS (
+                          INSERT INTO products(name,description,price,commission,delivery_price,image_path,category_id,delivery_mode,notes)
+                          VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id)
+                        INSERT INTO image_jobs(product_id,has_main,filenames,data)
+                        SELECT p.id,%s,%s,%s FROM p WHERE cardinality(%s::text[])>0""",
+                     (name,description,price,commission,delivery_price,"static/img/placeholder.svg",category_id,delivery_mode,notes)+job)
+            on_commit(wake_image_worker); catalog_changed()
+            flash("تمت إضافة المنتج، الصور قيد المعالجة","success"); return redirect(url_for("admin_products"))
+        # الرفع كله قبل فتح المعاملة
+        paths=save_images([main_image]+extra_images)
+        main_path=paths[0] or "static/img/placeholder.svg"
+        extra_paths=[p for p in paths[1:] if p]
+        # المنتج وصوره الإضافية في استعلام واحد
+        exec_sql("""WITH p AS (
+                      INSERT INTO products(name,description,price,commission,delivery_price,image_path,category_id,delivery_mode,notes)
+                      VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING id)
+                    INSERT INTO product_images(product_id,image_path)
+                    SELECT p.id, x.path FROM p, unnest(%s::text[]) WITH ORDINALITY AS x(path,n) ORDER BY x.n""",
+                 (name,description,price,commission,delivery_price,main_path,category_id,delivery_mode,notes,extra_paths))
+        catalog_changed()
         flash("تمت إضافة المنتج","success"); return redirect(url_for("admin_products"))
-    cats=q_all("SELECT * FROM categories ORDER BY name ASC")
+    cats=cached_batch(CATEGORIES_Q)[0]
     return render_template("admin/product_form.html", p=None, categories=cats)
 
 @app.route("/admin/products/<int:pid>/edit", methods=["GET","POST"])
 @admin_required
 def admin_product_edit(pid):
-    p=q_one("SELECT * FROM products WHERE id=%s",(pid,))
-    if not p: abort(404)
     if request.method=="POST":
         name=request.form.get("name","").strip()
         description=request.form.get("description","").strip()
@@ -532,33 +1662,143 @@ def admin_product_edit(pid):
         main_image=request.files.get("image")
         extra_images=request.files.getlist("images[]")
 
-        main_path=p["image_path"]
-        if main_image and main_image.filename:
-            newp=save_image(main_image)
-            if newp: main_path=newp
-
-        with get_db() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""UPDATE products SET name=%s, description=%s, price=%s, commission=%s, delivery_price=%s,
-                               image_path=%s, category_id=%s, delivery_mode=%s, notes=%s
-                               WHERE id=%s""",
-                           (name,description,price,commission,delivery_price,main_path,category_id,delivery_mode,notes,pid))
-                for f in extra_images:
-                    pth=save_image(f)
-                    if pth:
-                        cur.execute("INSERT INTO product_images(product_id,image_path,created_at) VALUES(%s,%s,%s)", (pid,pth,now_iso()))
-            conn.commit()
+        if IMAGE_UPLOAD_MODE=="async":
+            job=image_job_params(main_image, extra_images)
+            row=q_one("""WITH p AS (
+                           UPDATE products SET name=%s, description=%s, price=%s, commission=%s, delivery_price=%s,
+                                  category_id=%s, delivery_mode=%s, notes=%s
+                           WHERE id=%s RETURNING id),
+                         j AS (
+                           INSERT INTO image_jobs(product_id,has_main,filenames,data)
+                           SELECT p.id,%s,%s,%s FROM p WHERE cardinality(%s::text[])>0)
+                         SELECT id FROM p""",
+                      (name,description,price,commission,delivery_price,category_id,delivery_mode,notes,pid)+job)
+            if not row: abort(404)
+            on_commit(wake_image_worker); catalog_changed()
+            flash("تم تعديل المنتج، الصور قيد المعالجة","success"); return redirect(url_for("admin_products"))
+        paths=save_images([main_image]+extra_images)
+        main_path=paths[0]
+        extra_paths=[p for p in paths[1:] if p]
+        # None => نُبقي الصورة الحالية؛ التعديل والصور في استعلام واحد و RETURNING يغني عن SELECT مسبق
+        row=q_one("""WITH p AS (
+                       UPDATE products SET name=%s, description=%s, price=%s, commission=%s, delivery_price=%s,
+                              image_path=COALESCE(%s,image_path), category_id=%s, delivery_mode=%s, notes=%s
+                       WHERE id=%s RETURNING id),
+                     i AS (
+                       INSERT INTO product_images(product_id,image_path)
+                       SELECT p.id, x.path FROM p, unnest(%s::text[]) WITH ORDINALITY AS x(path,n) ORDER BY x.n)
+                     SELECT id FROM p""",
+                  (name,description,price,commission,delivery_price,main_path,category_id,delivery_mode,notes,pid,extra_paths))
+        if not row: abort(404)
+        catalog_changed()
         flash("تم تعديل المنتج","success"); return redirect(url_for("admin_products"))
-    cats=q_all("SELECT * FROM categories ORDER BY name ASC")
-    imgs=q_all("SELECT * FROM product_images WHERE product_id=%s ORDER BY id ASC",(pid,))
+    p,cats,imgs=q_batch(("SELECT * FROM products WHERE id=%s",(pid,),"one"), CATEGORIES_Q,
+                        ("SELECT * FROM product_images WHERE product_id=%s ORDER BY id ASC",(pid,),"all"))
+    if not p: abort(404)
     return render_template("admin/product_form.html", p=p, categories=cats, images=imgs)
 
 @app.route("/admin/products/<int:pid>/delete", methods=["POST"])
 @admin_required
 def admin_product_delete(pid):
-    exec_sql("DELETE FROM products WHERE id=%s",(pid,))
+    exec_sql("DELETE FROM products WHERE id=%s",(pid,)); catalog_changed()
     flash("تم حذف المنتج","info"); return redirect(url_for("admin_products"))
 
+# ===================== استيراد المنتجات (CSV / JSON + zip صور) =====================
+# الأعمدة: name, description, price, commission, delivery_price, category (اسم؛ يُنشأ إن لم يوجد),
+#          delivery_mode, notes, image, images (أسماء ملفات في الـ zip أو روابط http، مفصولة بـ | في CSV)
+# الصور تُرفع أولًا (بالتوازي، خارج المعاملة)، ثم المنتجات وصورها بـ COPY في معاملة واحدة
+IMPORT_MAX_IMAGE=20*1024*1024
+
+def read_import_rows(fs)->list:
+    if (fs.filename or "").lower().endswith(".json"):
+        data=json.load(fs.stream)
+        return data.get("products", []) if isinstance(data, dict) else data
+    return list(csv.DictReader(io.TextIOWrapper(fs.stream, encoding="utf-8-sig", newline="")))
+
+def _image_refs(r)->list:
+    refs=r.get("images") or []
+    if isinstance(refs, str): refs=refs.split("|")
+    return [str(r.get("image") or "").strip()]+[str(x).strip() for x in refs if str(x).strip()]
+
+def import_products(rows, images_zip=None, dry_run:bool=False)->dict:
+    report=dict(rows=len(rows), created=0, categories=0, images=0, errors=[])
+    zf=zipfile.ZipFile(images_zip) if images_zip else None
+    members={os.path.basename(i.filename): i for i in zf.infolist() if not i.is_dir()} if zf else {}
+    valid=[]; wanted={}
+    for n,r in enumerate(rows, 1):
+        if not isinstance(r, dict): report["errors"].append((n, "صف غير صالح")); continue
+        f,err=product_fields(r)
+        refs=_image_refs(r)
+        missing=[x for x in refs if x and not images.is_remote(x) and x not in members]
+        big=[x for x in refs if x in members and members[x].file_size>IMPORT_MAX_IMAGE]
+        bad=[x for x in refs if x and not images.is_remote(x) and not allowed_file(x)]
+        if not err and missing: err="صورة غير موجودة في الملف المضغوط: "+", ".join(missing)
+        if not err and (big or bad): err="صورة غير مقبولة: "+", ".join(big or bad)
+        if err: report["errors"].append((n, err)); continue
+        f.update(category=str(r.get("category") or "").strip(), refs=refs)
+        valid.append(f)
+        for x in refs:
+            if x in members: wanted[x]=members[x]
+    if dry_run or not valid:
+        return report
+    # نفس الصورة في عدة صفوف تُرفع مرة (والتخزين حسب المحتوى يكمل الباقي)
+    names=list(wanted)
+    paths=dict(zip(names, save_images([FileStorage(io.BytesIO(zf.read(wanted[x])), filename=x) for x in names])))
+    report["images"]=len(names)
+    def path(x): return x if images.is_remote(x) else paths.get(x)
+    cats=sorted({f["category"] for f in valid if f["category"]})
+    with _use_conn() as conn, conn.transaction():
+        cat_ids={}
+        if cats:
+            report["categories"]=len(conn.execute(IMPORT_CATEGORIES_SQL, (cats,)).fetchall())
+            cat_ids=dict(conn.execute(IMPORT_CATEGORY_IDS_SQL, (cats,)).fetchall())
+        ids=[r[0] for r in conn.execute(IMPORT_IDS_SQL, (len(valid),))]
+        with conn.cursor() as cur:
+            with cur.copy("""COPY products(id,name,description,price,commission,delivery_price,image_path,
+                                           category_id,delivery_mode,notes) FROM STDIN""") as cp:
+                for pid,f in zip(ids, valid):
+                    cp.write_row((pid, f["name"], f["description"], f["price"], f["commission"], f["delivery_price"],
+                                  path(f["refs"][0]) or "static/img/placeholder.svg", cat_ids.get(f["category"]),
+                                  f["delivery_mode"], f["notes"]))
+            with cur.copy("COPY product_images(product_id,image_path) FROM STDIN") as cp:
+                for pid,f in zip(ids, valid):
+                    for x in f["refs"][1:]:
+                        if path(x): cp.write_row((pid, path(x)))
+    report["created"]=len(valid)
+    if has_request_context(): catalog_changed()
+    return report
+
+@app.route("/admin/products/import", methods=["GET","POST"])
+@admin_required
+def admin_products_import():
+    report=None
+    if request.method=="POST":
+        fs=request.files.get("file")
+        if not fs or not fs.filename:
+            flash("اختر ملف CSV أو JSON","danger"); return redirect(url_for("admin_products_import"))
+        zf=request.files.get("images_zip")
+        try:
+            rows=read_import_rows(fs)
+            report=import_products(rows, zf.stream if zf and zf.filename else None, dry_run=bool(request.form.get("dry_run")))
+        except (ValueError, csv.Error, zipfile.BadZipFile) as e:
+            flash(f"ملف غير صالح: {e}","danger"); return redirect(url_for("admin_products_import"))
+        if report["created"]: flash(f"تم استيراد {report['created']} منتج","success")
+    return render_template("admin/import.html", report=report)
+
+@app.cli.command("products-import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--images", "images_zip", type=click.Path(exists=True, dir_okay=False), help="ملف zip بالصور")
+@click.option("--dry-run", is_flag=True, help="تحقق فقط دون إدراج")
+def products_import_command(path, images_zip, dry_run):
+    t0=time.monotonic()
+    with open(path, "rb") as f:
+        rows=read_import_rows(FileStorage(f, filename=path))
+    report=import_products(rows, images_zip, dry_run=dry_run)
+    for n,err in report["errors"]: click.echo(f"صف {n}: {err}", err=True)
+    click.echo(f"{report['rows']} صف: {report['created']} منتج، {report['categories']} تصنيف جديد، "
+               f"{report['images']} صورة، {len(report['errors'])} خطأ في {time.monotonic()-t0:.1f}s"
+               + (" — dry-run" if dry_run else ""))
+
 # تغيير حالة الطلب من لوحة الأدمن
 @app.route("/admin/orders/<int:oid>/status", methods=["POST"])
 @admin_required
@@ -566,9 +1806,79 @@ def admin_order_status(oid):
     status=request.form.get("status")
     if status not in ("pending","delivered","canceled"):
         flash("حالة غير صالحة","danger"); return redirect(url_for("admin_dashboard"))
-    exec_sql("UPDATE orders SET status=%s WHERE id=%s",(status,oid))
+    exec_sql(ORDER_STATUS_SQL, dict(ids=[oid], statuses=[status]))
     flash("تم تحديث حالة الطلب","success"); return redirect(url_for("admin_dashboard"))
 
+# تحديث جماعي للحالات (تقرير شركة التوصيل): CSV بعمودين رقم الطلب,الحالة أو قائمة أرقام بحالة واحدة
+# COPY إلى جدول مؤقت ثم استعلام واحد بنفس آثار العمولة؛ إعادة نفس الملف لا تغيّر شيئًا (لا تغيير = لا قيد)
+ORDER_STATUS_ALIASES={
+    "pending": "pending", "en attente": "pending", "قيد الانتظار": "pending",
+    "delivered": "delivered", "livré": "delivered", "livre": "delivered", "تم التوصيل": "delivered", "مستلم": "delivered",
+    "canceled": "canceled", "cancelled": "canceled", "returned": "canceled", "retour": "canceled", "annulé": "canceled",
+    "ملغى": "canceled", "مرتجع": "canceled",
+}
+INT_MAX=2**31-1
+
+def parse_status_rows(rows)->Tuple[list, list]:
+    # rows: قوائم [رقم, حالة]؛ يعيد ([(id, status)], [(سطر, خطأ)])؛ سطر أول غير رقمي = عناوين
+    pairs=[]; errors=[]
+    for n,row in enumerate(rows, 1):
+        if not row or not "".join(row).strip(): continue
+        oid=row[0].strip().lstrip("#")
+        if not oid.isdigit() or int(oid)>INT_MAX:
+            if n>1: errors.append((n, "رقم طلب غير صالح"))
+            continue
+        st=ORDER_STATUS_ALIASES.get(row[1].strip().lower() if len(row)>1 else "")
+        if not st: errors.append((n, "حالة غير معروفة")); continue
+        pairs.append((int(oid), st))
+    return pairs, errors
+
+def bulk_order_status(pairs)->dict:
+    report=dict(rows=len(pairs), updated=0, delivered=0, canceled=0, pending=0, unchanged=0, unmatched=[])
+    if not pairs: return report
+    with _use_conn() as conn, conn.transaction():
+        conn.execute(ORDER_STATUS_IMPORT_SQL)
+        with conn.cursor() as cur:
+            with cur.copy("COPY order_status_import(n,id,status) FROM STDIN") as cp:
+                for n,(oid,st) in enumerate(pairs): cp.write_row((n, oid, st))
+            cur.execute(ORDER_STATUS_BULK_SQL)
+            for kind,oid,_,new_status in cur.fetchall():
+                if kind=="unmatched": report["unmatched"].append(oid); continue
+                report["updated"]+=1; report[new_status]+=1
+    report["unmatched"].sort()
+    report["unchanged"]=len({oid for oid,_ in pairs})-report["updated"]-len(report["unmatched"])
+    return report
+
+@app.route("/admin/orders/bulk-status", methods=["GET","POST"])
+@admin_required
+def admin_orders_bulk_status():
+    report=errors=None
+    if request.method=="POST":
+        fs=request.files.get("file")
+        try:
+            if fs and fs.filename:
+                rows=csv.reader(io.TextIOWrapper(fs.stream, encoding="utf-8-sig", newline=""))
+            else:
+                status=request.form.get("status","")
+                rows=[[x, status] for x in re.split(r"[\s,;]+", request.form.get("ids",""))]
+            pairs,errors=parse_status_rows(rows)
+        except (ValueError, csv.Error) as e:
+            flash(f"ملف غير صالح: {e}","danger"); return redirect(url_for("admin_orders_bulk_status"))
+        report=bulk_order_status(pairs)
+        if report["updated"]: flash(f"تم تحديث {report['updated']} طلبية","success")
+    return render_template("admin/orders_bulk.html", report=report, errors=errors)
+
+@app.cli.command("orders-status")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def orders_status_command(path):
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        pairs,errors=parse_status_rows(csv.reader(f))
+    for n,err in errors: click.echo(f"سطر {n}: {err}", err=True)
+    r=bulk_order_status(pairs)
+    click.echo(f"{r['rows']} سطر: {r['updated']} محدّثة (توصيل {r['delivered']}، إلغاء {r['canceled']}، انتظار {r['pending']})، "
+               f"{r['unchanged']} دون تغيير، {len(r['unmatched'])} غير موجودة"
+               + (": "+", ".join(map(str, r["unmatched"][:50])) if r["unmatched"] else ""))
+
 # الصفحات
 @app.route("/admin/pages", methods=["GET","POST"])
 @admin_required
@@ -579,8 +1889,11 @@ def admin_pages():
         content=request.form.get("content","").strip()
         if slug not in ("privacy","about","contact") or not title:
             flash("تحقق من البيانات","danger"); return redirect(url_for("admin_pages"))
-        exec_sql("UPDATE pages SET title=%s, content=%s WHERE slug=%s",(title,content,slug))
+        _,pages=q_batch(("UPDATE pages SET title=%s, content=%s WHERE slug=%s RETURNING id",(title,content,slug),"one"),
+                        ("SELECT * FROM pages ORDER BY slug",(),"all"))
+        catalog_changed()
         flash("تم حفظ الصفحة","success")
+        return render_template("admin/pages.html", pages=pages)
     pages=q_all("SELECT * FROM pages ORDER BY slug")
     return render_template("admin/pages.html", pages=pages)
 
@@ -591,43 +1904,207 @@ def admin_withdraw_set(wid):
     status=request.form.get("status")
     if status not in ("approved","rejected"):
         flash("إجراء غير صالح","danger"); return redirect(url_for("admin_dashboard"))
-    exec_sql("UPDATE withdrawals SET status=%s WHERE id=%s",(status,wid))
+    row=q_one(WITHDRAW_STATUS_SQL, dict(wid=wid, status=status))
+    if not row: abort(404)
+    if not row["updated"] and row["old_status"]=="rejected" and status!="rejected":
+        flash("رصيد المسوّق لا يكفي لإعادة قبول هذا السحب","danger"); return redirect(url_for("admin_dashboard"))
     flash("تم تحديث طلب السحب","success"); return redirect(url_for("admin_dashboard"))
 
 # إعدادات الأدمن
 @app.route("/admin/settings", methods=["GET","POST"])
 @admin_required
 def admin_settings():
+    before,n=page_args()
     if request.method=="POST":
         new_email=request.form.get("email","").strip().lower()
         new_pass =request.form.get("password","").strip()
         if not new_email:
             flash("الإيميل مطلوب","danger"); return redirect(url_for("admin_settings"))
-        admin_user=q_one("SELECT * FROM users WHERE role='admin' LIMIT 1")
-        if admin_user:
-            if new_pass:
-                exec_sql("UPDATE users SET email=%s, password_hash=%s WHERE id=%s",
-                         (new_email, generate_password_hash(new_pass), admin_user["id"]))
-            else:
-                exec_sql("UPDATE users SET email=%s WHERE id=%s",(new_email, admin_user["id"]))
-            flash("تم حفظ الإعدادات","success")
-        else:
-            flash("لا يوجد مستخدم أدمن","danger")
-    affiliates=q_all("SELECT id,name,email,phone,approved,created_at FROM users WHERE role='affiliate' ORDER BY id DESC")
-    admin_user=q_one("SELECT id,name,email FROM users WHERE role='admin' LIMIT 1")
-    return render_template("admin/settings.html", admin_user=admin_user, affiliates=affiliates)
+        pw_hash=hash_password(new_pass) if new_pass else None
+        # التحديث والقراءات في دفعة واحدة (COALESCE يبقي كلمة السر إن لم تتغير)
+        updated,affiliates,admin_user=q_batch(
+            ("""UPDATE users SET email=%s, password_hash=COALESCE(%s,password_hash)
+                WHERE id=(SELECT id FROM users WHERE role='admin' ORDER BY id LIMIT 1) RETURNING id""",(new_email,pw_hash),"one"),
+            admin_affiliates_query(before, n), ADMIN_USER_Q)
+        if updated: flash("تم حفظ الإعدادات","success")
+        else:       flash("لا يوجد مستخدم أدمن","danger")
+    else:
+        affiliates,admin_user=q_batch(admin_affiliates_query(before, n), ADMIN_USER_Q)
+    affiliates,next_url=keyset_page(affiliates, n)
+    return render_template("admin/settings.html", admin_user=admin_user, affiliates=affiliates, next_url=next_url)
+
+# إحصائيات مسبح الاتصالات (لهذا العامل فقط) لضبط الحجم
+@app.route("/admin/stats/db")
+@admin_required
+def admin_db_stats():
+    return jsonify(pool_stats())
+
+@app.route("/admin/stats/cache")
+@admin_required
+def admin_cache_stats():
+    st=catalog_cache.stats(); st.update(pid=os.getpid(), listening=_listener_live.is_set())
+    return jsonify(st)
+
+# ===================== التحليلات =====================
+# من order_rollups فقط (يوم × مسوّق × منتج × حالة): الكلفة تتبع طول الفترة لا حجم orders. الأيام بتوقيت UTC
+ANALYTICS_DAYS=30
+ANALYTICS_MAX_DAYS=731
+ANALYTICS_TOP=10
+
+def _arg_date(name:str)->Optional[date]:
+    v=request.args.get(name)
+    if not v: return None
+    try: return datetime.strptime(v, "%Y-%m-%d").date()
+    except ValueError: abort(400)
+
+def analytics_range()->Tuple[date,date]:
+    # ?from=&to= شاملان => [start, end)
+    end=(_arg_date("to") or datetime.now(timezone.utc).date())+timedelta(days=1)
+    start=_arg_date("from") or end-timedelta(days=ANALYTICS_DAYS)
+    if start>=end or (end-start).days>ANALYTICS_MAX_DAYS: abort(400)
+    return start, end
+
+def _rates(t)->dict:
+    # التحويل: من الطلبيات المحسومة (توصيل أو إلغاء)، ومن كل الطلبيات
+    closed=t["delivered"]+t["canceled"]
+    return {"delivered_rate": round(t["delivered"]/closed, 4) if closed else None,
+            "canceled_rate": round(t["canceled"]/closed, 4) if closed else None,
+            "delivered_of_all": round(t["delivered"]/t["orders"], 4) if t["orders"] else None}
+
+def analytics(start:date, end:date)->dict:
+    rows,affiliates,products=q_batch(*analytics_queries(start, end, ANALYTICS_TOP))
+    keys=("orders","delivered","canceled","pending","revenue","commission")
+    by_day={r["day"]: r for r in rows}
+    series=[]; totals=dict.fromkeys(keys, 0)
+    for i in range((end-start).days):
+        d=start+timedelta(days=i)
+        r=by_day.get(d) or dict.fromkeys(keys, 0)
+        series.append({"day": d.isoformat(), **{k: r[k] for k in keys}})
+        for k in keys: totals[k]+=r[k]
+    for r in affiliates+products: r.update(_rates(r))
+    return {"from": start.isoformat(), "to": (end-timedelta(days=1)).isoformat(), "series": series,
+            "totals": totals, "conversion": _rates(totals),
+            "top_affiliates": affiliates, "top_products": products}
+
+@app.route("/admin/analytics")
+@admin_required
+def admin_analytics():
+    return render_template("admin/analytics.html", **analytics(*analytics_range()))
+
+@app.route("/admin/stats/analytics")
+@admin_required
+def admin_analytics_stats():
+    return jsonify(analytics(*analytics_range()))
+
+@app.route("/metrics")
+def metrics_view():
+    # مجمّع من كل العمال. جلسة أدمن أو METRICS_TOKEN (Prometheus لا يملك جلسة)
+    token=request.headers.get("Authorization", "")
+    if not (METRICS_TOKEN and hmac.compare_digest(token.encode(), f"Bearer {METRICS_TOKEN}".encode())):
+        if "user_id" not in session: return redirect(url_for("login"))
+        if session.get("role")!="admin": abort(403)
+    return app.response_class(METRICS.render(), content_type="text/plain; version=0.0.4; charset=utf-8",
+                              headers={"Cache-Control": "no-store"})
 
 # ===================== API مساعدة للصور =====================
 @app.route("/api/product/<int:pid>/images")
+@conditional(per_user=False)
 def api_product_images(pid):
-    rows=q_all("SELECT image_path FROM product_images WHERE product_id=%s ORDER BY id ASC",(pid,))
+    rows=cached_batch(product_images_query(pid))[0]
     return jsonify([r["image_path"] for r in rows])
 
+@app.route("/api/products/suggest")
+@login_required()
+@conditional()
+def api_products_suggest():
+    # الإكمال التلقائي لخانة البحث: أول SUGGEST_LIMIT نتيجة، من كاش الكتالوج غالبًا
+    q=search_text(request.args.get("q"))
+    rows=cached_batch(products_suggest_query(q))[0] if q else []
+    return jsonify([{"id": r["id"], "name": r["name"], "image": static_url(r["image_path"]),
+                     "url": url_for("affiliate_product_detail", pid=r["id"])} for r in rows])
+
+# ===================== التصدير (CSV / XLSX بالتدفق) =====================
+# مؤشر على الخادم (named cursor) يجلب EXPORT_ITERSIZE صفًا كل مرة => ذاكرة ثابتة مهما كبر الجدول،
+# وأول بايت يُرسل فور وصول أول دفعة. اتصال مستقل من المسبح: معاملة الطلب تُغلق قبل إرسال الجسم
+EXPORT_ITERSIZE=2000
+EXPORT_MIMETYPES={"csv": "text/csv; charset=utf-8",
+                  "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
+LEDGER_KIND_LABELS={"commission": "عمولة", "commission_reversal": "إلغاء عمولة", "bonus": "علاوة",
+                    "withdrawal": "سحب", "withdrawal_reversal": "إرجاع سحب"}
+
+def _export_rows(sql, params, label=None):
+    with get_db() as conn:
+        with conn.cursor(name="export") as cur:
+            cur.itersize=EXPORT_ITERSIZE
+            cur.execute(sql, params)
+            for row in cur: yield label(row) if label else row
+
+def export_filters(alias:str, statuses=(), by_affiliate:bool=True)->Tuple[str, list]:
+    # ?from=YYYY-MM-DD&to=YYYY-MM-DD (شاملان، UTC) &status= &affiliate_id=
+    days=[]
+    for arg in ("from", "to"):
+        v=request.args.get(arg)
+        try: days.append(datetime.strptime(v, "%Y-%m-%d").replace(tzinfo=timezone.utc) if v else None)
+        except ValueError: abort(400)
+    st=request.args.get("status")
+    if st and st not in statuses: abort(400)
+    aff=request.args.get("affiliate_id", type=int) if by_affiliate else None
+    return export_where(alias, *days, st, aff)
+
+def export_response(name:str, fmt:str, header, query, label=None):
+    sql,params,_=query
+    rows=_export_rows(sql, params, label)
+    body=exports.csv_stream(header, rows) if fmt=="csv" else exports.xlsx_stream(header, rows, name)
+    fname=f"{name}-{datetime.now(timezone.utc):%Y%m%d-%H%M}.{fmt}"
+    return app.response_class(body, mimetype=EXPORT_MIMETYPES[fmt],
+                              headers={"Content-Disposition": f'attachment; filename="{fname}"',
+                                       "Cache-Control": "no-store", "X-Accel-Buffering": "no"})
+
+STATEMENT_HEADER=("#", "التاريخ", "رقم المسوّق", "المسوّق", "الحركة", "المبلغ", "الرصيد", "الطلبية", "السحب")
+
+def _statement_label(row):
+    row=list(row); row[4]=LEDGER_KIND_LABELS.get(row[4], row[4]); return row
+
+def statement_export(fmt:str, affiliate_id:Optional[int]):
+    return export_response("commissions", fmt, STATEMENT_HEADER,
+                           statement_export_query(affiliate_id, *export_filters("s", by_affiliate=False)), _statement_label)
+
+@app.route("/admin/export/orders.<any(csv,xlsx):fmt>")
+@admin_required
+def admin_export_orders(fmt):
+    where,params=export_filters("o", ("pending","delivered","canceled"))
+    return export_response("orders", fmt,
+        ("#", "التاريخ", "المنتج", "المسوّق", "البريد", "الزبون", "الهاتف", "العنوان", "الحالة", "العمولة", "السعر"),
+        orders_export_query(where, params))
+
+@app.route("/admin/export/withdrawals.<any(csv,xlsx):fmt>")
+@admin_required
+def admin_export_withdrawals(fmt):
+    where,params=export_filters("w", ("requested","approved","rejected"))
+    return export_response("withdrawals", fmt,
+        ("#", "التاريخ", "المسوّق", "البريد", "المبلغ", "الطريقة", "التفاصيل", "الحالة"),
+        withdrawals_export_query(where, params))
+
+@app.route("/admin/export/commissions.<any(csv,xlsx):fmt>")
+@admin_required
+def admin_export_commissions(fmt):
+    return statement_export(fmt, request.args.get("affiliate_id", type=int))
+
+@app.route("/affiliate/export/commissions.<any(csv,xlsx):fmt>")
+@login_required(role="affiliate")
+def affiliate_export_commissions(fmt):
+    return statement_export(fmt, session["user_id"])
+
 # ===================== أخطاء =====================
 @app.errorhandler(403)
 def e403(_): return render_template("error.html", message="403 - ممنوع"), 403
 @app.errorhandler(404)
 def e404(_): return render_template("error.html", message="404 - غير موجود"), 404
+@app.errorhandler(TooManyRequests)
+def e429(e): return render_template("error.html", message="429 - محاولات كثيرة، أعد المحاولة لاحقًا"), 429, {"Retry-After": str(e.retry_after or 60)}
+@app.errorhandler(PoolTimeout)
+@app.errorhandler(HashBusy)
+def e503(_): return render_template("error.html", message="503 - الخادم مشغول، أعد المحاولة"), 503
 
 # ===================== تشغيل =====================
 if __name__=="__main__":
@@ -0,0 +1,448 @@
+# bench.py — قياس الأداء تحت الحمل على بيانات اصطناعية (PostgreSQL محلي فقط)
+#   py bench.py seed [--products 50000 --affiliates 500 --orders 5000000 ...]   توليد البيانات (COPY) في مخطط dz_bench
+#   py bench.py run [--users 32 --duration 60 --procs 1] [--out FILE]             تشغيل الحمل وحفظ النتائج (JSON)
+#   py bench.py compare OLD.json NEW.json                                         مقارنة تشغيلين (قبل/بعد commit)
+#
+# - القاعدة: BENCH_DATABASE_URL (وإلا DATABASE_URL) ويُرفض أي خادم غير محلي: لا حمل ولا بيانات على الإنتاج.
+# - كل شيء داخل مخطط dz_bench (search_path) => بقية القاعدة لا تتأثر؛ seed يحذفه ويعيد بناءه بالترحيلات.
+# - المستخدمون المحاكون يستدعون مسارات app_pg الحقيقية (Flask test client، بلا شبكة) بجلسة جاهزة:
+#   كل مستخدم خيط، و --procs توزعهم على عمليات منفصلة (مثل عمال gunicorn) لتجاوز GIL.
+# - ما يكتبه التشغيل (طلبيات، سحوبات) يُحذف في نهايته => كل التشغيلات على نفس البيانات.
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from itertools import accumulate
+from urllib.parse import urlencode
+
+import psycopg
+from psycopg import sql
+from psycopg.conninfo import conninfo_to_dict, make_conninfo
+from dotenv import load_dotenv
+
+SCHEMA = "dz_bench"
+LOCAL_HOSTS = {"", "localhost", "127.0.0.1", "::1"}
+COPY_CHUNK = 10000
+RESULTS_DIR = "bench_results"
+
+PRODUCT_WORDS = ["حذاء رياضي", "ساعة يد", "حقيبة ظهر", "سماعة لاسلكية", "قميص قطني", "عطر", "مكواة", "خلاط كهربائي",
+                 "نظارة شمسية", "شاحن سريع", "ساعة ذكية", "طقم أواني", "ميزان مطبخ", "بطانية", "جراب هاتف", "مجفف شعر"]
+COLORS = ["أسود", "أبيض", "أزرق", "أحمر", "رمادي", "بني", "ذهبي", "فضي"]
+FIRST_NAMES = ["محمد", "أحمد", "يوسف", "أمين", "كريم", "عبد القادر", "نور الدين", "فاطمة", "خديجة", "مريم", "سارة", "إيمان"]
+LAST_NAMES = ["بن علي", "بوزيد", "حداد", "مصطفاوي", "بلقاسم", "سعيدي", "زروقي", "بن عيسى", "عمراني", "قاسمي"]
+WILAYAS = ["الجزائر", "وهران", "قسنطينة", "سطيف", "البليدة", "باتنة", "عنابة", "تلمسان", "بجاية", "تيزي وزو", "الشلف", "ورقلة"]
+
+# حالة الطلبية حسب عمرها: الحديثة أغلبها معلّقة، والقديمة محسومة
+RECENT_DAYS = 3
+RECENT_MIX = (("pending", 0.60), ("delivered", 0.25), ("canceled", 0.15))
+SETTLED_MIX = (("pending", 0.05), ("delivered", 0.68), ("canceled", 0.27))
+
+# مزيج الطلبات لكل مستخدم محاكى (الوزن النسبي)
+AFFILIATE_MIX = (("affiliate_products GET", 40), ("affiliate_orders GET", 25), ("affiliate_commissions GET", 12),
+                 ("affiliate_order POST", 10), ("affiliate_commissions POST", 3))
+ADMIN_MIX = (("admin_dashboard GET", 1),)
+
+BENCH_TABLES = ("users", "categories", "products", "product_images", "orders", "withdrawals", "bonuses",
+                "ledger_entries", "affiliate_balances", "order_rollups", "order_totals")
+
+
+def bench_url():
+    load_dotenv()
+    url = (os.environ.get("BENCH_DATABASE_URL") or os.environ.get("DATABASE_URL", "")).strip()
+    if not url:
+        sys.exit("BENCH_DATABASE_URL مفقود")
+    hosts = (conninfo_to_dict(url).get("host") or "").split(",")
+    if any(h not in LOCAL_HOSTS and not h.startswith("/") for h in hosts):
+        sys.exit(f"خادم غير محلي ({','.join(hosts)}): القياس على PostgreSQL محلي فقط (BENCH_DATABASE_URL)")
+    return make_conninfo(url, options=f"-c search_path={SCHEMA},public")   # public: الإضافات (pg_trgm)
+
+
+def _ts(t):
+    return datetime.fromtimestamp(t, timezone.utc).isoformat(sep=" ", timespec="seconds")
+
+
+def _zipf(ids, s, rnd):
+    # شعبية غير متساوية (قليل من المنتجات/المسوّقين يأخذ أغلب الطلبيات)، مبعثرة على الـ ids
+    ids = list(ids)
+    rnd.shuffle(ids)
+    return ids, list(accumulate(1 / r ** s for r in range(1, len(ids) + 1)))
+
+
+def _pick(rnd, mix):
+    x = rnd.random()
+    for v, p in mix:
+        x -= p
+        if x < 0: return v
+    return mix[-1][0]
+
+
+def _copy(conn, table, cols, lines, total=None):
+    # lines: أسطر COPY نصية جاهزة (القيم من قوائم معروفة، بلا tab ولا \) تُرسل في كتل
+    t0, buf, n = time.monotonic(), [], 0
+    with conn.cursor().copy(f"COPY {table} ({cols}) FROM STDIN") as cp:
+        for line in lines:
+            buf.append(line)
+            if len(buf) == COPY_CHUNK:
+                cp.write("\n".join(buf) + "\n"); n += len(buf); buf.clear()
+                if total and n % (COPY_CHUNK * 50) == 0: print(f"   {table}: {n}/{total}", flush=True)
+        if buf: cp.write("\n".join(buf) + "\n"); n += len(buf)
+    conn.commit()
+    print(f"-> {table:16s} {n:>9} صف  {time.monotonic() - t0:6.1f}s", flush=True)
+
+
+# ===================== توليد البيانات =====================
+def _customer(rnd):
+    return (f"{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}\t0{rnd.choice('567')}{rnd.randrange(10**8):08d}\t"
+            f"{rnd.choice(WILAYAS)}، حي {rnd.randrange(1, 400)} رقم {rnd.randrange(1, 90)}")
+
+
+def _products(rnd, n, cats, now, days, price, commission):
+    cat_ids, cat_cw = _zipf(range(1, cats + 1), 0.8, rnd)
+    for i in range(1, n + 1):
+        word, color = rnd.choice(PRODUCT_WORDS), rnd.choice(COLORS)
+        price[i] = p = rnd.randrange(800, 15001, 100)
+        commission[i] = c = max(100, round(p * rnd.uniform(0.08, 0.2), -1))
+        notes = "\\N" if rnd.random() < 0.7 else f"متوفر بمقاسات مختلفة - {color}"
+        yield (f"{word} {color} {i}\t{word} {color} بجودة عالية، التوصيل لكل الولايات\t{p}\t{c}\t{rnd.randrange(400, 901, 50)}\t"
+               f"/static/img/placeholder.svg\t{rnd.choices(cat_ids, cum_weights=cat_cw)[0]}\t"
+               f"{rnd.choice(('home', 'office'))}\t{notes}\t{_ts(now - days * 86400 * (n - i) / n)}")
+
+
+def _users(rnd, n, now, days, pw_hash):
+    yield f"Admin\tadmin@bench.local\t{pw_hash}\tadmin\tt\t\\N\t{_ts(now - days * 86400)}"
+    for i in range(1, n + 1):
+        yield (f"{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}\taff{i}@bench.local\t{pw_hash}\taffiliate\t"
+               f"{'t' if rnd.random() < 0.9 else 'f'}\t0{rnd.choice('567')}{rnd.randrange(10**8):08d}\t"
+               f"{_ts(now - days * 86400 * (n - i) / n)}")
+
+
+def _orders(rnd, n, now, days, products, affiliates, price, commission):
+    (pids, pcw), (aids, acw), span = products, affiliates, days * 86400
+    for lo in range(0, n, COPY_CHUNK):
+        k = min(COPY_CHUNK, n - lo)
+        ps, afs = rnd.choices(pids, cum_weights=pcw, k=k), rnd.choices(aids, cum_weights=acw, k=k)
+        for j in range(k):
+            t = now - span + span * (lo + j) / n          # id تصاعدي مع الزمن كما في الإنتاج
+            status = _pick(rnd, RECENT_MIX if now - t < RECENT_DAYS * 86400 else SETTLED_MIX)
+            p = ps[j]
+            yield f"{p}\t{afs[j]}\t{_customer(rnd)}\t{status}\t{commission[p]}\t{price[p]}\t{_ts(t)}"
+
+
+def _withdrawals(rnd, n, now, days, affiliates):
+    (aids, acw), span = affiliates, days * 86400
+    for i, aid in enumerate(rnd.choices(aids, cum_weights=acw, k=n)):
+        t = now - span + span * i / max(n, 1)
+        status = "requested" if now - t < RECENT_DAYS * 86400 else ("rejected" if rnd.random() < 0.08 else "approved")
+        method = rnd.choice(("ccp", "rib"))
+        yield f"{aid}\t{rnd.randrange(5000, 30001, 500)}\t{method}\t{method.upper()} 00799999{rnd.randrange(10**10):010d}\t{status}\t{_ts(t)}"
+
+
+def _bonuses(rnd, approved, now, days):
+    for w in range(1, days // 7 + 1):
+        t = now - w * 7 * 86400
+        y, wk = datetime.fromtimestamp(t, timezone.utc).isocalendar()[:2]
+        for aid in rnd.sample(approved, k=len(approved) * 15 // 100):
+            yield f"{aid}\t{y}\t{wk}\t{1000 * rnd.choice((1, 1, 1, 2, 3))}\t{_ts(t)}"
+
+
+# دفتر الحركات والأرصدة من التاريخ المولَّد (نفس قواعد app_pg: عمولة لكل توصيل، سحب، إرجاع سحب مرفوض، علاوة)
+LEDGER_SQL = [
+    """INSERT INTO ledger_entries(affiliate_id,kind,amount,order_id,created_at)
+       SELECT affiliate_id,'commission',commission,id,created_at FROM orders WHERE status='delivered' ORDER BY id""",
+    """INSERT INTO ledger_entries(affiliate_id,kind,amount,withdrawal_id,created_at)
+       SELECT affiliate_id,k.kind,CASE WHEN k.kind='withdrawal' THEN -amount ELSE amount END,id,created_at
+       FROM withdrawals, LATERAL (VALUES ('withdrawal'),('withdrawal_reversal')) k(kind)
+       WHERE k.kind='withdrawal' OR status='rejected' ORDER BY id, k.kind""",
+    """INSERT INTO ledger_entries(affiliate_id,kind,amount,bonus_id,created_at)
+       SELECT affiliate_id,'bonus',amount,id,created_at FROM bonuses ORDER BY id""",
+    """INSERT INTO affiliate_balances(affiliate_id,balance)
+       SELECT affiliate_id, SUM(amount) FROM ledger_entries GROUP BY affiliate_id""",
+]
+
+
+def seed(url, products, affiliates, orders, withdrawals, categories, days, seed_value):
+    from migrate_db import migrate
+    from werkzeug.security import generate_password_hash
+    rnd, now = random.Random(seed_value), time.time()
+    t0 = time.monotonic()
+    with psycopg.connect(url, autocommit=True) as conn:
+        conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.execute(f"CREATE SCHEMA {SCHEMA}")
+    migrate(url)
+    price, commission = [0] * (products + 1), [0] * (products + 1)
+    with psycopg.connect(url) as conn:
+        # مخطط جديد => التسلسلات تبدأ من 1: ids = ترتيب الأسطر
+        _copy(conn, "categories", "name", (f"{PRODUCT_WORDS[i % len(PRODUCT_WORDS)]} {i}" for i in range(1, categories + 1)))
+        _copy(conn, "products", "name,description,price,commission,delivery_price,image_path,category_id,delivery_mode,notes,created_at",
+              _products(rnd, products, categories, now, days, price, commission), products)
+        _copy(conn, "product_images", "product_id,image_path,created_at",
+              (f"{1 + i // 2}\t/static/img/placeholder.svg\t{_ts(now)}" for i in range(products * 2)), products * 2)
+        _copy(conn, "users", "name,email,password_hash,role,approved,phone,created_at",
+              _users(rnd, affiliates, now, days + 30, generate_password_hash("bench")))
+        approved = [r[0] for r in conn.execute("SELECT id FROM users WHERE role='affiliate' AND approved ORDER BY id")]
+        prods, affs = _zipf(range(1, products + 1), 1.0, rnd), _zipf(approved, 0.8, rnd)
+        _copy(conn, "orders", "product_id,affiliate_id,customer_name,customer_phone,customer_address,status,commission,price,created_at",
+              _orders(rnd, orders, now, days, prods, affs, price, commission), orders)
+        _copy(conn, "withdrawals", "affiliate_id,amount,method,details,status,created_at",
+              _withdrawals(rnd, withdrawals, now, days, affs), withdrawals)
+        _copy(conn, "bonuses", "affiliate_id,iso_year,iso_week,amount,created_at", _bonuses(rnd, approved, now, days))
+        t1 = time.monotonic()
+        for q in LEDGER_SQL: conn.execute(q)
+        conn.execute(sql.SQL("COMMENT ON SCHEMA {} IS {}").format(sql.Identifier(SCHEMA), sql.Literal(json.dumps(dict(
+            products=products, affiliates=affiliates, orders=orders, withdrawals=withdrawals, categories=categories,
+            days=days, seed=seed_value, seeded_at=_ts(now))))))
+        conn.commit()
+        print(f"-> ledger_entries   {time.monotonic() - t1:6.1f}s", flush=True)
+    with psycopg.connect(url, autocommit=True) as conn:
+        for t in BENCH_TABLES: conn.execute(f"VACUUM (ANALYZE) {t}")
+    print(f"seed done in {time.monotonic() - t0:.0f}s")
+
+
+def dataset(conn):
+    info = conn.execute("SELECT obj_description(to_regnamespace(%s), 'pg_namespace') AS info", (SCHEMA,)).fetchone()["info"]
+    if not info:
+        sys.exit(f"المخطط {SCHEMA} غير موجود: py bench.py seed أولًا")
+    return json.loads(info)
+
+
+# ===================== المستخدمون المحاكون =====================
+def _request(name, rnd, ctx):
+    # (method, path, form) لكل نوع طلب؛ القيم من البيانات الفعلية (ids موجودة، كلمات بحث من أسماء المنتجات)
+    if name == "affiliate_products GET":
+        args = {}
+        if rnd.random() < 0.25: args["cat"] = rnd.choice(ctx["categories"])
+        if rnd.random() < 0.15: args["q"] = rnd.choice(PRODUCT_WORDS).split()[0]
+        elif rnd.random() < 0.2: args["before"] = rnd.randrange(1, ctx["max_product"] + 1)
+        return "GET", "/affiliate/products" + ("?" + urlencode(args) if args else ""), None
+    if name == "affiliate_orders GET":
+        args = {}
+        if rnd.random() < 0.3: args["status"] = rnd.choice(("pending", "delivered", "canceled"))
+        if rnd.random() < 0.15: args["before"] = rnd.randrange(1, ctx["max_order"] + 1)
+        return "GET", "/affiliate/orders" + ("?" + urlencode(args) if args else ""), None
+    if name == "affiliate_commissions GET":
+        return "GET", "/affiliate/commissions", None
+    if name == "affiliate_commissions POST":
+        return "POST", "/affiliate/commissions", dict(method="ccp", amount=str(int(ctx["withdraw_min"])), details="CCP 0079999912345")
+    if name == "affiliate_order POST":
+        cn, cp, ca = _customer(rnd).split("\t")
+        return "POST", f"/affiliate/order/{rnd.choice(ctx['hot_products'])}", dict(customer_name=cn, customer_phone=cp, customer_address=ca)
+    if name == "admin_dashboard GET":
+        return "GET", "/admin", None
+    raise ValueError(name)
+
+
+def _user(app, last, uid, role, rnd, ctx, t0, deadline, think, samples):
+    mix = AFFILIATE_MIX if role == "affiliate" else ADMIN_MIX
+    names, cw = [m[0] for m in mix], list(accumulate(m[1] for m in mix))
+    client = app.test_client()
+    with client.session_transaction() as s:      # جلسة جاهزة: الدخول (scrypt + حد المحاولات) ليس جزءًا من القياس
+        s["user_id"], s["role"] = uid, role
+    while time.perf_counter() < deadline:
+        name = rnd.choices(names, cum_weights=cw)[0]
+        method, path, form = _request(name, rnd, ctx)
+        last.n = last.db = None
+        t = time.perf_counter()
+        resp = client.open(path, method=method, data=form)
+        resp.get_data(); resp.close()
+        dt = time.perf_counter() - t
+        samples.append((name, resp.status_code, dt * 1000, last.n, (last.db or 0) * 1000, t - t0))
+        if method == "POST":
+            # المتصفح يتبع التحويل فتُستهلك رسالة flash هناك؛ هنا نحذفها كي لا تكبر الجلسة
+            with client.session_transaction() as s: s.pop("_flashes", None)
+        if think: time.sleep(rnd.expovariate(1 / think))
+
+
+def worker(spec, barrier=None, out=None):
+    # عملية واحدة: تستورد app_pg (على مخطط dz_bench) وتشغّل مستخدميها في خيوط
+    os.environ.update(DATABASE_URL=spec["url"], CLOUDINARY_URL="", METRICS_DIR=spec["metrics_dir"],
+                      IMAGE_WORKER_THREADS="0", IMAGE_GC_INTERVAL_HOURS="0")
+    os.environ.setdefault("DB_POOL_MAX", str(len(spec["users"])))              # اتصال لكل خيط (مثل gthread)
+    os.environ.setdefault("DB_POOL_MAX_WAITING", str(2 * len(spec["users"])))
+    import app_pg
+    from flask import g
+    app, last = app_pg.app, threading.local()
+
+    @app.teardown_request
+    def _bench_queries(exc):
+        last.n, last.db = g.get("_db_n", 0), g.get("_db_time", 0.0)
+
+    ctx = dict(spec["ctx"], withdraw_min=app_pg.WITHDRAW_MIN)
+    if barrier is not None: barrier.wait()
+    t0 = time.perf_counter()
+    deadline = t0 + spec["warmup"] + spec["duration"]
+    samples, threads = [], []
+    for i, (uid, role) in enumerate(spec["users"]):
+        rnd = random.Random(f"{spec['seed']}:{spec['index']}:{i}")
+        threads.append(threading.Thread(target=_user, args=(app, last, uid, role, rnd, ctx, t0, deadline, spec["think"], samples)))
+    for th in threads: th.start()
+    for th in threads: th.join()
+    samples = [s for s in samples if s[5] >= spec["warmup"]]
+    if out is not None: out.put(samples)
+    return samples
+
+
+# ===================== النتائج =====================
+def _pct(vals, p):
+    return vals[min(len(vals) - 1, max(0, math.ceil(p / 100 * len(vals)) - 1))] if vals else None
+
+
+def summarize(samples, duration):
+    out = {}
+    for name in sorted({s[0] for s in samples}) + ["total"]:
+        rows = [s for s in samples if name == "total" or s[0] == name]
+        lat = sorted(s[2] for s in rows)
+        qs = sorted(s[3] for s in rows if s[3] is not None)
+        out[name] = dict(
+            requests=len(rows), errors=sum(s[1] >= 400 for s in rows),
+            status=dict(sorted(Counter(str(s[1]) for s in rows).items())),
+            rps=round(len(rows) / duration, 2),
+            latency_ms=dict(p50=_pct(lat, 50), p95=_pct(lat, 95), p99=_pct(lat, 99),
+                            mean=sum(lat) / len(lat), max=lat[-1]),
+            queries=dict(mean=sum(qs) / len(qs), p95=_pct(qs, 95), max=qs[-1]) if qs else None,
+            db_ms_mean=sum(s[4] for s in rows) / len(rows))
+    return out
+
+
+def print_summary(routes):
+    print(f"{'':28s} {'req':>7s} {'err':>5s} {'rps':>8s} {'p50':>8s} {'p95':>8s} {'p99':>8s} {'q/req':>6s} {'db ms':>7s}")
+    for name, r in routes.items():
+        lat, q = r["latency_ms"], r["queries"] or {}
+        print(f"{name:28s} {r['requests']:7d} {r['errors']:5d} {r['rps']:8.1f} {lat['p50']:8.1f} {lat['p95']:8.1f} "
+              f"{lat['p99']:8.1f} {q.get('mean', 0):6.1f} {r['db_ms_mean']:7.1f}")
+
+
+def _git():
+    try:
+        sha = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return sha, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+# ما يكتبه التشغيل يُحذف (الطلبيات عبر triggers تُعيد order_rollups/order_totals) ثم تُعاد أرصدة المتأثرين
+CLEANUP_SQL = [
+    """CREATE TEMP TABLE bench_touched ON COMMIT DROP AS
+       SELECT DISTINCT affiliate_id FROM ledger_entries WHERE id>%(ledger)s""",
+    "DELETE FROM ledger_entries WHERE id>%(ledger)s",
+    "DELETE FROM withdrawals WHERE id>%(withdrawals)s",
+    "DELETE FROM orders WHERE id>%(orders)s",
+    """UPDATE affiliate_balances b SET balance=(SELECT COALESCE(SUM(amount),0) FROM ledger_entries l WHERE l.affiliate_id=b.affiliate_id)
+       WHERE affiliate_id IN (SELECT affiliate_id FROM bench_touched)""",
+]
+MARKS_SQL = """SELECT (SELECT COALESCE(MAX(id),0) FROM orders) AS orders,
+                      (SELECT COALESCE(MAX(id),0) FROM withdrawals) AS withdrawals,
+                      (SELECT COALESCE(MAX(id),0) FROM ledger_entries) AS ledger"""
+
+
+def run(url, users, admins, procs, duration, warmup, think, seed_value, out_path):
+    rnd = random.Random(seed_value)
+    with psycopg.connect(url, row_factory=psycopg.rows.dict_row) as conn:
+        data = dataset(conn)
+        weights = conn.execute("""SELECT affiliate_id, COUNT(*) AS n FROM orders o JOIN users u ON u.id=o.affiliate_id
+                                  WHERE u.approved GROUP BY affiliate_id ORDER BY affiliate_id""").fetchall()
+        admin_id = conn.execute("SELECT id FROM users WHERE role='admin' ORDER BY id LIMIT 1").fetchone()["id"]
+        ctx = dict(categories=[r["id"] for r in conn.execute("SELECT id FROM categories ORDER BY id")],
+                   hot_products=[r["product_id"] for r in conn.execute("SELECT product_id FROM orders ORDER BY id DESC LIMIT 5000")],
+                   max_product=conn.execute("SELECT MAX(id) AS m FROM products").fetchone()["m"],
+                   max_order=conn.execute("SELECT MAX(id) AS m FROM orders").fetchone()["m"])
+        marks = conn.execute(MARKS_SQL).fetchone()
+        pg_version = conn.execute("SHOW server_version").fetchone()["server_version"]
+    # المسوّقون الأنشط يستعملون التطبيق أكثر: الاختيار بوزن عدد طلبياتهم
+    who = [(aid, "affiliate") for aid in rnd.choices([w["affiliate_id"] for w in weights], weights=[w["n"] for w in weights], k=users)]
+    who += [(admin_id, "admin")] * admins
+    rnd.shuffle(who)
+    metrics_dir = tempfile.mkdtemp(prefix="dzbench-metrics-")
+    specs = [dict(url=url, users=who[i::procs], ctx=ctx, warmup=warmup, duration=duration, think=think, seed=seed_value,
+                  index=i, metrics_dir=metrics_dir) for i in range(procs)]
+    started = datetime.now(timezone.utc)
+    print(f"{users} مسوّق + {admins} أدمن، {procs} عملية، {warmup:.0f}s إحماء + {duration:.0f}s قياس ...", flush=True)
+    try:
+        if procs == 1:
+            samples = worker(specs[0])
+        else:
+            # spawn: كل عملية تستورد app_pg من جديد (مسبح اتصالات وكاش خاص بها) كما يفعل gunicorn
+            mp = multiprocessing.get_context("spawn")
+            barrier, out = mp.Barrier(procs), mp.Queue()
+            ps = [mp.Process(target=worker, args=(s, barrier, out)) for s in specs]
+            for p in ps: p.start()
+            samples = [s for _ in ps for s in out.get(timeout=warmup + duration + 600)]
+            for p in ps: p.join()
+    finally:
+        with psycopg.connect(url) as conn:
+            for q in CLEANUP_SQL: conn.execute(q, marks)
+    sha, dirty = _git()
+    result = dict(commit=sha, dirty=dirty, started=started.isoformat(timespec="seconds"),
+                  python=platform.python_version(), postgres=pg_version, dataset=data,
+                  settings=dict(users=users, admins=admins, procs=procs, duration=duration, warmup=warmup, think=think, seed=seed_value),
+                  routes=summarize(samples, duration) if samples else {})
+    if not samples:
+        sys.exit("لا طلبات مقاسة (المدة قصيرة جدًا؟)")
+    print_summary(result["routes"])
+    if not out_path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out_path = os.path.join(RESULTS_DIR, f"{started:%Y%m%d-%H%M%S}-{(sha or 'nogit')[:8]}{'-dirty' if dirty else ''}.json")
+    with open(out_path, "w", encoding="utf-8") as f: json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"=> {out_path}")
+
+
+def compare(old_path, new_path):
+    with open(old_path, encoding="utf-8") as f: old = json.load(f)
+    with open(new_path, encoding="utf-8") as f: new = json.load(f)
+    for r in (old, new):
+        print(f"{r['commit'] and r['commit'][:8]}{'-dirty' if r['dirty'] else ''}  {r['started']}  {r['settings']}")
+    if old["dataset"] != new["dataset"] or old["settings"] != new["settings"]:
+        print("تحذير: بيانات أو إعدادات مختلفة بين التشغيلين")
+    delta = lambda a, b: f"{b:9.1f} ({(b - a) / a * 100:+5.0f}%)" if a else f"{b:9.1f}"
+    print(f"{'':28s} {'rps':>17s} {'p50':>17s} {'p95':>17s} {'p99':>17s} {'q/req':>7s}")
+    for name in new["routes"]:
+        a, b = old["routes"].get(name), new["routes"][name]
+        if not a:
+            print(f"{name:28s} (جديد)"); continue
+        qa, qb = (a["queries"] or {}).get("mean", 0), (b["queries"] or {}).get("mean", 0)
+        print(f"{name:28s} {delta(a['rps'], b['rps'])} " + " ".join(delta(a["latency_ms"][p], b["latency_ms"][p]) for p in ("p50", "p95", "p99"))
+              + f" {qa:.1f}->{qb:.1f}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="قياس أداء app_pg على بيانات اصطناعية")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    s = sub.add_parser("seed", help="توليد البيانات في مخطط dz_bench (يحذف السابق)")
+    s.add_argument("--products", type=int, default=50000)
+    s.add_argument("--affiliates", type=int, default=500)
+    s.add_argument("--orders", type=int, default=5000000)
+    s.add_argument("--withdrawals", type=int, default=20000)
+    s.add_argument("--categories", type=int, default=40)
+    s.add_argument("--days", type=int, default=365, help="مدى تواريخ الطلبيات")
+    s.add_argument("--seed", type=int, default=1)
+    r = sub.add_parser("run", help="تشغيل الحمل وحفظ النتائج")
+    r.add_argument("--users", type=int, default=32, help="مسوّقون متزامنون")
+    r.add_argument("--admins", type=int, default=1)
+    r.add_argument("--procs", type=int, default=1, help="عمليات (كعمال gunicorn)")
+    r.add_argument("--duration", type=float, default=60, help="ثواني القياس")
+    r.add_argument("--warmup", type=float, default=10, help="ثواني إحماء لا تُحسب")
+    r.add_argument("--think", type=float, default=0, help="متوسط الانتظار بين طلبات المستخدم (ثواني؛ 0 = بلا توقف)")
+    r.add_argument("--seed", type=int, default=1)
+    r.add_argument("--out", help=f"ملف JSON (افتراضيًا {RESULTS_DIR}/<تاريخ>-<commit>.json)")
+    c = sub.add_parser("compare", help="مقارنة ملفي نتائج")
+    c.add_argument("old")
+    c.add_argument("new")
+    a = ap.parse_args()
+    if a.cmd == "seed":
+        seed(bench_url(), a.products, a.affiliates, a.orders, a.withdrawals, a.categories, a.days, a.seed)
+    elif a.cmd == "run":
+        run(bench_url(), a.users, a.admins, max(1, a.procs), a.duration, a.warmup, a.think, a.seed, a.out)
+    else:
+        compare(a.old, a.new)
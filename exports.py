@@ -0,0 +1,124 @@
+# exports.py — تصدير جداول كبيرة بالتدفق (CSV و XLSX) دون تحميل الملف كاملًا في الذاكرة
+# - المدخل: عناوين الأعمدة + مكرِّر صفوف (مؤشر على الخادم)؛ المخرج: مولّد bytes يُرسل مباشرة للمتصفح
+# - XLSX = ملف zip: نكتبه إلى مجرى غير قابل للبحث فيضع zipfile أطوال الأجزاء بعد بياناتها (data descriptor)
+
+import csv
+import io
+import re
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+CHUNK_ROWS = 500        # صفوف بين كل دفعة مُرسلة
+
+# خلية تبدأ بهذه الرموز يفسرها Excel كمعادلة (اسم زبون "=HYPERLINK(...)")
+_FORMULA = ("=", "+", "-", "@", "\t", "\r")
+_XML_ILLEGAL = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _text(v):
+    if v is None: return ""
+    if isinstance(v, datetime): return v.strftime("%Y-%m-%d %H:%M")
+    if isinstance(v, date): return v.isoformat()
+    return str(v)
+
+
+def _csv_cell(v):
+    if isinstance(v, (int, float, Decimal)) and not isinstance(v, bool): return v
+    s = _text(v)
+    return "'" + s if s.startswith(_FORMULA) else s
+
+
+def csv_stream(header, rows):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    buf.write("\ufeff")                                  # BOM: Excel يقرأ العربية كـ UTF-8
+    w.writerow(header)
+    for i, row in enumerate(rows, 1):
+        w.writerow([_csv_cell(v) for v in row])
+        if i % CHUNK_ROWS == 0:
+            yield buf.getvalue().encode("utf-8"); buf.seek(0); buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+
+class _Sink:
+    # ملف للكتابة فقط بلا tell/seek: zipfile يكتب بالتدفق، ونفرغ ما تجمع بعد كل دفعة
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, b):
+        self.buf += b
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        out = bytes(self.buf); self.buf.clear()
+        return out
+
+
+def _col(n):
+    # 0 => A, 26 => AA
+    s = ""
+    n += 1
+    while n:
+        n, r = divmod(n - 1, 26)
+        s = chr(65 + r) + s
+    return s
+
+
+def _xlsx_row(r, values):
+    cells = []
+    for c, v in enumerate(values):
+        ref = f"{_col(c)}{r}"
+        if isinstance(v, (int, float, Decimal)) and not isinstance(v, bool):
+            cells.append(f'<c r="{ref}"><v>{v}</v></c>')
+        elif v is not None and v != "":
+            s = escape(_XML_ILLEGAL.sub("", _text(v)))
+            cells.append(f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{s}</t></is></c>')
+    return f'<row r="{r}">{"".join(cells)}</row>'
+
+
+_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+</Types>"""
+_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="{name}" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+</Relationships>"""
+_SHEET_HEAD = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<sheetViews><sheetView workbookViewId="0" rightToLeft="1"><pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/></sheetView></sheetViews>
+<sheetData>"""
+_SHEET_TAIL = "</sheetData></worksheet>"
+
+
+def xlsx_stream(header, rows, sheet="Sheet1"):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        zf.writestr("_rels/.rels", _RELS)
+        zf.writestr("xl/workbook.xml", _WORKBOOK.format(name=escape(sheet[:31])))
+        zf.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS)
+        with zf.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as ws:
+            ws.write((_SHEET_HEAD + _xlsx_row(1, header)).encode("utf-8"))
+            for i, row in enumerate(rows, 2):
+                ws.write(_xlsx_row(i, row).encode("utf-8"))
+                if i % CHUNK_ROWS == 0:
+                    yield sink.drain()
+            ws.write(_SHEET_TAIL.encode("utf-8"))
+    yield sink.drain()
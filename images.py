@@ -0,0 +1,154 @@
+# images.py — نسخ مشتقة من صور المنتجات (مصغّرة / بطاقة / تفاصيل) بصيغتي WebP و JPEG
+# - محليًا: تُولَّد عند الرفع في static/uploads/_v/ بأسماء ثابتة مشتقة من اسم الأصل (لا حاجة لتخزينها في القاعدة)
+# - Cloudinary: لا ملفات؛ نفس الواجهة تعيد روابط تحويل (c_fill/w_/f_auto) ويتكفل Cloudinary بالصيغة وحذف EXIF
+# - كل النسخ بدون EXIF (بعد تدوير الصورة حسب اتجاه الكاميرا)
+
+import os
+import re
+import threading
+import time
+
+from PIL import Image, ImageOps
+
+# الاسم: (العرض، الارتفاع، cover=قص لملء المربع | fit=تصغير مع الحفاظ على النسبة)
+SIZES = {
+    "thumb":  (160, 160, "cover"),
+    "card":   (480, 480, "cover"),
+    "detail": (1200, 1200, "fit"),
+}
+# أحجام بنفس النسبة (مربعة) تصلح معًا في srcset
+SRCSET = {"thumb": ("thumb", "card"), "card": ("thumb", "card"), "detail": ("detail",)}
+FORMATS = {"webp": dict(format="WEBP", quality=80, method=4), "jpg": dict(format="JPEG", quality=82, optimize=True, progressive=True)}
+RASTER_EXT = {"png", "jpg", "jpeg", "webp", "gif"}
+
+VARIANT_DIR = os.path.join("static", "uploads", "_v")
+
+
+def _local_path(url_or_path):
+    # "/static/uploads/x.jpg" أو "static/uploads/x.jpg" => مسار نسبي على القرص؛ غير ذلك None
+    s = (url_or_path or "").strip()
+    if s.startswith("/"): s = s[1:]
+    return s if s.startswith("static/") else None
+
+
+def is_remote(url_or_path):
+    s = (url_or_path or "").strip()
+    return s.startswith("http://") or s.startswith("https://")
+
+
+def image_key(url_or_path):
+    # مفتاح التخزين: اسم الملف بلا امتداد (محلي) أو public_id (Cloudinary)؛ None لغير ذلك (placeholder، رابط خارجي)
+    if is_remote(url_or_path):
+        if "/upload/" not in url_or_path: return None
+        tail = re.sub(r"^v\d+/", "", url_or_path.split("/upload/", 1)[1])
+        return os.path.splitext(tail)[0]
+    path = _local_path(url_or_path)
+    if not path or os.path.dirname(path).replace("\\", "/") != "static/uploads": return None
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def variant_key(name):
+    # "<stem>.card.webp" => stem
+    return name.rsplit(".", 2)[0]
+
+
+def variant_path(src, size, fmt):
+    stem = os.path.splitext(os.path.basename(src))[0]
+    return os.path.join(VARIANT_DIR, f"{stem}.{size}.{fmt}")
+
+
+def _render(im, size):
+    w, h, mode = SIZES[size]
+    if mode == "cover":
+        return ImageOps.fit(im, (w, h), Image.LANCZOS)
+    out = im.copy(); out.thumbnail((w, h), Image.LANCZOS)
+    return out
+
+
+def _flatten(im):
+    # JPEG بلا شفافية: الخلفية الشفافة تصبح بيضاء بدل السوداء
+    if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+        im = im.convert("RGBA")
+        bg = Image.new("RGB", im.size, (255, 255, 255)); bg.paste(im, mask=im.getchannel("A"))
+        return bg
+    return im.convert("RGB")
+
+
+def make_variants(src, force=False):
+    # src: مسار محلي للأصل. يعيد عدد الملفات المكتوبة. "detail.jpg" يُكتب أخيرًا => وجوده يعني اكتمال الكل
+    path = _local_path(src) or src
+    if os.path.splitext(path)[1].lower().lstrip(".") not in RASTER_EXT or not os.path.isfile(path):
+        return 0
+    if not force and os.path.exists(variant_path(path, "detail", "jpg")):
+        return 0
+    os.makedirs(VARIANT_DIR, exist_ok=True)
+    written = 0
+    with Image.open(path) as im:
+        im = ImageOps.exif_transpose(im)                  # يطبّق الاتجاه ثم نحفظ بدون exif
+        rgb = _flatten(im)
+        for size in SIZES:
+            out = _render(rgb, size)
+            for fmt, opts in FORMATS.items():
+                dst = variant_path(path, size, fmt)
+                tmp = f"{dst}.{os.getpid()}-{threading.get_ident()}.tmp"   # نفس الصورة قد تُعالج في خيطين
+                out.save(tmp, **opts)                     # لا نمرر exif= => بلا بيانات وصفية
+                os.replace(tmp, dst)                      # ذري: القارئ لا يرى ملفًا نصف مكتوب
+                written += 1
+    _exists.pop(path, None)
+    return written
+
+
+def strip_exif(path):
+    # الأصل يبقى للتنزيل؛ نحذف EXIF (قد يحوي موقع GPS) فقط إن وُجد، بإعادة حفظ بجودة عالية
+    with Image.open(path) as im:
+        if not im.getexif() or im.format not in ("JPEG", "WEBP"):
+            return False
+        fmt = im.format
+        clean = ImageOps.exif_transpose(im)
+        clean.save(path, format=fmt, quality=95)
+    return True
+
+
+# وجود النسخ على القرص: الإيجابي يُحفظ دائمًا، السلبي لمدة قصيرة (قد يكملها backfill من عملية أخرى)
+_exists = {}
+_exists_lock = threading.Lock()
+MISSING_TTL = 30.0
+
+
+def has_variants(path):
+    now = time.monotonic()
+    with _exists_lock:
+        hit = _exists.get(path)
+    if hit is True or (hit is not None and hit > now):
+        return hit is True
+    ok = os.path.exists(variant_path(path, "detail", "jpg"))
+    with _exists_lock:
+        _exists[path] = True if ok else now + MISSING_TTL
+    return ok
+
+
+def cloudinary_url(url, size, fmt="auto"):
+    # إدراج التحويل بعد /upload/ ؛ f_auto => WebP/AVIF حسب المتصفح، والتحويل يحذف البيانات الوصفية
+    if "/upload/" not in url:
+        return url
+    w, h, mode = SIZES[size]
+    crop = "c_fill,g_auto" if mode == "cover" else "c_limit"
+    return url.replace("/upload/", f"/upload/{crop},w_{w},h_{h},f_{fmt},q_auto/", 1)
+
+
+def variant_url(url_or_path, size, fmt="jpg"):
+    # رابط النسخة أو None إن لم تتوفر (صورة قديمة بدون backfill، svg، رابط خارجي آخر)
+    if is_remote(url_or_path):
+        return cloudinary_url(url_or_path, size, "auto" if fmt == "webp" else fmt) if "/upload/" in url_or_path else None
+    path = _local_path(url_or_path)
+    if not path or not has_variants(path):
+        return None
+    return "/" + variant_path(path, size, fmt).replace("\\", "/")
+
+
+def srcset(url_or_path, size, fmt="jpg"):
+    parts = []
+    for s in SRCSET[size]:
+        u = variant_url(url_or_path, s, fmt)
+        if u: parts.append(f"{u} {SIZES[s][0]}w")
+    return ", ".join(parts)
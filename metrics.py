@@ -0,0 +1,122 @@
+# metrics.py — عدادات وهيستوغرامات بصيغة Prometheus (نص)، مجمّعة عبر عمال gunicorn
+# - كل عامل يحفظ قيمه في الذاكرة ويكتب لقطة JSON إلى <dir>/<pid>-<run>.json (مرة كل flush_interval على الأكثر،
+#   وعند الخروج: atexit أو worker_exit في gunicorn). run عشوائي لكل عملية => pid أُعيد استعماله لا يكتب فوق لقطة عامل سابق
+# - render() يجمع لقطات كل العمال؛ لقطة عامل انتهى تبقى (العدادات تراكمية) => امسح المجلد عند كل نشر
+# - بلا مكتبات خارجية؛ آمن للخيوط
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt(v):
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+def _labels(pairs, extra=()):
+    pairs = list(pairs) + list(extra)
+    if not pairs: return ""
+    esc = lambda s: s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+
+class Registry:
+    def __init__(self, directory, flush_interval=1.0):
+        self.dir, self.flush_interval = directory, flush_interval
+        self._meta = {}          # name => (type, help, buckets)
+        self._values = {}        # (name, labels) => رقم (counter) أو [عدّ كل حد..., sum, count] (histogram)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._run = os.urandom(4).hex()
+        self._flushed = 0.0
+
+    def counter(self, name, help):
+        self._meta[name] = ("counter", help, None)
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        self._meta[name] = ("histogram", help, tuple(buckets))
+
+    def _fork_check(self):
+        # عامل جديد بعد fork: لا يرث أرقام العملية الأم
+        if self._pid != os.getpid():
+            self._values.clear(); self._pid = os.getpid(); self._run = os.urandom(4).hex(); self._flushed = 0.0
+
+    def inc(self, name, v=1, **labels):
+        k = (name, _key(labels))
+        with self._lock:
+            self._fork_check()
+            self._values[k] = self._values.get(k, 0) + v
+
+    def observe(self, name, v, **labels):
+        buckets = self._meta[name][2]
+        k = (name, _key(labels))
+        with self._lock:
+            self._fork_check()
+            h = self._values.get(k)
+            if h is None: h = self._values[k] = [0] * (len(buckets) + 2)
+            for i, le in enumerate(buckets):
+                if v <= le: h[i] += 1; break
+            h[-2] += v; h[-1] += 1
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._flushed < self.flush_interval: return
+        with self._lock:
+            self._fork_check()
+            self._flushed = now
+            data = [[n, list(map(list, l)), v] for (n, l), v in self._values.items()]
+            name = f"{self._pid}-{self._run}.json"
+        if not data: return
+        os.makedirs(self.dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f: json.dump(data, f)
+        os.replace(tmp, os.path.join(self.dir, name))
+
+    def _collect(self):
+        self.flush(force=True)
+        total = {}
+        try: files = os.listdir(self.dir)
+        except FileNotFoundError: return total   # لا لقطات بعد: مجلد جديد أو مُسح عند النشر وهذا العامل بلا أرقام
+        for fn in files:
+            if not fn.endswith(".json"): continue
+            try:
+                with open(os.path.join(self.dir, fn)) as f: data = json.load(f)
+            except (OSError, ValueError):
+                continue                         # لقطة تُكتب الآن أو تالفة: نتجاوزها هذه المرة
+            for name, labels, v in data:
+                if name not in self._meta: continue
+                k = (name, tuple(map(tuple, labels)))
+                if isinstance(v, list):
+                    cur = total.setdefault(k, [0] * len(v))
+                    for i, x in enumerate(v): cur[i] += x
+                else:
+                    total[k] = total.get(k, 0) + v
+        return total
+
+    def render(self):
+        total = self._collect()
+        out = []
+        for name, (kind, help, buckets) in sorted(self._meta.items()):
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            for (n, labels), v in sorted(total.items()):
+                if n != name: continue
+                if kind == "counter":
+                    out.append(f"{name}{_labels(labels)} {_fmt(v)}"); continue
+                acc = 0
+                for le, c in zip(buckets, v):
+                    acc += c
+                    out.append(f"{name}_bucket{_labels(labels, [('le', _fmt(le))])} {acc}")
+                out.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {v[-1]}")
+                out.append(f"{name}_sum{_labels(labels)} {_fmt(v[-2])}")
+                out.append(f"{name}_count{_labels(labels)} {v[-1]}")
+        return "\n".join(out) + "\n"
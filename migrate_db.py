@@ -1,88 +1,776 @@
-import sqlite3
-
-DB = "app.db"
-conn = sqlite3.connect(DB)
-c = conn.cursor()
-
-def table_cols(table):
-    return [r[1] for r in c.execute(f"PRAGMA table_info({table})").fetchall()]
-
-def ensure_column(table, col_def):
-    # col_def example: "image_path TEXT"
-    col = col_def.split()[0]
-    if col not in table_cols(table):
-        c.execute(f"ALTER TABLE {table} ADD COLUMN {col_def}")
-
-# 1) products: إضافة image_path ونسخ من image_url إن موجودة
-ensure_column('products', 'image_path TEXT')
-cols_products = table_cols('products')
-if 'image_url' in cols_products:
-    c.execute("UPDATE products SET image_path=image_url WHERE (image_path IS NULL OR image_path='') AND image_url IS NOT NULL")
-
-# 2) users: إضافة approved إن ناقص
-ensure_column('users', 'approved INTEGER NOT NULL DEFAULT 0')
-
-# 3) product_images: تحويل image_url -> image_path أو إنشاء الجدول إن ناقص
-try:
-    cols_pi = table_cols('product_images')
-except sqlite3.OperationalError:
-    cols_pi = []
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS product_images(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_id INTEGER NOT NULL,
-            image_path TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY(product_id) REFERENCES products(id)
-        )
-    """)
-
-if cols_pi:
-    if 'image_path' not in cols_pi and 'image_url' in cols_pi:
-        # نعيد تسمية الجدول وننشئه من جديد بالأعمدة الصحيحة ثم ننسخ البيانات
-        c.execute("ALTER TABLE product_images RENAME TO product_images_old")
-        c.execute("""
-            CREATE TABLE product_images(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                product_id INTEGER NOT NULL,
-                image_path TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY(product_id) REFERENCES products(id)
-            )
-        """)
-        c.execute("""
-            INSERT INTO product_images(product_id,image_path,created_at)
-            SELECT product_id,image_url,created_at FROM product_images_old
-        """)
-        c.execute("DROP TABLE product_images_old")
-    elif 'image_path' not in cols_pi and 'image_url' not in cols_pi:
-        # ماكان لا image_path لا image_url -> ننشئه صحيح
-        c.execute("DROP TABLE IF EXISTS product_images")
-        c.execute("""
-            CREATE TABLE product_images(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                product_id INTEGER NOT NULL,
-                image_path TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY(product_id) REFERENCES products(id)
-            )
-        """)
-
-conn.commit()
-conn.close()
-print("Migration done.")
-
-
-@app.errorhandler(404)
-def _e404(e):
-    try:
-        return render_template("error.html", message="404 - غير موجود", status=404), 404
-    except Exception:
-        return "404 - غير موجود", 404
-
-@app.errorhandler(403)
-def _e403(e):
-    try:
-        return render_template("error.html", message="403 - ممنوع", status=403), 403
-    except Exception:
-        return "403 - ممنوع", 403
+# migrate_db.py — ترحيلات مرقّمة لقاعدة PostgreSQL
+# التطبيق يشغّلها تلقائيًا عند الإقلاع (init_db)، ويمكن تشغيلها يدويًا:
+#   py migrate_db.py                 تطبيق الترحيلات الناقصة
+#   py migrate_db.py status          عرض الترحيلات المطبّقة
+#   py migrate_db.py check-indexes   التحقق أن كل استعلامات app_pg تستعمل فهارس (على بيانات تجريبية)
+#
+# - كل ترحيل يُسجَّل في جدول schema_migrations ولا يُعاد تطبيقه.
+# - التشغيل تحت pg_advisory_lock حتى لا يتسابق عمال gunicorn عند الإقلاع.
+# - الترحيل transactional=False يُنفَّذ خطوة بخطوة خارج معاملة (مثل CREATE INDEX CONCURRENTLY).
+
+import os
+import sys
+from collections import namedtuple
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+
+import psycopg
+from psycopg.conninfo import make_conninfo
+from dotenv import load_dotenv
+
+import queries as q
+
+Migration = namedtuple("Migration", "version name steps transactional", defaults=(True,))
+
+LOCK_KEY = 0x647A73686F70   # "dzshop"
+MIN_SERVER_VERSION = 110000  # EXECUTE FUNCTION في triggers (PostgreSQL 11)
+
+
+def index(name, table, cols, where=None, unique=False, using=None):
+    # خطوة إنشاء فهرس بدون قفل الجدول؛ إن فشل بناء سابق وترك فهرسًا INVALID نحذفه ونعيد
+    def step(conn):
+        row = conn.execute("""SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid=c.oid
+                              WHERE c.relname=%s AND c.relnamespace=current_schema()::regnamespace""", (name,)).fetchone()
+        if row and row[0]:
+            return
+        if row:
+            conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        conn.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY {name} ON {table}"
+                     + (f" USING {using}" if using else "") + f"({cols})"
+                     + (f" WHERE {where}" if where else ""))
+    step.__name__ = f"index:{name}"
+    return step
+
+
+def trigger(name, table, spec):
+    # بديل CREATE OR REPLACE TRIGGER (PostgreSQL 14+ فقط): حذف ثم إنشاء داخل نفس المعاملة
+    def step(conn):
+        conn.execute(f"DROP TRIGGER IF EXISTS {name} ON {table}")
+        conn.execute(f"CREATE TRIGGER {name} {spec}")
+    step.__name__ = f"trigger:{name}"
+    return step
+
+
+def _has_column(conn, table, col):
+    return conn.execute("""SELECT 1 FROM information_schema.columns
+                           WHERE table_schema=current_schema() AND table_name=%s AND column_name=%s""", (table, col)).fetchone()
+
+
+def _column_type(conn, table, col):
+    row = conn.execute("""SELECT data_type FROM information_schema.columns
+                          WHERE table_schema=current_schema() AND table_name=%s AND column_name=%s""", (table, col)).fetchone()
+    return row[0] if row else None
+
+
+def created_at_to_timestamptz(table):
+    # جداول صغيرة: تحويل مباشر (إعادة كتابة قصيرة للجدول)
+    def step(conn):
+        if _column_type(conn, table, "created_at") == "text":
+            conn.execute(f"""ALTER TABLE {table}
+                               ALTER COLUMN created_at TYPE timestamptz USING created_at::timestamptz,
+                               ALTER COLUMN created_at SET DEFAULT now()""")
+    step.__name__ = f"timestamptz:{table}"
+    return step
+
+
+BACKFILL_BATCH = int(os.getenv("MIGRATE_BATCH", "20000"))
+
+# مسار صورة مخزنة حسب المحتوى: .../<sha256>.<ext> (المجموعة الأولى = البصمة)
+BLOB_RE = r"/([0-9a-f]{64})\.[a-z0-9]+$"
+
+
+def _validate_not_null(conn, table, col):
+    # NOT NULL عبر CHECK ... NOT VALID ثم VALIDATE (بدون قفل حصري أثناء الفحص)
+    name = f"{table}_{col}_nn"
+    if not conn.execute("SELECT 1 FROM pg_constraint WHERE conname=%s", (name,)).fetchone():
+        conn.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} CHECK ({col} IS NOT NULL) NOT VALID")
+    conn.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}")
+
+
+def _set_not_null(conn, table, col):
+    # SET NOT NULL يستفيد من CHECK المُتحقق منه فلا يمسح الجدول؛ ثم لا حاجة للقيد
+    conn.execute(f"ALTER TABLE {table} ALTER COLUMN {col} SET NOT NULL")
+    conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_{col}_nn")
+
+
+def orders_created_at_online(conn):
+    # orders قد يكون كبيرًا: عمود جديد + تعبئة على دفعات (كل دفعة commit مستقل) ثم تبديل سريع
+    # قابل للاستئناف: كل مرحلة تتحقق من حالتها قبل التنفيذ
+    if _column_type(conn, "orders", "created_at") == "timestamp with time zone" and not _has_column(conn, "orders", "created_at_tz"):
+        return
+    conn.execute("ALTER TABLE orders ADD COLUMN IF NOT EXISTS created_at_tz timestamptz")
+    # منفصلًا عن ADD COLUMN: القيمة الافتراضية تخص الصفوف الجديدة فقط (الكود القديم ما زال يكتب created_at نصًا)
+    conn.execute("ALTER TABLE orders ALTER COLUMN created_at_tz SET DEFAULT now()")
+    lo, hi = conn.execute("SELECT COALESCE(MIN(id),0), COALESCE(MAX(id),0) FROM orders").fetchone()
+    for start in range(lo, hi + 1, BACKFILL_BATCH):
+        conn.execute("""UPDATE orders SET created_at_tz=created_at::timestamptz
+                        WHERE id>=%s AND id<%s AND created_at_tz IS NULL""", (start, start + BACKFILL_BATCH))
+    _validate_not_null(conn, "orders", "created_at_tz")
+    with conn.transaction():
+        conn.execute("LOCK TABLE orders IN ACCESS EXCLUSIVE MODE")
+        _set_not_null(conn, "orders", "created_at_tz")
+        conn.execute("ALTER TABLE orders DROP COLUMN created_at")                    # يحذف أيضًا الفهرس القديم على النص
+        conn.execute("ALTER TABLE orders RENAME COLUMN created_at_tz TO created_at")
+
+
+def orders_snapshot_online(conn):
+    # العمولة والسعر وقت إنشاء الطلب: تعديل المنتج لاحقًا لا يغيّر أرباحًا سابقة
+    conn.execute("ALTER TABLE orders ADD COLUMN IF NOT EXISTS commission NUMERIC, ADD COLUMN IF NOT EXISTS price NUMERIC")
+    # شبكة أمان: أي إدراج لا يمرّر اللقطة (كود قديم أثناء النشر) تُملأ من المنتج
+    conn.execute("""CREATE OR REPLACE FUNCTION orders_snapshot() RETURNS trigger LANGUAGE plpgsql AS $$
+                    BEGIN
+                      SELECT COALESCE(NEW.commission, p.commission), COALESCE(NEW.price, p.price)
+                        INTO NEW.commission, NEW.price FROM products p WHERE p.id=NEW.product_id;
+                      RETURN NEW;
+                    END $$""")
+    conn.execute("DROP TRIGGER IF EXISTS orders_snapshot ON orders")
+    conn.execute("""CREATE TRIGGER orders_snapshot BEFORE INSERT ON orders
+                    FOR EACH ROW WHEN (NEW.commission IS NULL OR NEW.price IS NULL) EXECUTE FUNCTION orders_snapshot()""")
+    lo, hi = conn.execute("SELECT COALESCE(MIN(id),0), COALESCE(MAX(id),0) FROM orders WHERE commission IS NULL").fetchone()
+    for start in range(lo, hi + 1, BACKFILL_BATCH):
+        conn.execute("""UPDATE orders o SET commission=p.commission, price=p.price FROM products p
+                        WHERE p.id=o.product_id AND o.id>=%s AND o.id<%s AND o.commission IS NULL""", (start, start + BACKFILL_BATCH))
+    for col in ("commission", "price"):
+        _validate_not_null(conn, "orders", col)
+        _set_not_null(conn, "orders", col)
+
+
+def ledger_from_history(conn):
+    # دفتر الحركات يُبنى مرة واحدة من التاريخ؛ الكتابة متوقفة أثناء البناء حتى يطابق الرصيد الحركات
+    # العلاوة رصيد دائن (كان الحساب القديم يطرحها مرة ثانية مع مبلغ السحب)
+    with conn.transaction():
+        conn.execute("LOCK TABLE orders, withdrawals, bonuses IN SHARE ROW EXCLUSIVE MODE")
+        if conn.execute("SELECT 1 FROM ledger_entries LIMIT 1").fetchone():
+            return
+        conn.execute("""INSERT INTO ledger_entries(affiliate_id,kind,amount,order_id,created_at)
+                        SELECT affiliate_id,'commission',commission,id,created_at FROM orders WHERE status='delivered'""")
+        conn.execute("""INSERT INTO ledger_entries(affiliate_id,kind,amount,bonus_id,created_at)
+                        SELECT affiliate_id,'bonus',amount,id,created_at FROM bonuses""")
+        conn.execute("""INSERT INTO ledger_entries(affiliate_id,kind,amount,withdrawal_id,created_at)
+                        SELECT affiliate_id,'withdrawal',-amount,id,created_at FROM withdrawals
+                        WHERE status IN ('requested','approved')""")
+        conn.execute("""INSERT INTO affiliate_balances(affiliate_id,balance)
+                        SELECT affiliate_id, SUM(amount) FROM ledger_entries GROUP BY affiliate_id
+                        ON CONFLICT (affiliate_id) DO UPDATE SET balance=EXCLUDED.balance, updated_at=now()""")
+
+
+def _trgm_index(conn):
+    # pg_trgm من contrib (متوفر في Render وفي حزم PostgreSQL المعتادة)؛ بدونه يبقى البحث نصًا كاملًا فقط
+    if not conn.execute("SELECT 1 FROM pg_available_extensions WHERE name='pg_trgm'").fetchone():
+        print("  pg_trgm غير متوفر: البحث بدون تسامح مع الأخطاء الإملائية"); return
+    conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    index("products_name_trgm_idx", "products", "ar_normalize(name) gin_trgm_ops", using="gin")(conn)
+
+
+ROLLUP_TABLES = [
+    """CREATE TABLE IF NOT EXISTS order_rollups(
+          day DATE NOT NULL,                    -- UTC
+          affiliate_id INTEGER NOT NULL,
+          product_id INTEGER NOT NULL,
+          status TEXT NOT NULL,
+          orders BIGINT NOT NULL DEFAULT 0,
+          amount NUMERIC NOT NULL DEFAULT 0,    -- مجموع أسعار الطلبيات (اللقطة)
+          commission NUMERIC NOT NULL DEFAULT 0,
+          PRIMARY KEY (day, affiliate_id, product_id, status)
+        )""",
+    """CREATE TABLE IF NOT EXISTS order_totals(
+          status TEXT NOT NULL,
+          slot SMALLINT NOT NULL,
+          orders BIGINT NOT NULL DEFAULT 0,
+          amount NUMERIC NOT NULL DEFAULT 0,
+          commission NUMERIC NOT NULL DEFAULT 0,
+          PRIMARY KEY (status, slot)
+        )""",
+]
+
+# فرق الاستعلام (+1 للصفوف الجديدة، -1 للقديمة) ثم upsert مرتب بالمفتاح (لا deadlock بين تحديثين جماعيين)
+# أثناء التعبئة: الصفوف القديمة (id<=upto) تُحسب فقط بعد أن تمرّ عليها التعبئة (id<done)
+ROLLUP_FN = """CREATE OR REPLACE FUNCTION order_rollup_stmt() RETURNS trigger LANGUAGE plpgsql AS $$
+           DECLARE
+             src TEXT := CASE TG_OP
+               WHEN 'INSERT' THEN 'SELECT *, 1 AS n FROM new_rows'
+               WHEN 'DELETE' THEN 'SELECT *, -1 AS n FROM old_rows'
+               ELSE 'SELECT *, -1 AS n FROM old_rows UNION ALL SELECT *, 1 FROM new_rows' END;
+           BEGIN
+             EXECUTE format($q$
+               WITH d AS (SELECT x.* FROM (%s) x{backfill}),
+               r AS (
+                 INSERT INTO order_rollups AS t (day, affiliate_id, product_id, status, orders, amount, commission)
+                 SELECT (created_at AT TIME ZONE 'UTC')::date, affiliate_id, product_id, status,
+                        sum(n), sum(n*price), sum(n*commission)
+                 FROM d GROUP BY 1,2,3,4
+                 HAVING sum(n)<>0 OR sum(n*price)<>0 OR sum(n*commission)<>0 ORDER BY 1,2,3,4
+                 ON CONFLICT (day, affiliate_id, product_id, status) DO UPDATE
+                   SET orders=t.orders+EXCLUDED.orders, amount=t.amount+EXCLUDED.amount,
+                       commission=t.commission+EXCLUDED.commission)
+               INSERT INTO order_totals AS t (status, slot, orders, amount, commission)
+               SELECT status, pg_backend_pid() %% 8, sum(n), sum(n*price), sum(n*commission)
+               FROM d GROUP BY 1
+               HAVING sum(n)<>0 OR sum(n*price)<>0 OR sum(n*commission)<>0 ORDER BY 1
+               ON CONFLICT (status, slot) DO UPDATE
+                 SET orders=t.orders+EXCLUDED.orders, amount=t.amount+EXCLUDED.amount,
+                     commission=t.commission+EXCLUDED.commission$q$, src);
+             RETURN NULL;
+           END $$"""
+ROLLUP_BACKFILL_FILTER = ", order_rollups_backfill b WHERE x.id<b.done OR x.id>b.upto"
+
+ROLLUP_TRIGGERS = [
+    ("orders_rollup_ins", "AFTER INSERT ON orders REFERENCING NEW TABLE AS new_rows"),
+    ("orders_rollup_del", "AFTER DELETE ON orders REFERENCING OLD TABLE AS old_rows"),
+    ("orders_rollup_upd", "AFTER UPDATE ON orders REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+]
+
+# دفعة تعبئة: صفوف الدفعة مقفولة FOR SHARE (تعديلها ينتظر حتى commit الدفعة فقط) ثم تُضاف للتجميعات
+ROLLUP_BACKFILL_SQL = """WITH o AS (
+                           SELECT created_at, affiliate_id, product_id, status, price, commission FROM orders
+                           WHERE id>=%(lo)s AND id<%(hi)s AND id<=%(upto)s FOR SHARE),
+                         r AS (
+                           INSERT INTO order_rollups AS t (day, affiliate_id, product_id, status, orders, amount, commission)
+                           SELECT (created_at AT TIME ZONE 'UTC')::date, affiliate_id, product_id, status,
+                                  count(*), sum(price), sum(commission)
+                           FROM o GROUP BY 1,2,3,4 ORDER BY 1,2,3,4
+                           ON CONFLICT (day, affiliate_id, product_id, status) DO UPDATE
+                             SET orders=t.orders+EXCLUDED.orders, amount=t.amount+EXCLUDED.amount,
+                                 commission=t.commission+EXCLUDED.commission)
+                         INSERT INTO order_totals AS t (status, slot, orders, amount, commission)
+                         SELECT status, 0, count(*), sum(price), sum(commission) FROM o GROUP BY 1 ORDER BY 1
+                         ON CONFLICT (status, slot) DO UPDATE
+                           SET orders=t.orders+EXCLUDED.orders, amount=t.amount+EXCLUDED.amount,
+                               commission=t.commission+EXCLUDED.commission"""
+
+
+def order_rollups_online(conn):
+    # بلا إيقاف الكتابة على orders أثناء التعبئة: triggers أولًا (قفل لحظي)، ثم التاريخ على دفعات حسب id
+    # الصف الجديد (id>upto) تحسبه triggers فورًا، والقديم بعد أن تمرّ عليه دفعته => لا عدّ مزدوج ولا ناقص
+    # قابل للاستئناف: التقدم في order_rollups_backfill؛ غيابه بعد انقطاع = إعادة التعبئة من الصفر
+    with conn.transaction():
+        for ddl in ROLLUP_TABLES: conn.execute(ddl)
+        conn.execute("CREATE TABLE IF NOT EXISTS order_rollups_backfill(upto BIGINT NOT NULL, done BIGINT NOT NULL)")
+        if not conn.execute("SELECT 1 FROM order_rollups_backfill").fetchone():
+            # ينتظر المعاملات الكاتبة الجارية فقط؛ لا مسح لـ orders تحت القفل
+            conn.execute("LOCK TABLE orders IN SHARE ROW EXCLUSIVE MODE")
+            conn.execute("DELETE FROM order_rollups")
+            conn.execute("DELETE FROM order_totals")
+            conn.execute("INSERT INTO order_rollups_backfill SELECT COALESCE(MAX(id),0), 0 FROM orders")
+        conn.execute(ROLLUP_FN.format(backfill=ROLLUP_BACKFILL_FILTER))
+        for name, spec in ROLLUP_TRIGGERS:
+            trigger(name, "orders", f"{spec} FOR EACH STATEMENT EXECUTE FUNCTION order_rollup_stmt()")(conn)
+    while True:
+        try:
+            with conn.transaction():
+                upto, done = conn.execute("SELECT upto, done FROM order_rollups_backfill FOR UPDATE").fetchone()
+                if done > upto: break
+                conn.execute(ROLLUP_BACKFILL_SQL, dict(lo=done, hi=done + BACKFILL_BATCH, upto=upto))
+                conn.execute("UPDATE order_rollups_backfill SET done=%s", (done + BACKFILL_BATCH,))
+        except psycopg.errors.DeadlockDetected:
+            continue                                     # مع تحديث جماعي متزامن: الدفعة أُلغيت كاملة، نعيدها
+    with conn.transaction():
+        conn.execute("LOCK TABLE orders IN SHARE ROW EXCLUSIVE MODE")   # لا trigger جارٍ يقرأ الجدول أثناء حذفه
+        conn.execute(ROLLUP_FN.format(backfill=""))
+        conn.execute("DROP TABLE order_rollups_backfill")
+
+
+MIGRATIONS = [
+    Migration(1, "initial_schema", [
+        """CREATE TABLE IF NOT EXISTS users(
+              id SERIAL PRIMARY KEY,
+              name TEXT NOT NULL,
+              email TEXT UNIQUE NOT NULL,
+              password_hash TEXT NOT NULL,
+              role TEXT NOT NULL CHECK(role IN ('affiliate','admin')),
+              approved BOOLEAN NOT NULL DEFAULT FALSE,
+              phone TEXT,
+              created_at TEXT NOT NULL
+            )""",
+        """CREATE TABLE IF NOT EXISTS categories(
+              id SERIAL PRIMARY KEY,
+              name TEXT UNIQUE NOT NULL
+            )""",
+        """CREATE TABLE IF NOT EXISTS products(
+              id SERIAL PRIMARY KEY,
+              name TEXT NOT NULL,
+              description TEXT,
+              price NUMERIC NOT NULL,
+              commission NUMERIC NOT NULL,
+              delivery_price NUMERIC NOT NULL,
+              image_path TEXT,
+              category_id INTEGER REFERENCES categories(id),
+              delivery_mode TEXT CHECK (delivery_mode IN ('home','office')) DEFAULT 'home',
+              notes TEXT,
+              created_at TEXT NOT NULL
+            )""",
+        """CREATE TABLE IF NOT EXISTS product_images(
+              id SERIAL PRIMARY KEY,
+              product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+              image_path TEXT NOT NULL,
+              created_at TEXT NOT NULL
+            )""",
+        """CREATE TABLE IF NOT EXISTS orders(
+              id SERIAL PRIMARY KEY,
+              product_id INTEGER NOT NULL REFERENCES products(id),
+              affiliate_id INTEGER NOT NULL REFERENCES users(id),
+              customer_name TEXT NOT NULL,
+              customer_phone TEXT NOT NULL,
+              customer_address TEXT NOT NULL,
+              status TEXT NOT NULL CHECK(status IN ('pending','delivered','canceled')),
+              created_at TEXT NOT NULL
+            )""",
+        """CREATE TABLE IF NOT EXISTS withdrawals(
+              id SERIAL PRIMARY KEY,
+              affiliate_id INTEGER NOT NULL REFERENCES users(id),
+              amount NUMERIC NOT NULL,
+              method TEXT NOT NULL,
+              details TEXT NOT NULL,
+              status TEXT NOT NULL CHECK(status IN ('requested','approved','rejected')),
+              bonus NUMERIC NOT NULL DEFAULT 0,
+              created_at TEXT NOT NULL
+            )""",
+        """CREATE TABLE IF NOT EXISTS pages(
+              id SERIAL PRIMARY KEY,
+              slug TEXT UNIQUE NOT NULL,
+              title TEXT NOT NULL,
+              content TEXT NOT NULL
+            )""",
+        """CREATE TABLE IF NOT EXISTS bonuses(
+              id SERIAL PRIMARY KEY,
+              affiliate_id INTEGER NOT NULL REFERENCES users(id),
+              iso_year INTEGER NOT NULL,
+              iso_week INTEGER NOT NULL,
+              amount NUMERIC NOT NULL,
+              created_at TEXT NOT NULL,
+              UNIQUE(affiliate_id, iso_year, iso_week)
+            )""",
+    ]),
+    # فهارس مطابقة لشروط WHERE / ORDER BY في app_pg.py
+    Migration(2, "hot_query_indexes", [
+        index("users_role_approved_id_idx",      "users",          "role, approved, id DESC"),   # admin_affiliates
+        index("users_role_id_idx",               "users",          "role, id DESC"),             # admin_settings / أول أدمن
+        index("products_category_id_idx",        "products",       "category_id, id DESC"),      # affiliate_products?cat=
+        index("product_images_product_id_idx",   "product_images", "product_id, id"),            # صور المنتج
+        index("orders_affiliate_id_idx",         "orders",         "affiliate_id, id DESC"),     # affiliate_orders
+        index("orders_affiliate_status_created_idx", "orders",     "affiliate_id, status, created_at"),  # الرصيد + العلاوة
+        index("orders_status_idx",               "orders",         "status"),                    # عدّادات لوحة الأدمن
+        index("orders_product_id_idx",           "orders",         "product_id"),                # فحص FK عند حذف منتج
+        index("withdrawals_affiliate_status_idx", "withdrawals",   "affiliate_id, status"),      # الرصيد
+        index("withdrawals_status_id_idx",       "withdrawals",    "status, id DESC"),           # طلبات السحب المعلقة
+    ], transactional=False),
+    # created_at: نص ISO-8601 => timestamptz بقيمة افتراضية now() من الخادم
+    Migration(3, "created_at_timestamptz", [
+        created_at_to_timestamptz("users"),
+        created_at_to_timestamptz("products"),
+        created_at_to_timestamptz("product_images"),
+        created_at_to_timestamptz("withdrawals"),
+        created_at_to_timestamptz("bonuses"),
+        orders_created_at_online,
+        # الفهرس القديم حُذف مع العمود النصي؛ نعيد بناءه على العمود الجديد
+        index("orders_affiliate_status_created_idx", "orders", "affiliate_id, status, created_at"),
+    ], transactional=False),
+    # دفتر حركات (إضافة فقط) + رصيد مُجمّع لكل مسوّق يُحدَّث في نفس المعاملة
+    Migration(4, "affiliate_ledger", [
+        orders_snapshot_online,
+        """CREATE TABLE IF NOT EXISTS ledger_entries(
+              id BIGSERIAL PRIMARY KEY,
+              affiliate_id INTEGER NOT NULL REFERENCES users(id),
+              kind TEXT NOT NULL CHECK(kind IN ('commission','commission_reversal','bonus','withdrawal','withdrawal_reversal')),
+              amount NUMERIC NOT NULL,            -- موجب: لصالح المسوّق، سالب: عليه
+              order_id INTEGER REFERENCES orders(id),
+              withdrawal_id INTEGER REFERENCES withdrawals(id),
+              bonus_id INTEGER REFERENCES bonuses(id),
+              created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )""",
+        """CREATE TABLE IF NOT EXISTS affiliate_balances(
+              affiliate_id INTEGER PRIMARY KEY REFERENCES users(id),
+              balance NUMERIC NOT NULL DEFAULT 0,
+              updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )""",
+        index("ledger_entries_affiliate_id_idx", "ledger_entries", "affiliate_id, id DESC"),
+        ledger_from_history,
+    ], transactional=False),
+    # مهمة العلاوة الأسبوعية: الطلبيات المُوصلة في نطاق أسبوع لكل المسوّقين
+    Migration(5, "weekly_bonus_index", [
+        index("orders_delivered_created_idx", "orders", "created_at, affiliate_id", where="status='delivered'"),
+    ], transactional=False),
+    # ترقيم keyset لطلبيات المسوّق مع فلتر الحالة؛ فهرس (affiliate_id, status, created_at) لم يعد يخدم أي استعلام
+    Migration(6, "keyset_pagination_indexes", [
+        index("orders_affiliate_status_id_idx", "orders", "affiliate_id, status, id DESC"),
+        "DROP INDEX CONCURRENTLY IF EXISTS orders_affiliate_status_created_idx",
+    ], transactional=False),
+    # كاش الكتالوج في العمال: أي كتابة على هذه الجداول (من أي مصدر) ترسل NOTIFY عند الـ commit
+    Migration(7, "catalog_notify", [
+        """CREATE OR REPLACE FUNCTION catalog_notify() RETURNS trigger LANGUAGE plpgsql AS $$
+           BEGIN
+             PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);   -- مكرر في نفس المعاملة = إشعار واحد
+             RETURN NULL;
+           END $$""",
+    ] + [trigger(f"{t}_catalog_notify", t, f"""AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {t}
+             FOR EACH STATEMENT EXECUTE FUNCTION catalog_notify()""")
+         for t in ("products", "categories", "product_images", "pages")]),
+    # طابور رفع الصور (IMAGE_UPLOAD_MODE=async): صف لكل إرسال نموذج، الملفات نفسها في bytea
+    # => أي عامل على أي خادم يستطيع معالجتها، وتُحذف بعد الربط بالمنتج
+    Migration(8, "image_jobs", [
+        """CREATE TABLE IF NOT EXISTS image_jobs(
+              id BIGSERIAL PRIMARY KEY,
+              product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+              has_main BOOLEAN NOT NULL,          -- العنصر الأول هو الصورة الرئيسية
+              filenames TEXT[] NOT NULL,
+              data BYTEA[] NOT NULL,
+              attempts INTEGER NOT NULL DEFAULT 0,
+              last_error TEXT,
+              failed BOOLEAN NOT NULL DEFAULT false,
+              created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )""",
+        "CREATE INDEX IF NOT EXISTS image_jobs_pending_idx ON image_jobs(id) WHERE NOT failed",
+        "CREATE INDEX IF NOT EXISTS image_jobs_product_id_idx ON image_jobs(product_id)",
+    ]),
+    # صور مخزنة حسب المحتوى (<sha256>.<ext>): عدد المراجع من products و product_images لكل ملف
+    # triggers تُنشئ الصف عند أول مرجع وتعدّل العدد؛ الصور القديمة (أسماء بتاريخ) لا تُحسب
+    Migration(9, "blobs", [
+        """CREATE TABLE IF NOT EXISTS blobs(
+              url TEXT PRIMARY KEY,
+              sha256 TEXT NOT NULL,
+              refcount INTEGER NOT NULL DEFAULT 0,
+              created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )""",
+        "CREATE INDEX IF NOT EXISTS blobs_sha256_idx ON blobs(sha256)",
+        f"""CREATE OR REPLACE FUNCTION blob_ref() RETURNS trigger LANGUAGE plpgsql AS $$
+           DECLARE h TEXT;
+           BEGIN
+             IF TG_OP IN ('UPDATE','DELETE') THEN
+               UPDATE blobs SET refcount=refcount-1 WHERE url=OLD.image_path;
+             END IF;
+             IF TG_OP IN ('INSERT','UPDATE') THEN
+               h:=substring(NEW.image_path from '{BLOB_RE}');
+               IF h IS NOT NULL THEN
+                 INSERT INTO blobs(url,sha256,refcount) VALUES(NEW.image_path,h,1)
+                 ON CONFLICT (url) DO UPDATE SET refcount=blobs.refcount+1;
+               END IF;
+             END IF;
+             RETURN NULL;
+           END $$""",
+    ] + [stmt for t in ("products", "product_images") for stmt in (
+        trigger(f"{t}_blob_ref", t, f"""AFTER INSERT OR DELETE ON {t}
+            FOR EACH ROW EXECUTE FUNCTION blob_ref()"""),
+        trigger(f"{t}_blob_ref_upd", t, f"""AFTER UPDATE OF image_path ON {t}
+            FOR EACH ROW WHEN (OLD.image_path IS DISTINCT FROM NEW.image_path) EXECUTE FUNCTION blob_ref()"""),
+    )] + [
+        f"""INSERT INTO blobs(url,sha256,refcount)
+            SELECT url, substring(url from '{BLOB_RE}'), count(*)
+            FROM (SELECT image_path AS url FROM products UNION ALL SELECT image_path FROM product_images) r
+            WHERE url ~ '{BLOB_RE}'
+            GROUP BY url
+            ON CONFLICT (url) DO UPDATE SET refcount=EXCLUDED.refcount""",
+    ]),
+    # إصدار الكتالوج لـ ETag/Last-Modified: صف واحد يزيده نفس trigger الإشعار (catalog_notify)
+    Migration(10, "catalog_version", [
+        """CREATE TABLE IF NOT EXISTS catalog_version(
+              id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+              version BIGINT NOT NULL DEFAULT 1,
+              changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )""",
+        "INSERT INTO catalog_version(id) VALUES(true) ON CONFLICT DO NOTHING",
+        """CREATE OR REPLACE FUNCTION catalog_notify() RETURNS trigger LANGUAGE plpgsql AS $$
+           BEGIN
+             UPDATE catalog_version SET version=version+1, changed_at=clock_timestamp();
+             PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);   -- مكرر في نفس المعاملة = إشعار واحد
+             RETURN NULL;
+           END $$""",
+    ]),
+    # عدّ مراجع blobs مرة لكل استعلام بدل كل صف (الاستيراد الجماعي بـ COPY: عشرات آلاف الصفوف لنفس الصور)
+    Migration(11, "blob_ref_statement_triggers", [
+        f"""CREATE OR REPLACE FUNCTION blob_ref_stmt() RETURNS trigger LANGUAGE plpgsql AS $$
+           BEGIN
+             IF TG_OP='DELETE' THEN
+               UPDATE blobs b SET refcount=b.refcount-d.n
+               FROM (SELECT image_path, count(*) AS n FROM old_rows GROUP BY image_path) d
+               WHERE b.url=d.image_path;
+             ELSIF TG_OP='UPDATE' THEN
+               UPDATE blobs b SET refcount=b.refcount-d.n
+               FROM (SELECT o.image_path, count(*) AS n FROM old_rows o JOIN new_rows n USING (id)
+                     WHERE o.image_path IS DISTINCT FROM n.image_path GROUP BY o.image_path) d
+               WHERE b.url=d.image_path;
+               INSERT INTO blobs(url,sha256,refcount)
+               SELECT n.image_path, substring(n.image_path from '{BLOB_RE}'), count(*)
+               FROM old_rows o JOIN new_rows n USING (id)
+               WHERE o.image_path IS DISTINCT FROM n.image_path AND n.image_path ~ '{BLOB_RE}'
+               GROUP BY n.image_path ORDER BY 1
+               ON CONFLICT (url) DO UPDATE SET refcount=blobs.refcount+EXCLUDED.refcount;
+             ELSE
+               INSERT INTO blobs(url,sha256,refcount)
+               SELECT image_path, substring(image_path from '{BLOB_RE}'), count(*)
+               FROM new_rows WHERE image_path ~ '{BLOB_RE}'
+               GROUP BY image_path ORDER BY 1
+               ON CONFLICT (url) DO UPDATE SET refcount=blobs.refcount+EXCLUDED.refcount;
+             END IF;
+             RETURN NULL;
+           END $$""",
+    ] + [stmt for t in ("products", "product_images") for stmt in (
+        f"DROP TRIGGER IF EXISTS {t}_blob_ref ON {t}",
+        f"DROP TRIGGER IF EXISTS {t}_blob_ref_upd ON {t}",
+        trigger(f"{t}_blob_ref_ins", t, f"""AFTER INSERT ON {t}
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION blob_ref_stmt()"""),
+        trigger(f"{t}_blob_ref_del", t, f"""AFTER DELETE ON {t}
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION blob_ref_stmt()"""),
+        trigger(f"{t}_blob_ref_upd", t, f"""AFTER UPDATE ON {t}
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION blob_ref_stmt()"""),
+    )] + ["DROP FUNCTION IF EXISTS blob_ref()"]),
+    # بحث المنتجات: نص كامل (الاسم/الوصف/الملاحظات بأوزان) + trigram على الاسم للأخطاء الإملائية
+    # التطبيع العربي: حذف التشكيل والتطويل، أ/إ/آ/ٱ => ا، ى => ي، ة => ه، ؤ => و، ئ => ي
+    # فهارس على تعابير (لا أعمدة جديدة => لا إعادة كتابة للجدول)
+    Migration(12, "product_search", [
+        r"""CREATE OR REPLACE FUNCTION ar_normalize(t TEXT) RETURNS TEXT
+            LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+              SELECT lower(translate(regexp_replace(coalesce(t,''), E'[\u064B-\u0652\u0670\u0640]', '', 'g'),
+                                     E'\u0623\u0625\u0622\u0671\u0649\u0629\u0624\u0626',
+                                     E'\u0627\u0627\u0627\u0627\u064A\u0647\u0648\u064A'))
+            $$""",
+        """CREATE OR REPLACE FUNCTION product_search_vec(name TEXT, description TEXT, notes TEXT) RETURNS tsvector
+           LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+             SELECT setweight(to_tsvector('simple'::regconfig, ar_normalize(name)), 'A')
+                 || setweight(to_tsvector('simple'::regconfig, ar_normalize(description)), 'B')
+                 || setweight(to_tsvector('simple'::regconfig, ar_normalize(notes)), 'C')
+           $$""",
+        # "حذا" => 'حذا':* (بادئة: البحث أثناء الكتابة)؛ كل الكلمات مطلوبة. التقطيع بمحلل tsvector نفسه
+        """CREATE OR REPLACE FUNCTION ar_prefix_query(q TEXT) RETURNS tsquery
+           LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+             SELECT to_tsquery('simple'::regconfig, coalesce(string_agg(quote_literal(w)||':*', ' & '), ''))
+             FROM unnest(tsvector_to_array(to_tsvector('simple'::regconfig, ar_normalize(q)))) AS w
+           $$""",
+        index("products_search_idx", "products", "product_search_vec(name, description, notes)", using="gin"),
+        _trgm_index,
+    ], transactional=False),
+    # تجميعات الطلبيات (يوم × مسوّق × منتج × حالة) تُحدَّث مع كل إدراج/تغيير حالة => التحليلات لا تمسح orders
+    # order_totals: المجاميع حسب الحالة لِلوحة الأدمن، موزعة على 8 خانات (slot) حتى لا تتزاحم
+    # المعاملات المتزامنة على صف واحد؛ القراءة = جمع 24 صفًا
+    Migration(13, "order_rollups", [order_rollups_online], transactional=False),
+    # عدادات محاولات الدخول/التسجيل (نافذة منزلقة في app_pg.py). UNLOGGED: بلا WAL، وضياعها بعد انهيار مقبول
+    Migration(14, "rate_limits", [
+        """CREATE UNLOGGED TABLE IF NOT EXISTS rate_limits(
+              key TEXT NOT NULL,                    -- ip:<addr> أو acct:<email> أو user:<id>
+              bucket TIMESTAMPTZ NOT NULL,          -- بداية النافذة الثابتة
+              hits INTEGER NOT NULL DEFAULT 0,
+              PRIMARY KEY (key, bucket)
+            )""",
+        "CREATE INDEX IF NOT EXISTS rate_limits_bucket_idx ON rate_limits(bucket)",
+    ]),
+    # سجل الاستعلامات البطيئة (app_pg.py يكتبه من خيط خلفي، ويحذف ما تجاوز SLOW_QUERY_KEEP_DAYS)
+    Migration(15, "slow_queries", [
+        """CREATE TABLE IF NOT EXISTS slow_queries(
+              id BIGSERIAL PRIMARY KEY,
+              created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+              query_id TEXT NOT NULL,               -- بصمة SQL بعد التطبيع: يجمع نفس الاستعلام بقيم مختلفة
+              endpoint TEXT,                        -- اسم المسار أو cli
+              duration_ms REAL NOT NULL,
+              batch_size INTEGER NOT NULL DEFAULT 1,  -- >1: ضمن q_batch والزمن للدفعة كلها
+              sql TEXT NOT NULL,
+              params_fp TEXT,                       -- بصمة القيم لا القيم نفسها
+              plan TEXT                             -- EXPLAIN (ANALYZE, BUFFERS) لعينة من القراءات
+            )""",
+        "CREATE INDEX IF NOT EXISTS slow_queries_created_at_idx ON slow_queries(created_at)",
+    ]),
+    # slow-queries --plan <query_id>: آخر خطة ملتقطة؛ جزئي => فقط صفوف العينة التي فيها خطة
+    Migration(16, "slow_queries_plan_idx", [
+        index("slow_queries_plan_idx", "slow_queries", "query_id, id DESC", where="plan IS NOT NULL"),
+    ], transactional=False),
+    # طابور الصور: المحاولة التالية بعد مهلة (next_attempt_at) وحجز بمدة (locked_until) بدل قفل صف طوال الرفع
+    Migration(17, "image_jobs_lease", [
+        """ALTER TABLE image_jobs
+             ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+             ADD COLUMN IF NOT EXISTS locked_until TIMESTAMPTZ""",
+    ]),
+]
+
+
+def _run_step(conn, step):
+    if callable(step): step(conn)
+    else: conn.execute(step)
+
+
+def migrate(conninfo, verbose=False):
+    # اتصال مخصص (ليس من المسبح) لأن القفل الاستشاري مرتبط بالجلسة
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        if conn.info.server_version < MIN_SERVER_VERSION:
+            raise RuntimeError(f"PostgreSQL {conn.info.server_version} قديم: المطلوب {MIN_SERVER_VERSION // 10000} أو أحدث")
+        conn.execute("SELECT pg_advisory_lock(%s)", (LOCK_KEY,))
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS schema_migrations(
+                              version INTEGER PRIMARY KEY,
+                              name TEXT NOT NULL,
+                              applied_at TIMESTAMPTZ NOT NULL DEFAULT now())""")
+            done = {r[0] for r in conn.execute("SELECT version FROM schema_migrations")}
+            for m in sorted(MIGRATIONS, key=lambda m: m.version):
+                if m.version in done: continue
+                if verbose: print(f"-> {m.version:03d} {m.name}")
+                if m.transactional:
+                    with conn.transaction():
+                        for st in m.steps: _run_step(conn, st)
+                        conn.execute("INSERT INTO schema_migrations(version,name) VALUES(%s,%s)", (m.version, m.name))
+                else:
+                    # كل خطوة قابلة للإعادة: إن انقطع الترحيل يُستأنف من جديد بأمان
+                    for st in m.steps: _run_step(conn, st)
+                    conn.execute("INSERT INTO schema_migrations(version,name) VALUES(%s,%s)", (m.version, m.name))
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY,))
+
+
+def status(conninfo):
+    with psycopg.connect(conninfo) as conn:
+        done = {r[0]: r[1] for r in conn.execute("SELECT version, applied_at FROM schema_migrations")}
+    for m in MIGRATIONS:
+        print(f"{m.version:03d} {m.name:40s} {done.get(m.version) or 'PENDING'}")
+
+
+# ===================== التحقق من خطط الاستعلامات =====================
+# الاستعلامات الساخنة في app_pg.py بقيم تمثيلية؛ يجب ألا يظهر Seq Scan على الجداول الكبيرة
+BIG_TABLES = {"users", "products", "product_images", "orders", "withdrawals", "bonuses", "ledger_entries", "affiliate_balances", "blobs",
+              "order_rollups", "rate_limits", "slow_queries"}
+
+KEYSET_TOP = 2**31 - 1          # الصفحة الأولى (app_pg.page_args)
+_SINCE = datetime.now(timezone.utc) - timedelta(days=30)
+_UNTIL = datetime.now(timezone.utc)
+
+
+def _hot(name, query, allow=()):
+    # query: (sql, params[, kind]) كما تعيده queries.py ؛ allow: جداول مسحها كاملًا متوقع (تصدير بالجملة)
+    return name, query[0], query[1], set(allow)
+
+
+# نفس النصوص والمولّدات التي ينفذها app_pg (queries.py) بقيم تمثيلية
+HOT_QUERIES = [
+    _hot("login",                  (q.USER_BY_EMAIL_SQL, ("aff5@x",))),
+    _hot("register",               (q.REGISTER_SQL, ("n", "new@x", "x", "affiliate", False, "0555"))),
+    _hot("rate_limit",             (q.RATE_SQL, dict(k="ip:10.0.0.1", w=900, hit=True))),
+    _hot("rate_limit_read",        (q.RATE_SQL, dict(k="acct:aff5@x", w=900, hit=False))),
+    _hot("rate_limit_prune",       (q.RATE_PRUNE_SQL, (1800,))),
+    _hot("slow_queries_prune",     (q.SLOW_PRUNE_SQL, (7,))),
+    _hot("slow_queries_plan",      (q.SLOW_PLAN_SQL, ("0123456789abcdef",))),
+    _hot("slow_queries_report",    (q.SLOW_REPORT_SQL, (3600, 15))),
+    _hot("blob_lookup",            (q.BLOB_URL_SQL, ("c4ca4238a0b923820dcc509a6f75849bc81e728d9d4c2f636f067f89cc14862c",))),
+    _hot("products_first",         q.products_page_query(None, KEYSET_TOP, 50)),
+    _hot("products_before",        q.products_page_query(None, 15000, 50)),
+    _hot("products_cat_first",     q.products_page_query(7, KEYSET_TOP, 50)),
+    _hot("products_cat_before",    q.products_page_query(7, 15000, 50)),
+    _hot("product_detail",         q.product_detail_query(42)),
+    _hot("product_images",         q.product_images_query(42)),
+]
+for _fuzzy in (False, True):
+    _f = "_fuzzy" if _fuzzy else ""
+    HOT_QUERIES += [
+        _hot("search" + _f,            q.products_search_query("ساعه 1234", None, (None, KEYSET_TOP), 50, _fuzzy)),
+        _hot("search_after" + _f,      q.products_search_query("ساعه", None, (Decimal("0.05"), 15000), 50, _fuzzy)),
+        _hot("search_cat" + _f,        q.products_search_query("حداء رياضى", 7, (None, KEYSET_TOP), 50, _fuzzy)),
+        _hot("suggest" + _f,           q.products_suggest_query("حداء رياضى", _fuzzy)),
+    ]
+HOT_QUERIES += [
+    _hot("affiliate_orders",       q.affiliate_orders_query(5, None, KEYSET_TOP, 50)),
+    _hot("affiliate_orders_before", q.affiliate_orders_query(5, None, 150000, 50)),
+    _hot("affiliate_orders_status", q.affiliate_orders_query(5, "canceled", KEYSET_TOP, 50)),
+    _hot("affiliate_balance",      (q.BALANCE_SQL, dict(aid=5))),
+    _hot("withdraw",               (q.WITHDRAW_SQL, dict(aid=5, amount=1000, method="ccp", details="x"))),
+    _hot("last_week_bonus",        q.last_bonus_query(5, 2025, 10)),
+    _hot("weekly_bonus_job",       (q.WEEKLY_BONUS_SQL, dict(amount=1000, start=_UNTIL-timedelta(days=14),
+                                                            end=_UNTIL-timedelta(days=7), lo=0, hi=5000, y=2025, w=10))),
+    _hot("dashboard_stats",        q.DASHBOARD_STATS_Q),
+    _hot("dashboard_latest",       q.DASHBOARD_LATEST_Q),
+    _hot("dashboard_withdrawals",  q.DASHBOARD_WITHDRAWALS_Q),
+    _hot("affiliates_pending",     q.affiliates_page_query(False, KEYSET_TOP, 50)),
+    _hot("affiliates_approved",    q.affiliates_page_query(True, 15000, 50)),
+    _hot("admin_settings",         q.admin_affiliates_query(15000, 50)),
+    _hot("admin_user",             q.ADMIN_USER_Q),
+    _hot("order_status",           (q.ORDER_STATUS_SQL, dict(ids=[42], statuses=["delivered"]))),
+    _hot("order_status_bulk",      (q.ORDER_STATUS_BULK_SQL, None)),
+    _hot("withdraw_status",        (q.WITHDRAW_STATUS_SQL, dict(wid=100, status="rejected"))),
+    _hot("import_categories",      (q.IMPORT_CATEGORIES_SQL, (["cat1", "جديد"],))),
+    _hot("import_category_ids",    (q.IMPORT_CATEGORY_IDS_SQL, (["cat1", "جديد"],))),
+    _hot("import_ids",             (q.IMPORT_IDS_SQL, (100,))),
+    _hot("export_orders",          q.orders_export_query(*q.export_where("o", _SINCE, _UNTIL, "delivered")),
+         allow=("products", "users")),                # عشرات آلاف الطلبيات: hash join مع الجدولين كاملين
+    _hot("export_orders_affiliate", q.orders_export_query(*q.export_where("o", affiliate_id=5))),
+    _hot("export_withdrawals",     q.withdrawals_export_query(*q.export_where("w", _SINCE, _UNTIL, "requested"))),
+    _hot("export_statement",       q.statement_export_query(5, *q.export_where("s", _SINCE, _UNTIL))),
+]
+_analytics = q.analytics_queries(date.today()-timedelta(days=30), date.today()+timedelta(days=1), 10)
+HOT_QUERIES += [_hot(n, x) for n, x in zip(("analytics_series", "analytics_top_affiliates", "analytics_top_products"), _analytics)]
+
+SEED_SQL = [
+    "INSERT INTO categories(name) SELECT 'cat'||g FROM generate_series(1,%(cats)s) g",
+    """INSERT INTO users(name,email,password_hash,role,approved,created_at)
+       SELECT 'aff'||g, 'aff'||g||'@x', 'x', CASE WHEN g=1 THEN 'admin' ELSE 'affiliate' END, g%%10<>0, now()-g*interval '1 minute'
+       FROM generate_series(1,%(users)s) g""",
+    """INSERT INTO products(name,price,commission,delivery_price,image_path,category_id,created_at)
+       SELECT (ARRAY['حذاء رياضي','ساعة يد','حقيبة ظهر','سماعة لاسلكية','قميص قطني','عطر','مكواة','خلاط كهربائي'])[1+g%%8]||' '||g,
+              1000+g%%500, 100, 400, '/static/img/placeholder.svg', 1+g%%%(cats)s, now()-g*interval '1 minute'
+       FROM generate_series(1,%(products)s) g""",
+    """INSERT INTO product_images(product_id,image_path,created_at)
+       SELECT 1+g%%%(products)s, '/static/uploads/x'||g||'.jpg', now() FROM generate_series(1,%(products)s*3) g""",
+    """INSERT INTO orders(product_id,affiliate_id,customer_name,customer_phone,customer_address,status,created_at)
+       SELECT 1+g%%%(products)s, 2+g%%(%(users)s-1), 'c', '0555', 'addr',
+              (ARRAY['pending','delivered','delivered','canceled'])[1+g%%4], now()-(%(orders)s-g)*interval '1 minute'
+       FROM generate_series(1,%(orders)s) g""",
+    """INSERT INTO withdrawals(affiliate_id,amount,method,details,status,created_at)
+       SELECT 2+g%%(%(users)s-1), 5000, 'ccp', 'x',
+              CASE WHEN g%%100=0 THEN 'requested' WHEN g%%10=0 THEN 'rejected' ELSE 'approved' END, now()
+       FROM generate_series(1,%(orders)s/20) g""",
+    """INSERT INTO bonuses(affiliate_id,iso_year,iso_week,amount)
+       SELECT 2+g%%(%(users)s-1), 2025, 1+g/(%(users)s-1), 1000 FROM generate_series(1,%(users)s*5) g""",
+    "INSERT INTO affiliate_balances(affiliate_id,balance) SELECT id, 1000 FROM users WHERE role='affiliate'",
+    """INSERT INTO ledger_entries(affiliate_id,kind,amount,order_id,created_at)
+       SELECT affiliate_id,'commission',commission,id,created_at FROM orders WHERE status='delivered'""",
+    """INSERT INTO blobs(url,sha256,refcount)
+       SELECT '/static/uploads/'||h||'.jpg', h, 1 FROM (SELECT md5(g::text)||md5((-g)::text) AS h FROM generate_series(1,%(products)s) g) s""",
+    """INSERT INTO rate_limits(key,bucket,hits)
+       SELECT 'ip:10.0.'||(g%%250)||'.'||(g/250%%250), to_timestamp(floor(extract(epoch FROM now())/900)*900)-(g%%2)*interval '15 minutes', 1
+       FROM generate_series(1,%(users)s*5) g ON CONFLICT DO NOTHING""",
+    """INSERT INTO slow_queries(created_at,query_id,endpoint,duration_ms,batch_size,sql,params_fp)
+       SELECT now()-g*interval '5 seconds', md5((g%%200)::text), 'affiliate_products', 300, 1, 'SELECT 1', 'x'
+       FROM generate_series(1,%(orders)s/4) g""",
+]
+
+
+def _plan_nodes(plan):
+    yield plan
+    for ch in plan.get("Plans", []):
+        yield from _plan_nodes(ch)
+
+
+def check_indexes(conninfo, users=20000, products=20000, orders=200000, cats=100):
+    schema = "dz_index_check"
+    sizes = dict(users=users, products=products, orders=orders, cats=cats)
+    bad = []
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        conn.execute(f"CREATE SCHEMA {schema}")
+        try:
+            migrate(make_conninfo(conninfo, options=f"-c search_path={schema},public"))   # public: الإضافات (pg_trgm)
+            conn.execute(f"SET search_path={schema},public")
+            for sql in SEED_SQL: conn.execute(sql, sizes)
+            conn.execute("VACUUM ANALYZE")
+            trgm = conn.execute("SELECT 1 FROM pg_extension WHERE extname='pg_trgm'").fetchone()
+            with conn.transaction(force_rollback=True):
+                conn.execute(q.ORDER_STATUS_IMPORT_SQL)         # جدول COPY للحالات الجماعية
+                for name, sql, params, allow in HOT_QUERIES:
+                    if "<%%" in sql and not trgm:
+                        print(f"skip {name:24s} pg_trgm"); continue
+                    plan = conn.execute("EXPLAIN (FORMAT JSON) " + sql, params).fetchone()[0][0]["Plan"]
+                    seq = sorted({n["Relation Name"] for n in _plan_nodes(plan)
+                                  if n["Node Type"] == "Seq Scan" and n.get("Relation Name") in BIG_TABLES - allow})
+                    print(f"{'FAIL' if seq else 'ok  '} {name:24s} {('seq scan on ' + ', '.join(seq)) if seq else ''}")
+                    if seq: bad.append(name)
+        finally:
+            conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    return bad
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    url = os.environ.get("DATABASE_URL", "").strip()
+    if not url:
+        sys.exit("DATABASE_URL مفقود")
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "migrate"
+    if cmd == "migrate":
+        migrate(url, verbose=True); print("Migration done.")
+    elif cmd == "status":
+        status(url)
+    elif cmd == "check-indexes":
+        sys.exit(1 if check_indexes(url) else 0)
+    else:
+        sys.exit(f"أمر غير معروف: {cmd}")
@@ -0,0 +1,273 @@
+# queries.py — نصوص استعلامات app_pg.py ومولّداتها (بلا Flask ولا اتصال)
+# - app_pg ينفذها، و migrate_db.py check-indexes يفحص خططها بنفس النص => لا نسخة يدوية تنحرف عن الأصل
+# - المولّد يعيد (sql, params, kind) كما تتوقعه q_batch/cached_batch؛ kind = "one" أو "all"
+
+from datetime import timedelta
+from typing import Optional, Tuple
+
+# ---- مصادقة وحد المحاولات ----
+USER_BY_EMAIL_SQL="SELECT * FROM users WHERE email=%s"
+REGISTER_SQL="""INSERT INTO users(name,email,password_hash,role,approved,phone)
+                VALUES(%s,%s,%s,%s,%s,%s)"""
+
+# نافذة منزلقة تقريبية من نافذتين ثابتتين: السابقة بوزن ما بقي منها داخل النافذة الحالية
+RATE_SQL="""WITH b AS (SELECT to_timestamp(floor(extract(epoch FROM now())/%(w)s)*%(w)s) AS cur),
+                 up AS (INSERT INTO rate_limits(key,bucket,hits) SELECT %(k)s, cur, 1 FROM b WHERE %(hit)s
+                        ON CONFLICT (key,bucket) DO UPDATE SET hits=rate_limits.hits+1 RETURNING hits)
+            SELECT COALESCE((SELECT hits FROM up), (SELECT r.hits FROM rate_limits r WHERE r.key=%(k)s AND r.bucket=b.cur), 0) AS cur,
+                   COALESCE((SELECT r.hits FROM rate_limits r WHERE r.key=%(k)s AND r.bucket=b.cur-make_interval(secs=>%(w)s)), 0) AS prev,
+                   extract(epoch FROM now()-b.cur)::float8/%(w)s AS frac
+            FROM b"""
+RATE_PRUNE_SQL="DELETE FROM rate_limits WHERE bucket<now()-make_interval(secs=>%s)"
+
+# ---- سجل الاستعلامات البطيئة ----
+SLOW_INSERT_SQL="""INSERT INTO slow_queries(created_at,query_id,endpoint,duration_ms,batch_size,sql,params_fp,plan)
+                   VALUES(%s,%s,%s,%s,%s,%s,%s,%s)"""
+SLOW_PRUNE_SQL="DELETE FROM slow_queries WHERE created_at<now()-make_interval(days=>%s)"
+SLOW_PLAN_SQL="""SELECT created_at, endpoint, duration_ms, sql, plan FROM slow_queries
+                 WHERE query_id=%s AND plan IS NOT NULL ORDER BY id DESC LIMIT 1"""
+SLOW_REPORT_SQL="""SELECT query_id, count(*), sum(duration_ms), avg(duration_ms), max(duration_ms),
+                          string_agg(DISTINCT endpoint, ','), min(sql), bool_or(plan IS NOT NULL)
+                   FROM slow_queries WHERE created_at>=now()-make_interval(secs=>%s)
+                   GROUP BY query_id ORDER BY 3 DESC LIMIT %s"""
+
+# ---- الصور ----
+BLOB_URL_SQL="SELECT url FROM blobs WHERE sha256=%s LIMIT 1"
+
+# ---- الكتالوج ----
+CATEGORIES_Q=("SELECT * FROM categories ORDER BY name ASC",(),"all")
+
+def products_page_query(cat_id:Optional[int], before:int, n:int):
+    if cat_id:
+        return ("""SELECT p.*, c.name AS category_name
+                   FROM products p LEFT JOIN categories c ON c.id=p.category_id
+                   WHERE p.category_id=%s AND p.id<%s ORDER BY p.id DESC LIMIT %s""",(cat_id,before,n+1),"all")
+    return ("""SELECT p.*, c.name AS category_name
+               FROM products p LEFT JOIN categories c ON c.id=p.category_id
+               WHERE p.id<%s ORDER BY p.id DESC LIMIT %s""",(before,n+1),"all")
+
+# البحث: نص كامل (products_search_idx) أو تشابه trigram مع الاسم (products_name_trgm_idx) إن ثُبّت pg_trgm
+SUGGEST_LIMIT=8
+SEARCH_FROM="(SELECT ar_prefix_query(%s) AS tq, ar_normalize(%s) AS qn) sq"
+
+def search_sql(fuzzy:bool)->Tuple[str,str]:
+    # (شرط المطابقة، تعبير الدرجة) على sq.tq/sq.qn: السؤال مطبّعًا مرة واحدة (ثوابت => الفهارس تُستعمل)
+    match="product_search_vec(p.name,p.description,p.notes) @@ sq.tq"
+    score="ts_rank(product_search_vec(p.name,p.description,p.notes), sq.tq)"
+    if fuzzy:
+        match=f"({match} OR sq.qn <%% ar_normalize(p.name))"
+        score+=" + word_similarity(sq.qn, ar_normalize(p.name))"
+    return match, f"round(({score})::numeric, 6)"
+
+def products_search_query(q:str, cat_id:Optional[int], after, n:int, fuzzy:bool):
+    # after = (score, id) من الصفحة السابقة؛ score=None => الصفحة الأولى
+    (score,pid),(match,rank)=after,search_sql(fuzzy)
+    where=[match]; params=[q,q]
+    if cat_id: where.append("p.category_id=%s"); params.append(cat_id)
+    page=""
+    if score is not None: page="WHERE (score, id) < (%s, %s)"; params+=[score,pid]
+    return (f"""SELECT * FROM (
+                  SELECT p.*, c.name AS category_name, {rank} AS score
+                  FROM products p LEFT JOIN categories c ON c.id=p.category_id, {SEARCH_FROM}
+                  WHERE {" AND ".join(where)}) s
+                {page} ORDER BY score DESC, id DESC LIMIT %s""", (*params, n+1), "all")
+
+def products_suggest_query(q:str, fuzzy:bool):
+    match,rank=search_sql(fuzzy)
+    return (f"""SELECT p.id, p.name, p.image_path FROM products p, {SEARCH_FROM}
+                WHERE {match} ORDER BY {rank} DESC, p.id DESC LIMIT %s""", (q, q, SUGGEST_LIMIT), "all")
+
+def product_detail_query(pid:int):
+    return ("""SELECT p.*, c.name AS category_name
+               FROM products p LEFT JOIN categories c ON c.id=p.category_id WHERE p.id=%s""",(pid,),"one")
+
+def product_images_query(pid:int):
+    return ("SELECT image_path FROM product_images WHERE product_id=%s ORDER BY id ASC",(pid,),"all")
+
+# ---- المسوّق ----
+def affiliate_orders_query(aid:int, status:Optional[str], before:int, n:int):
+    if status:
+        return ("""SELECT o.*, p.name AS product_name, p.image_path
+                   FROM orders o JOIN products p ON p.id=o.product_id
+                   WHERE o.affiliate_id=%s AND o.status=%s AND o.id<%s ORDER BY o.id DESC LIMIT %s""",(aid,status,before,n+1),"all")
+    return ("""SELECT o.*, p.name AS product_name, p.image_path
+               FROM orders o JOIN products p ON p.id=o.product_id
+               WHERE o.affiliate_id=%s AND o.id<%s ORDER BY o.id DESC LIMIT %s""",(aid,before,n+1),"all")
+
+def last_bonus_query(aid:int, y:int, w:int):
+    return ("SELECT amount FROM bonuses WHERE affiliate_id=%s AND iso_year=%s AND iso_week=%s",(aid,y,w),"one")
+
+# الرصيد مُجمّع في affiliate_balances ويُحدَّث مع كل حركة في ledger_entries => قراءة بالمفتاح الأساسي
+# لا صف بعد = لا حركات بعد => 0
+BALANCE_SQL="""SELECT COALESCE((SELECT balance FROM affiliate_balances WHERE affiliate_id=%(aid)s),0) AS balance"""
+
+# طلب السحب في استعلام واحد: UPDATE على صف الرصيد يقفله، وشرط الرصيد يُعاد تقييمه بعد القفل
+# => طلبان متزامنان لا يمكنهما تجاوز الرصيد. لا صف عائد = الرصيد لم يعد يكفي (ولم يُكتب شيء)
+WITHDRAW_SQL="""WITH bal AS (
+                  UPDATE affiliate_balances SET balance=balance-%(amount)s, updated_at=now()
+                  WHERE affiliate_id=%(aid)s AND balance>=%(amount)s
+                  RETURNING affiliate_id),
+                w AS (
+                  INSERT INTO withdrawals(affiliate_id,amount,method,details,status)
+                  SELECT affiliate_id,%(amount)s,%(method)s,%(details)s,'requested' FROM bal
+                  RETURNING id)
+                INSERT INTO ledger_entries(affiliate_id,kind,amount,withdrawal_id)
+                SELECT %(aid)s,'withdrawal',-%(amount)s,id FROM w RETURNING withdrawal_id"""
+
+# علاوة أسبوع ISO مكتمل لكل المسوّقين في تمريرة واحدة: n//10 × WEEKLY_BONUS (n = طلبيات مُوصلة خلال الأسبوع)
+# العلاوة + قيد الدفتر + الرصيد في نفس المعاملة؛ ON CONFLICT DO NOTHING => إعادة التشغيل لا تكرر شيئًا
+WEEKLY_BONUS_SQL="""WITH c AS (
+                      SELECT affiliate_id, (COUNT(*)/10)*%(amount)s AS amount FROM orders
+                      WHERE status='delivered' AND created_at>=%(start)s AND created_at<%(end)s
+                        AND affiliate_id>=%(lo)s AND affiliate_id<%(hi)s
+                      GROUP BY affiliate_id HAVING COUNT(*)>=10),
+                    b AS (
+                      INSERT INTO bonuses(affiliate_id,iso_year,iso_week,amount)
+                      SELECT affiliate_id,%(y)s,%(w)s,amount FROM c
+                      ON CONFLICT (affiliate_id,iso_year,iso_week) DO NOTHING RETURNING id, affiliate_id, amount),
+                    l AS (
+                      INSERT INTO ledger_entries(affiliate_id,kind,amount,bonus_id)
+                      SELECT affiliate_id,'bonus',amount,id FROM b),
+                    bal AS (
+                      INSERT INTO affiliate_balances AS x (affiliate_id,balance)
+                      SELECT affiliate_id, amount FROM b
+                      ON CONFLICT (affiliate_id) DO UPDATE SET balance=x.balance+EXCLUDED.balance, updated_at=now())
+                    SELECT COUNT(*) AS n, COALESCE(SUM(amount),0) AS total FROM b"""
+
+# ---- الأدمن ----
+# order_totals: 8 صفوف لكل حالة تُحدَّث مع الطلبيات (migrate_db.py) بدل مسح orders كاملًا
+DASHBOARD_STATS_Q=("""SELECT COALESCE(SUM(orders),0)::bigint AS orders_total,
+                             COALESCE(SUM(orders) FILTER (WHERE status='delivered'),0)::bigint AS delivered,
+                             COALESCE(SUM(orders) FILTER (WHERE status='pending'),0)::bigint   AS pending,
+                             COALESCE(SUM(orders) FILTER (WHERE status='canceled'),0)::bigint  AS canceled
+                      FROM order_totals""",(),"one")
+DASHBOARD_LATEST_Q=("""SELECT o.*, p.name AS product_name, p.image_path, u.name AS affiliate_name
+                       FROM orders o JOIN products p ON p.id=o.product_id
+                       JOIN users u ON u.id=o.affiliate_id
+                       ORDER BY o.id DESC LIMIT 20""",(),"all")
+DASHBOARD_WITHDRAWALS_Q=("""SELECT w.*, u.name AS affiliate_name, u.email
+                            FROM withdrawals w JOIN users u ON u.id=w.affiliate_id
+                            WHERE w.status='requested' ORDER BY w.id DESC""",(),"all")
+def affiliates_page_query(approved:bool, before:int, n:int):
+    return ("SELECT * FROM users WHERE role='affiliate' AND approved=%s AND id<%s ORDER BY id DESC LIMIT %s",(approved,before,n+1),"all")
+
+def admin_affiliates_query(before:int, n:int):
+    return ("""SELECT id,name,email,phone,approved,created_at FROM users
+               WHERE role='affiliate' AND id<%s ORDER BY id DESC LIMIT %s""",(before,n+1),"all")
+
+ADMIN_USER_Q=("SELECT id,name,email FROM users WHERE role='admin' ORDER BY id LIMIT 1",(),"one")
+
+# تغيير حالة الطلبات + قيود الدفتر + الرصيد في استعلام واحد (مصفوفتا ids/statuses => يصلح للتحديث الجماعي)
+# التوصيل يضيف العمولة (اللقطة المحفوظة في الطلب)، والخروج من "delivered" يعكسها
+# الأقفال بترتيب id لتفادي deadlock بين تحديثين متزامنين
+ORDER_STATUS_EFFECTS="""
+                    old AS (
+                      SELECT o.id, o.status FROM orders o JOIN req USING (id) ORDER BY o.id FOR UPDATE OF o),
+                    upd AS (
+                      UPDATE orders o SET status=req.status FROM old JOIN req USING (id)
+                      WHERE o.id=old.id AND old.status<>req.status
+                      RETURNING o.id, o.affiliate_id, o.commission, old.status AS old_status, o.status AS new_status),
+                    led AS (
+                      INSERT INTO ledger_entries(affiliate_id,kind,amount,order_id)
+                      SELECT affiliate_id,
+                             CASE WHEN new_status='delivered' THEN 'commission' ELSE 'commission_reversal' END,
+                             CASE WHEN new_status='delivered' THEN commission ELSE -commission END, id
+                      FROM upd WHERE (new_status='delivered')<>(old_status='delivered')
+                      RETURNING affiliate_id, amount),
+                    bal AS (
+                      INSERT INTO affiliate_balances AS b (affiliate_id,balance)
+                      SELECT affiliate_id, SUM(amount) FROM led GROUP BY affiliate_id
+                      ON CONFLICT (affiliate_id) DO UPDATE SET balance=b.balance+EXCLUDED.balance, updated_at=now())"""
+ORDER_STATUS_SQL="""WITH req AS (
+                      SELECT * FROM unnest(%(ids)s::int[], %(statuses)s::text[]) AS r(id, status)),"""+ORDER_STATUS_EFFECTS+"""
+                    SELECT id, old_status, new_status FROM upd"""
+
+# نفس الآثار من جدول مؤقت (COPY)؛ رقم مكرر في الملف => آخر سطر هو المعتمد
+ORDER_STATUS_IMPORT_SQL="CREATE TEMP TABLE order_status_import(n INT, id INT, status TEXT) ON COMMIT DROP"
+ORDER_STATUS_BULK_SQL="""WITH req AS (
+                      SELECT DISTINCT ON (id) id, status FROM order_status_import ORDER BY id, n DESC),"""+ORDER_STATUS_EFFECTS+"""
+                    SELECT 'updated' AS kind, id, old_status, new_status FROM upd
+                    UNION ALL
+                    SELECT 'unmatched', r.id, NULL, NULL FROM req r WHERE NOT EXISTS (SELECT 1 FROM orders o WHERE o.id=r.id)"""
+
+# رفض طلب سحب يعيد المبلغ للرصيد، وإعادة قبول طلب مرفوض يخصمه من جديد
+# الخصم من جديد فقط إن كان الرصيد يكفي (قد يكون المسوّق سحب المبلغ المُعاد): صف الرصيد مقفول في نفس الاستعلام
+# النتيجة: لا صف = طلب غير موجود؛ updated=0 والحالة القديمة rejected = الرصيد لا يكفي
+WITHDRAW_STATUS_SQL="""WITH old AS (
+                         SELECT id, affiliate_id, amount, status FROM withdrawals WHERE id=%(wid)s FOR UPDATE),
+                       bal AS (
+                         SELECT b.balance FROM affiliate_balances b JOIN old ON b.affiliate_id=old.affiliate_id FOR UPDATE OF b),
+                       upd AS (
+                         UPDATE withdrawals w SET status=%(status)s FROM old
+                         WHERE w.id=old.id AND old.status<>%(status)s
+                           AND (old.status<>'rejected' OR old.amount<=COALESCE((SELECT balance FROM bal),0))
+                         RETURNING w.id, w.affiliate_id, w.amount, old.status AS old_status, w.status AS new_status),
+                       led AS (
+                         INSERT INTO ledger_entries(affiliate_id,kind,amount,withdrawal_id)
+                         SELECT affiliate_id,
+                                CASE WHEN new_status='rejected' THEN 'withdrawal_reversal' ELSE 'withdrawal' END,
+                                CASE WHEN new_status='rejected' THEN amount ELSE -amount END, id
+                         FROM upd WHERE (new_status='rejected')<>(old_status='rejected')
+                         RETURNING affiliate_id, amount),
+                       acc AS (
+                         INSERT INTO affiliate_balances AS b (affiliate_id,balance)
+                         SELECT affiliate_id, amount FROM led
+                         ON CONFLICT (affiliate_id) DO UPDATE SET balance=b.balance+EXCLUDED.balance, updated_at=now())
+                       SELECT old.status AS old_status, (SELECT COUNT(*) FROM upd) AS updated FROM old"""
+
+# ---- التحليلات: من order_rollups فقط (يوم × مسوّق × منتج × حالة) ----
+ROLLUP_SUMS="""COALESCE(SUM(orders),0)::bigint AS orders,
+               COALESCE(SUM(orders) FILTER (WHERE status='delivered'),0)::bigint AS delivered,
+               COALESCE(SUM(orders) FILTER (WHERE status='canceled'),0)::bigint AS canceled,
+               COALESCE(SUM(orders) FILTER (WHERE status='pending'),0)::bigint AS pending,
+               COALESCE(SUM(amount) FILTER (WHERE status='delivered'),0)::float8 AS revenue,
+               COALESCE(SUM(commission) FILTER (WHERE status='delivered'),0)::float8 AS commission"""
+_ROLLUP_TOP="""SELECT t.*, x.name FROM (
+                 SELECT {key}, {sums} FROM order_rollups WHERE day>=%s AND day<%s
+                 GROUP BY {key} ORDER BY delivered DESC, orders DESC, {key} LIMIT %s) t
+               LEFT JOIN {table} x ON x.id=t.{key} ORDER BY delivered DESC, orders DESC, t.{key}"""
+
+def analytics_queries(start, end, top:int):
+    # (السلسلة اليومية، أفضل المسوّقين، أفضل المنتجات) في [start, end)
+    return ((f"SELECT day, {ROLLUP_SUMS} FROM order_rollups WHERE day>=%s AND day<%s GROUP BY day ORDER BY day",(start,end),"all"),
+            (_ROLLUP_TOP.format(key="affiliate_id", table="users", sums=ROLLUP_SUMS),(start,end,top),"all"),
+            (_ROLLUP_TOP.format(key="product_id", table="products", sums=ROLLUP_SUMS),(start,end,top),"all"))
+
+# ---- الاستيراد الجماعي (المنتجات وصورها بعدها بـ COPY) ----
+IMPORT_CATEGORIES_SQL="""INSERT INTO categories(name) SELECT unnest(%s::text[])
+                         ON CONFLICT (name) DO NOTHING RETURNING id"""
+IMPORT_CATEGORY_IDS_SQL="SELECT name,id FROM categories WHERE name=ANY(%s)"
+IMPORT_IDS_SQL="""SELECT nextval(pg_get_serial_sequence('products','id'))
+                  FROM generate_series(1,%s)"""
+
+# ---- التصدير (مؤشر على الخادم) ----
+def export_where(alias:str, since=None, until=None, status:Optional[str]=None, affiliate_id:Optional[int]=None)->Tuple[str, list]:
+    # since/until: datetime (UTC) لأيام شاملة => [since, until+1 يوم)
+    where=["true"]; params=[]
+    if since: where.append(f"{alias}.created_at>=%s"); params.append(since)
+    if until: where.append(f"{alias}.created_at<%s"); params.append(until+timedelta(days=1))
+    if status: where.append(f"{alias}.status=%s"); params.append(status)
+    if affiliate_id: where.append(f"{alias}.affiliate_id=%s"); params.append(affiliate_id)
+    return " AND ".join(where), params
+
+def orders_export_query(where:str, params):
+    return (f"""SELECT o.id, o.created_at, p.name, u.name, u.email, o.customer_name, o.customer_phone,
+                   o.customer_address, o.status, o.commission, o.price
+            FROM orders o JOIN products p ON p.id=o.product_id JOIN users u ON u.id=o.affiliate_id
+            WHERE {where} ORDER BY o.id""",params,"all")
+
+def withdrawals_export_query(where:str, params):
+    return (f"""SELECT w.id, w.created_at, u.name, u.email, w.amount, w.method, w.details, w.status
+            FROM withdrawals w JOIN users u ON u.id=w.affiliate_id
+            WHERE {where} ORDER BY w.id""",params,"all")
+
+def statement_export_query(affiliate_id:Optional[int], where:str, params):
+    # الرصيد التراكمي على كل تاريخ المسوّق ثم فلترة الفترة => رصيد صحيح من أول سطر فيها
+    inner,iparams=("e.affiliate_id=%s", [affiliate_id]) if affiliate_id else ("true", [])
+    return (f"""SELECT s.* FROM (
+              SELECT e.id, e.created_at, e.affiliate_id, u.name, e.kind, e.amount,
+                     SUM(e.amount) OVER (PARTITION BY e.affiliate_id ORDER BY e.id) AS balance,
+                     e.order_id, e.withdrawal_id
+              FROM ledger_entries e JOIN users u ON u.id=e.affiliate_id
+              WHERE {inner}) s
+            WHERE {where} ORDER BY s.affiliate_id, s.id""",iparams+list(params),"all")
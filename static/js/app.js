@@ -8,3 +8,52 @@ document.addEventListener('click', (e)=>{
     setTimeout(()=> btn.innerHTML = '<i class="fa-regular fa-copy"></i>', 1000);
   });
 });
+
+// تحميل المزيد (ترقيم keyset): جلب الصفحة التالية وإلحاق عناصر القائمة نفسها
+document.addEventListener('click', async (e)=>{
+  const a = e.target.closest('a.load-more');
+  if(!a) return;
+  e.preventDefault();
+  const target = a.getAttribute('data-target');
+  const list = document.querySelector(target);
+  if(!list || a.classList.contains('disabled')) return;
+  a.classList.add('disabled');
+  try{
+    const res = await fetch(a.href, {credentials:'same-origin'});
+    if(!res.ok) throw new Error(res.status);
+    const doc = new DOMParser().parseFromString(await res.text(), 'text/html');
+    const more = doc.querySelector(target);
+    if(more) list.append(...more.children);
+    const next = doc.querySelector(`a.load-more[data-target="${target}"]`);
+    if(next){ a.href = next.href; a.classList.remove('disabled'); }
+    else a.parentElement.remove();
+  }catch(err){
+    window.location = a.href;   // احتياط: الانتقال للصفحة التالية عاديًا
+  }
+});
+
+// البحث عن المنتجات: اقتراحات أثناء الكتابة (datalist)، اختيار اقتراح يفتح المنتج مباشرة
+document.querySelectorAll('input[data-suggest]').forEach((input)=>{
+  const list = document.getElementById(input.getAttribute('list'));
+  let timer, ctrl, urls = {};
+  input.addEventListener('input', ()=>{
+    const q = input.value.trim();
+    if(urls[q]){ window.location = urls[q]; return; }
+    clearTimeout(timer);
+    if(q.length < 2){ list.replaceChildren(); return; }
+    timer = setTimeout(async ()=>{
+      if(ctrl) ctrl.abort();
+      ctrl = new AbortController();
+      try{
+        const res = await fetch(`${input.dataset.suggest}?q=${encodeURIComponent(q)}`, {credentials:'same-origin', signal:ctrl.signal});
+        if(!res.ok) return;
+        const items = await res.json();
+        urls = {};
+        list.replaceChildren(...items.map((it)=>{
+          urls[it.name] = it.url;
+          const o = document.createElement('option'); o.value = it.name; return o;
+        }));
+      }catch(err){ /* طلب أحدث ألغى هذا */ }
+    }, 150);
+  });
+});